@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""
+Build or extend the embedded BM25 index (search-es.py --query-type bm25).
+
+Reads the stackexchange NDJSON dumps (the files so_bulk_insert_es.py
+indexes into ES) and appends one or more segments per site to the index
+directory. Running it again with new files adds segments next to the
+existing ones; search workers pick them up without a restart. If a question
+is indexed twice, searches return its newest copy.
+
+Segments are only ever appended. Indexing a file twice would add a second
+copy of every question to the collection statistics (document count and
+frequencies), so files already indexed (same path, size and modification
+time, recorded in files.json) are refused. Rebuild into a new directory to
+index them again.
+"""
+
+from argparse import ArgumentParser
+import json
+import logging
+import os
+import sys
+import time
+
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+from bm25 import META, write_meta, write_segment
+from records import blacklist_message
+
+FILES = "files.json"
+
+logging.basicConfig(level=logging.INFO)
+
+
+def read_questions(files, fields):
+    """
+    Yield (site, id, title, text) of the questions in NDJSON files.
+    """
+    for path in files:
+        with open(path) as f:
+            for line in f:
+                try:
+                    doc = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.debug(f"Malformed JSON: {line}")
+                    continue
+                if blacklist_message(doc):
+                    continue
+                if "id" not in doc or "site" not in doc:
+                    continue
+                text = " ".join(doc.get(field) or "" for field in fields)
+                yield doc["site"], doc["id"], doc.get("title") or "", text
+
+
+def file_key(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def main():
+    parser = ArgumentParser("Append questions to the embedded BM25 index.")
+    parser.add_argument("files", help="NDJSON files with questions.", nargs="+")
+    parser.add_argument("--out", help="Index directory.", required=True)
+    parser.add_argument(
+        "--fields",
+        help="Comma separated fields indexed, like the ES --field of search-es.py. "
+        "Fixed when the index is created.",
+        default="body",
+    )
+    parser.add_argument(
+        "--segment-size",
+        help="Max questions per segment. Larger segments search faster but "
+        "take more memory to build.",
+        default=200_000,
+        type=int,
+    )
+    args = parser.parse_args()
+
+    fields = args.fields.split(",")
+    meta_path = os.path.join(args.out, META)
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            indexed = json.load(f)["fields"]
+        if indexed != fields:
+            parser.error(f"{args.out} indexes {indexed}, not {fields}.")
+    else:
+        write_meta(args.out, fields)
+
+    files_path = os.path.join(args.out, FILES)
+    indexed_files = {}
+    if os.path.exists(files_path):
+        with open(files_path) as f:
+            indexed_files = json.load(f)
+    files = {os.path.abspath(path): file_key(path) for path in args.files}
+    again = [path for path, key in files.items() if indexed_files.get(path) == key]
+    if again:
+        parser.error(f"{', '.join(again)} already indexed into {args.out}.")
+
+    start = time.time()
+    buffers = {}
+    segments = count = 0
+    for site, id, title, text in read_questions(args.files, fields):
+        buffer = buffers.setdefault(site, [])
+        buffer.append((id, title, text))
+        count += 1
+        if len(buffer) >= args.segment_size:
+            write_segment(args.out, site, buffer)
+            segments += 1
+            buffers[site] = []
+    for site, buffer in buffers.items():
+        if buffer:
+            write_segment(args.out, site, buffer)
+            segments += 1
+
+    indexed_files.update(files)
+    tmp = f"{files_path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(indexed_files, f, indent=2)
+    os.replace(tmp, files_path)
+
+    elapsed = time.time() - start
+    logging.info(
+        f"Indexed {count} questions of {len(buffers)} sites in {segments} segments "
+        f"in {elapsed:.1f} s."
+    )
+
+
+if __name__ == "__main__":
+    main()
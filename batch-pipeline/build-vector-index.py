@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+"""
+Build the vector index used by search-es.py --query-type vector.
+
+Reads stackexchange NDJSON dumps (local files) twice:
+
+1. Counts document frequencies of the hashed terms of every question and
+   keeps a uniform sample of questions, on which a truncated SVD of the
+   TF-IDF matrix is computed (randomized SVD, numpy only). The SVD's right
+   singular vectors project TF-IDF vectors onto --dims latent dimensions.
+2. Encodes every question, spills the vectors per site to a work directory
+   and builds one IVF index per site with spherical k-means.
+
+The index is built next to --out and swapped in once complete. Search
+workers keep using the files they mapped until they are restarted.
+"""
+
+from argparse import ArgumentParser
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import sys
+import time
+
+import numpy as np
+
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+from records import blacklist_message
+from vectors import (
+    csr_dot,
+    hash_terms,
+    normalize,
+    tfidf_rows,
+    write_model,
+    write_site_index,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+
+def read_questions(files):
+    """
+    Yield (site, id, title, text) of the questions in NDJSON files.
+    """
+    for path in files:
+        with open(path) as f:
+            for line in f:
+                try:
+                    doc = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.debug(f"Malformed JSON: {line}")
+                    continue
+                if blacklist_message(doc):
+                    continue
+                if "id" not in doc or "site" not in doc:
+                    continue
+                title = doc.get("title") or ""
+                yield doc["site"], doc["id"], title, f"{title} {doc.get('body', '')}"
+
+
+def document_frequencies(files, n_features, sample_size, rng):
+    """
+    Return (document count, df, sampled texts).
+    """
+    df = np.zeros(n_features, dtype=np.int64)
+    sample = []
+    count = 0
+    for _, _, _, text in read_questions(files):
+        columns, _ = hash_terms(text, n_features)
+        df[columns] += 1
+        count += 1
+        # Reservoir sampling keeps a uniform sample of unknown size input.
+        if len(sample) < sample_size:
+            sample.append(text)
+        else:
+            i = rng.randrange(count)
+            if i < sample_size:
+                sample[i] = text
+    return count, df, sample
+
+
+def csr_transpose_dot(indptr, columns, weights, dense, n_features, chunk_rows=4096):
+    """
+    Return A.T @ dense for the CSR matrix A.
+    """
+    out = np.zeros((n_features, dense.shape[1]), dtype=np.float32)
+    for start in range(0, len(indptr) - 1, chunk_rows):
+        end = min(start + chunk_rows, len(indptr) - 1)
+        low, high = indptr[start], indptr[end]
+        rows = np.repeat(np.arange(start, end), np.diff(indptr[start : end + 1]))
+        np.add.at(out, columns[low:high], weights[low:high, None] * dense[rows])
+    return out
+
+
+def fit_projection(texts, idf, dims, power_iterations, seed):
+    """
+    Return the float32[n_features, dims] LSA projection fitted on texts.
+
+    Randomized SVD (Halko et al.): the range of the TF-IDF matrix A is
+    found by multiplying it with a random matrix (plus a few power
+    iterations), then the SVD of the small projected matrix gives the
+    top right singular vectors of A.
+    """
+    n_features = len(idf)
+    indptr, columns, weights = tfidf_rows(texts, idf)
+    rank = min(dims + 10, len(texts))
+    omega = np.random.default_rng(seed).standard_normal((n_features, rank))
+    q, _ = np.linalg.qr(csr_dot(indptr, columns, weights, omega.astype(np.float32)))
+    for _ in range(power_iterations):
+        z, _ = np.linalg.qr(csr_transpose_dot(indptr, columns, weights, q, n_features))
+        q, _ = np.linalg.qr(csr_dot(indptr, columns, weights, z))
+    # B = Q.T A, computed as (A.T Q).T. Right singular vectors of B are the
+    # left singular vectors of B.T.
+    bt = csr_transpose_dot(indptr, columns, weights, q, n_features)
+    u, s, _ = np.linalg.svd(bt, full_matrices=False)
+    logging.info(f"Top singular values: {np.round(s[:5], 2).tolist()}")
+    return u[:, :dims].astype(np.float32)
+
+
+def spill_vectors(files, idf, projection, work_dir, chunk_size):
+    """
+    Encode every question and append it to per-site files in work_dir.
+
+    Returns {site: (path prefix of its files, count)}.
+    """
+    counts = {}
+    outputs = {}
+
+    def flush(chunk):
+        texts = [text for _, _, _, text in chunk]
+        indptr, columns, weights = tfidf_rows(texts, idf)
+        vectors = normalize(csr_dot(indptr, columns, weights, projection))
+        for (site, id, title, _), vector in zip(chunk, vectors):
+            if site not in outputs:
+                prefix = os.path.join(work_dir, str(len(outputs)))
+                outputs[site] = (
+                    open(f"{prefix}.vectors", "wb"),
+                    open(f"{prefix}.ids", "wb"),
+                    open(f"{prefix}.titles", "w"),
+                )
+                counts[site] = 0
+            vector_file, id_file, title_file = outputs[site]
+            vector_file.write(vector.astype(np.float32).tobytes())
+            id_file.write(np.int64(id).tobytes())
+            print(json.dumps(title), file=title_file)
+            counts[site] += 1
+
+    chunk = []
+    for question in read_questions(files):
+        chunk.append(question)
+        if len(chunk) == chunk_size:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+    for site_files in outputs.values():
+        for f in site_files:
+            f.close()
+    return {
+        site: (os.path.join(work_dir, str(i)), counts[site])
+        for i, site in enumerate(outputs)
+    }
+
+
+def spherical_kmeans(vectors, lists, iterations, sample_size, rng):
+    """
+    Return (centroids, assignment) of unit length vectors.
+
+    Centroids are fitted on a sample, then every vector is assigned to
+    its closest centroid (highest dot product).
+    """
+    n = len(vectors)
+    sample = vectors[np.sort(rng.choice(n, min(n, sample_size), replace=False))]
+    centroids = sample[rng.choice(len(sample), lists, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        empty = np.bincount(assignment, minlength=lists) == 0
+        # Restart empty lists from random sample vectors.
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize(sums)
+
+    assignment = np.empty(n, dtype=np.int64)
+    for start in range(0, n, 65536):
+        chunk = np.asarray(vectors[start : start + 65536])
+        assignment[start : start + 65536] = np.argmax(chunk @ centroids.T, axis=1)
+    return centroids, assignment
+
+
+def main():
+    parser = ArgumentParser("Build per-site vector indexes of questions.")
+    parser.add_argument("files", help="NDJSON files with questions.", nargs="+")
+    parser.add_argument("--out", help="Index directory.", required=True)
+    parser.add_argument("--dims", help="Vector dimensions.", default=128, type=int)
+    parser.add_argument(
+        "--n-features",
+        help="Hashed TF-IDF features. The projection takes n_features * dims "
+        "* 4 bytes on every search host.",
+        default=2 ** 16,
+        type=int,
+    )
+    parser.add_argument(
+        "--svd-sample",
+        help="Questions sampled to fit the SVD.",
+        default=100_000,
+        type=int,
+    )
+    parser.add_argument(
+        "--power-iterations",
+        help="Randomized SVD power iterations.",
+        default=2,
+        type=int,
+    )
+    parser.add_argument(
+        "--lists",
+        help="IVF lists per site. Defaults to sqrt(questions of the site).",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--kmeans-iterations",
+        help="Spherical k-means iterations.",
+        default=10,
+        type=int,
+    )
+    parser.add_argument(
+        "--kmeans-sample",
+        help="Questions per site sampled to fit the centroids.",
+        default=100_000,
+        type=int,
+    )
+    parser.add_argument(
+        "--chunk-size", help="Questions encoded per batch.", default=10_000, type=int
+    )
+    parser.add_argument("--seed", help="Random seed.", default=0, type=int)
+    args = parser.parse_args()
+
+    start = time.time()
+    rng = random.Random(args.seed)
+    count, df, sample = document_frequencies(
+        args.files, args.n_features, args.svd_sample, rng
+    )
+    if not count:
+        raise SystemExit("No questions with an id and a site in the input files.")
+    logging.info(f"Counted terms of {count} questions.")
+    idf = (np.log((1 + count) / (1 + df)) + 1).astype(np.float32)
+    projection = fit_projection(
+        sample, idf, args.dims, args.power_iterations, args.seed
+    )
+    logging.info(f"Fitted the projection on {len(sample)} questions.")
+
+    tmp = f"{args.out}.tmp-{os.getpid()}"
+    work_dir = os.path.join(tmp, "work")
+    os.makedirs(work_dir)
+    try:
+        spilled = spill_vectors(args.files, idf, projection, work_dir, args.chunk_size)
+        write_model(tmp, idf, projection, spilled)
+        np_rng = np.random.default_rng(args.seed)
+        for site, (prefix, n) in spilled.items():
+            vectors = np.memmap(
+                f"{prefix}.vectors",
+                dtype=np.float32,
+                mode="r",
+                shape=(n, projection.shape[1]),
+            )
+            ids = np.fromfile(f"{prefix}.ids", dtype=np.int64)
+            with open(f"{prefix}.titles") as f:
+                titles = [json.loads(line) for line in f]
+            lists = min(args.lists or max(1, int(math.sqrt(n))), n)
+            centroids, assignment = spherical_kmeans(
+                vectors, lists, args.kmeans_iterations, args.kmeans_sample, np_rng
+            )
+            write_site_index(tmp, site, vectors, ids, titles, centroids, assignment)
+            del vectors
+            logging.info(f"Indexed {n} questions of {site} in {lists} lists.")
+        shutil.rmtree(work_dir)
+
+        # Swap the new index in. Files mapped by running workers stay valid.
+        old = f"{args.out}.old-{os.getpid()}"
+        if os.path.exists(args.out):
+            os.rename(args.out, old)
+        os.rename(tmp, args.out)
+        shutil.rmtree(old, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    elapsed = time.time() - start
+    logging.info(f"Built vector index of {count} questions in {elapsed:.1f} s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+"""
+Load question metadata into postgres with COPY, without Spark.
+
+Reads stackexchange NDJSON dumps (plain or zstd compressed) from local
+disk. Plain files are split into byte ranges that worker processes parse
+in parallel, each streaming its question and user rows into the staging
+tables of loads.py with COPY ... FROM STDIN (binary or CSV). The staged
+rows are then merged into questions and users exactly like
+etl-to-postgres.py --incremental does, so both paths produce the same
+tables and share the record of loaded files.
+
+Secondary indexes of questions and users are dropped before the merge and
+rebuilt once it is done (--keep-indexes to skip). Primary keys stay, the
+upserts need them.
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime
+import json
+import io
+import logging
+from multiprocessing import Pool
+import os
+import time
+
+from loads import STAGED_QUESTIONS, STAGED_USERS, merge, new_files, prepare
+from pg_copy import (
+    connect,
+    QUESTION_COLUMNS,
+    QUESTION_TYPES,
+    USER_COLUMNS,
+    USER_TYPES,
+    add_user,
+    copy_rows,
+    question_row,
+    user_rows,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+
+def open_text(path):
+    if path.endswith(".zst"):
+        # Optional dependency, only needed for compressed dumps.
+        import zstandard
+
+        raw = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+        return io.TextIOWrapper(raw, encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def read_range(path, start, end):
+    """
+    Yield the lines of path starting in the byte range [start, end).
+
+    end is None for the whole (possibly compressed) file.
+    """
+    if end is None:
+        with open_text(path) as f:
+            yield from f
+        return
+    with open(path, "rb") as f:
+        if start:
+            # Skip to the first line starting at or after start, the line
+            # cut by start belongs to the previous range.
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line
+
+
+def parse_rows(lines, users):
+    """
+    Yield question rows of lines and keep the max reputation per user.
+
+    Returns the newest creation date (epoch seconds) seen, like the
+    columns selected by etl-to-postgres.py.
+    """
+    newest = None
+    for line in lines:
+        try:
+            doc = json.loads(line)
+        except json.JSONDecodeError:
+            logging.debug(f"Malformed JSON: {line}")
+            continue
+        if doc.get("type") != "question":
+            continue
+        row = question_row(doc)
+        created = row[1]
+        if created is not None and (newest is None or created > newest):
+            newest = created
+        yield row
+        add_user(users, doc)
+    return newest
+
+
+def load_range(task):
+    """
+    Worker: COPY the rows of one byte range into the staging tables.
+
+    Returns (path, questions, users, newest creation date).
+    """
+    path, start, end, args = task
+    users = {}
+    newest = None
+
+    def rows():
+        nonlocal newest
+        newest = yield from parse_rows(read_range(path, start, end), users)
+
+    conn = connect(args)
+    try:
+        with conn, conn.cursor() as cursor:
+            questions = copy_rows(
+                cursor,
+                STAGED_QUESTIONS,
+                QUESTION_COLUMNS,
+                QUESTION_TYPES,
+                rows(),
+                args.format,
+            )
+            copy_rows(
+                cursor,
+                STAGED_USERS,
+                USER_COLUMNS,
+                USER_TYPES,
+                user_rows(users),
+                args.format,
+            )
+    finally:
+        conn.close()
+    return path, questions, len(users), newest
+
+
+def split(files, range_size):
+    """
+    Return (path, start, end) byte ranges of files.
+
+    Compressed files cannot be split and form a single range (end None).
+    """
+    ranges = []
+    for path, size, _ in files:
+        if path.endswith(".zst"):
+            ranges.append((path, 0, None))
+            continue
+        for start in range(0, max(size, 1), range_size):
+            ranges.append((path, start, min(start + range_size, size)))
+    return ranges
+
+
+def drop_secondary_indexes(conn, tables):
+    """
+    Drop the indexes of tables that do not back a constraint.
+
+    Returns their definitions, to rebuild them.
+    """
+    with conn, conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT i.indexname, i.indexdef FROM pg_indexes i "
+            "WHERE i.tablename = ANY(%s) AND i.schemaname = current_schema() "
+            "AND NOT EXISTS (SELECT 1 FROM pg_constraint c "
+            "WHERE c.conname = i.indexname)",
+            (list(tables),),
+        )
+        indexes = cursor.fetchall()
+        for name, definition in indexes:
+            logging.info(f"Dropping {name}, rebuilt with: {definition}")
+            cursor.execute(f'DROP INDEX "{name}"')
+    return [definition for _, definition in indexes]
+
+
+def rebuild_indexes(conn, definitions):
+    with conn, conn.cursor() as cursor:
+        for definition in definitions:
+            cursor.execute(definition)
+
+
+def main():
+    parser = ArgumentParser("COPY question metadata from NDJSON dumps to postgres.")
+    parser.add_argument("files", help="NDJSON (or .zst) files.", nargs="+")
+    parser.add_argument(
+        "--postgres-url", help="PostgreSQL Endpoint", default=os.getenv("POSTGRES_URL")
+    )
+    parser.add_argument("--postgres-db", help="PostgreSQL database", default="postgres")
+    parser.add_argument(
+        "--format", help="COPY format.", default="binary", choices=["binary", "csv"]
+    )
+    parser.add_argument(
+        "--workers", help="Parallel COPY processes.", default=os.cpu_count(), type=int
+    )
+    parser.add_argument(
+        "--range-size",
+        help="Bytes of a plain file parsed per task.",
+        default=256 << 20,
+        type=int,
+    )
+    parser.add_argument(
+        "--keep-indexes",
+        help="Do not drop and rebuild secondary indexes around the merge.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--force",
+        help="Load files even if they were loaded before.",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    files = []
+    for path in args.files:
+        stat = os.stat(path)
+        modified = datetime.utcfromtimestamp(stat.st_mtime)
+        files.append((os.path.abspath(path), stat.st_size, modified))
+
+    conn = connect(args)
+    try:
+        prepare(conn)
+        if not args.force:
+            files = new_files(conn, files)
+        if not files:
+            logging.info("All files were loaded before.")
+            return
+
+        start = time.time()
+        ranges = split(files, args.range_size)
+        tasks = [(path, begin, end, args) for path, begin, end in ranges]
+        newest = {}
+        questions = 0
+        with Pool(min(args.workers, len(tasks))) as pool:
+            for path, q, _, created in pool.imap_unordered(load_range, tasks):
+                questions += q
+                if created is not None:
+                    newest[path] = max(created, newest.get(path, created))
+        copied = time.time() - start
+        logging.info(
+            f"Staged {questions} questions from {len(ranges)} ranges in "
+            f"{copied:.1f} s ({questions / max(copied, 1e-9):,.0f} rows/s)."
+        )
+
+        definitions = []
+        if not args.keep_indexes:
+            definitions = drop_secondary_indexes(conn, ["questions", "users"])
+        watermarks = {
+            path: datetime.utcfromtimestamp(created) for path, created in newest.items()
+        }
+        try:
+            merged, users = merge(
+                conn, [(*file, watermarks.get(file[0])) for file in files]
+            )
+        finally:
+            rebuild_indexes(conn, definitions)
+        elapsed = time.time() - start
+        logging.info(
+            f"Loaded {merged} questions and {users} users in {elapsed:.1f} s "
+            f"({questions / max(elapsed, 1e-9):,.0f} rows/s end to end, "
+            f"merge and indexes {elapsed - copied:.1f} s)."
+        )
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Reading the stackexchange dumps into Spark.
+
+The raw records carry close to a hundred keys. Reading them with an explicit
+schema of the columns the batch jobs use skips Spark's schema inference (a
+full extra pass over the JSON) and keeps the other keys out of memory.
+
+Jobs can also read the Parquet staging layer written by stage-to-parquet.py
+(--input-format parquet): questions and answers in separate tables,
+partitioned by site and creation month, so jobs only read the columns they
+select and, with --sites and --months, only the matching partitions.
+
+    <root>/questions/site=<site>/month=<yyyy-MM>/part-*.parquet
+    <root>/answers/site=<site>/month=<yyyy-MM>/part-*.parquet
+"""
+
+from datetime import datetime
+import os
+
+from pyspark.sql.functions import col, date_format, from_unixtime
+from pyspark.sql.types import (
+    ArrayType,
+    BooleanType,
+    LongType,
+    StringType,
+    StructField,
+    StructType,
+)
+
+OWNER_SCHEMA = StructType(
+    [StructField("user_id", LongType()), StructField("reputation", LongType())]
+)
+
+QUESTION_SCHEMA = StructType(
+    [
+        StructField("type", StringType()),
+        StructField("site", StringType()),
+        StructField("id", LongType()),
+        StructField("title", StringType()),
+        StructField("body", StringType()),
+        StructField("tags", ArrayType(StringType())),
+        StructField("creation_date", LongType()),
+        StructField("score", LongType()),
+        StructField("answer_count", LongType()),
+        StructField("link", StringType()),
+        StructField("owner", OWNER_SCHEMA),
+    ]
+)
+
+
+ANSWER_SCHEMA = StructType(
+    [
+        StructField("type", StringType()),
+        StructField("site", StringType()),
+        StructField("answer_id", LongType()),
+        StructField("question_id", LongType()),
+        StructField("body", StringType()),
+        StructField("creation_date", LongType()),
+        StructField("score", LongType()),
+        StructField("is_accepted", BooleanType()),
+        StructField("owner", OWNER_SCHEMA),
+    ]
+)
+
+# Every column of both, to read the raw records once and split them.
+RECORD_SCHEMA = StructType(
+    QUESTION_SCHEMA.fields
+    + [
+        field
+        for field in ANSWER_SCHEMA.fields
+        if field.name not in QUESTION_SCHEMA.names
+    ]
+)
+
+INPUT_FORMATS = ["json", "parquet"]
+# Tables of the staging layer.
+QUESTIONS = "questions"
+ANSWERS = "answers"
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--input-format",
+        help="json reads NDJSON dumps, parquet the staging layer of "
+        "stage-to-parquet.py (file is then its root directory).",
+        default="json",
+        choices=INPUT_FORMATS,
+    )
+    parser.add_argument(
+        "--sites", help="Comma separated sites to read. Defaults to all."
+    )
+    parser.add_argument(
+        "--months",
+        help="Creation months to read, yyyy-MM or yyyy-MM:yyyy-MM (inclusive). "
+        "Defaults to all.",
+    )
+
+
+def month(df):
+    """
+    Return the yyyy-MM creation month column of df.
+    """
+    if "month" in df.columns:
+        # Partition column of the staging layer.
+        return col("month")
+    return date_format(from_unixtime(df["creation_date"]), "yyyy-MM")
+
+
+def restrict(df, args):
+    """
+    Filter df to the sites and months of args.
+
+    On the staging layer these are partition columns and Spark skips the
+    other partitions instead of reading them.
+    """
+    if args is None:
+        return df
+    if args.sites:
+        df = df.filter(col("site").isin(args.sites.split(",")))
+    if args.months:
+        first, _, last = args.months.partition(":")
+        df = df.filter(month(df).between(first, last or first))
+    return df
+
+
+def read_table(sqlContext, path, table, schema, type, args, root=None):
+    """
+    Return the records of one type at path.
+
+    path is a hadoop glob or a list of files. On the staging layer it is the
+    root directory, or a list of files of table below root (their partition
+    columns are kept).
+    """
+    if args is not None and args.input_format == "parquet":
+        # Keep months (yyyy-MM) strings, Spark would guess at their type.
+        sqlContext.setConf(
+            "spark.sql.sources.partitionColumnTypeInference.enabled", "false"
+        )
+        if isinstance(path, list):
+            reader = sqlContext.read.option("basePath", os.path.join(root, table))
+            return restrict(reader.parquet(*path), args)
+        return restrict(sqlContext.read.parquet(os.path.join(path, table)), args)
+    df = sqlContext.read.json(path, schema=schema)
+    return restrict(df.filter(df.type == type), args)
+
+
+def read_questions(sqlContext, path, args=None, root=None):
+    """
+    Return the questions of the NDJSON files (or staging layer) at path.
+
+    args carries the options of add_arguments, None reads every question of
+    NDJSON files.
+    """
+    return read_table(
+        sqlContext, path, QUESTIONS, QUESTION_SCHEMA, "question", args, root
+    )
+
+
+def read_answers(sqlContext, path, args=None, root=None):
+    """
+    Return the answers of the NDJSON files (or staging layer) at path.
+    """
+    return read_table(sqlContext, path, ANSWERS, ANSWER_SCHEMA, "answer", args, root)
+
+
+def staged_files(root, table=QUESTIONS, sites=None):
+    """
+    Return the hadoop glob of the parquet files of a staging layer table.
+
+    sites is a comma separated list, None for all of them.
+    """
+    site = f"site={{{sites}}}" if sites else "site=*"
+    return os.path.join(root, table, site, "month=*", "*.parquet")
+
+
+def list_files(spark, pattern):
+    """
+    Return (path, size, modified) of the files matching a hadoop glob.
+    """
+    jvm = spark.sparkContext._jvm
+    path = jvm.org.apache.hadoop.fs.Path(pattern)
+    fs = path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+    return [
+        (
+            status.getPath().toString(),
+            status.getLen(),
+            datetime.utcfromtimestamp(status.getModificationTime() / 1000),
+        )
+        for status in fs.globStatus(path) or []
+        if status.isFile()
+    ]
@@ -0,0 +1,292 @@
+"""
+Writing questions from Spark to Elasticsearch.
+
+Shared by etl-to-es.py and etl-all.py. add_arguments registers the options
+of the ES sink on a parser, write indexes a data frame of questions (as
+read by dumps.py) according to them.
+"""
+
+from datetime import datetime, timezone
+from itertools import chain
+import json
+import logging
+import math
+import os
+import re
+
+from pyspark.sql.functions import col, concat_ws, create_map, lit, when
+
+STACK_OVERFLOW_SCHEMA = "stackoverflow-schema.json"
+ES_INDEX = "so-questions"
+ROUTING_INDEX = "so-routing"
+
+
+index_mapping_types = ["default", "custom", "site"]
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--mapping", help="Path to mapping.json.", default=STACK_OVERFLOW_SCHEMA
+    )
+    parser.add_argument(
+        "--index-type",
+        help="Type of index.",
+        default="default",
+        choices=index_mapping_types,
+    )
+    parser.add_argument(
+        "--default-index",
+        help="If index type is default, then the name of the default index.",
+        default=ES_INDEX,
+    )
+    parser.add_argument("--custom-index", nargs=2)
+    parser.add_argument(
+        "--group-docs",
+        help="If index type is site, sites with fewer questions share indexes "
+        "of up to this many questions.",
+        default=1_000_000,
+        type=int,
+    )
+    parser.add_argument(
+        "--docs-per-shard",
+        help="If index type is site, questions per primary shard.",
+        default=5_000_000,
+        type=int,
+    )
+    parser.add_argument(
+        "--max-shards", help="Max primary shards per index.", default=30, type=int
+    )
+    parser.add_argument(
+        "--replicas", help="Replicas of site indexes.", default=1, type=int
+    )
+    parser.add_argument(
+        "--routing-index",
+        help="If index type is site, the index saving the routing table "
+        "(search-es.py --routing-index).",
+        default=ROUTING_INDEX,
+    )
+    parser.add_argument(
+        "--routing-file",
+        help="Also save the routing table to this JSON file.",
+        default=None,
+    )
+    parser.add_argument(
+        "--es-partitions",
+        help="Spark partitions (concurrent bulk writers) indexing into ES. "
+        "Defaults to the partitions of the input.",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--es-batch-entries",
+        help="Documents per bulk request of each writer.",
+        default=1000,
+        type=int,
+    )
+    parser.add_argument(
+        "--es-batch-bytes",
+        help="Max size of a bulk request of each writer.",
+        default="1mb",
+    )
+
+
+def read_mappings(path):
+    with open(path) as f:
+        return json.loads(f.read())["mappings"]
+
+
+def columns(args):
+    """
+    Columns of the questions indexed in ES (the properties of the mapping).
+    """
+    return list(read_mappings(args.mapping)["properties"])
+
+
+def plan_indexes(site_counts, group_docs, docs_per_shard, max_shards):
+    """
+    Assign sites to indexes and size the indexes.
+
+    Sites with at least group_docs questions get an index of their own.
+    Smaller sites are packed, largest first into the emptiest group, into
+    ceil(their questions / group_docs) shared indexes of similar size.
+    Every index gets one primary shard per docs_per_shard questions.
+
+    Returns {index suffix: {"sites": [site], "docs": n, "shards": n}}.
+    """
+    plan = {}
+    small = []
+    for site, docs in sorted(site_counts.items(), key=lambda item: -item[1]):
+        if docs >= group_docs:
+            plan[index_name(site)] = {"sites": [site], "docs": docs}
+        else:
+            small.append((site, docs))
+
+    total_small = sum(docs for _, docs in small)
+    groups = [
+        {"sites": [], "docs": 0} for _ in range(math.ceil(total_small / group_docs))
+    ]
+    for site, docs in small:
+        group = min(groups, key=lambda group: group["docs"])
+        group["sites"].append(site)
+        group["docs"] += docs
+    for i, group in enumerate(groups):
+        plan[f"group-{i}"] = group
+
+    for entry in plan.values():
+        entry["shards"] = min(
+            max_shards, max(1, math.ceil(entry["docs"] / docs_per_shard))
+        )
+    return plan
+
+
+def index_name(site):
+    """
+    ES index names are lower case and cannot contain most punctuation.
+    """
+    return re.sub(r"[^a-z0-9._-]", "-", site.lower())
+
+
+def create_site_indexes(es, prefix, plan, mappings, replicas):
+    """
+    Create the indexes of plan, named <prefix>-<suffix>-<timestamp>.
+
+    Returns {site: index}.
+    """
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+    site_index = {}
+    for suffix, entry in plan.items():
+        index = f"{prefix}-{suffix}-{stamp}"
+        settings = {
+            "number_of_shards": entry["shards"],
+            "number_of_replicas": replicas,
+            # Bulk loads go faster without refreshes, enabled when done.
+            "refresh_interval": "-1",
+        }
+        es.indices.create(
+            index=index, body={"settings": settings, "mappings": mappings}
+        )
+        entry["index"] = index
+        for site in entry["sites"]:
+            site_index[site] = index
+        logging.info(
+            f"Created {index} with {entry['shards']} shards for {entry['docs']} "
+            f"questions of {len(entry['sites'])} sites."
+        )
+    return site_index
+
+
+def publish_routing(es, prefix, plan, routing_index, routing_file):
+    """
+    Point a per-site alias at the new indexes and save the routing table.
+
+    Each site is searched through <prefix>-site-<site>. Aliases of sites
+    sharing an index filter on the site, so even a search without the
+    site filter only sees its site. All aliases move in one request, then
+    the indexes of the previous run are deleted.
+
+    Only the indexes listed in the previous routing table of prefix are
+    deleted: other deployments may use indexes starting with <prefix>-.
+    """
+    previous = es.get(index=routing_index, id=prefix, ignore=404)
+    old = set(previous.get("_source", {}).get("indexes", {}))
+    new = {entry["index"] for entry in plan.values()}
+    actions = []
+    routes = {}
+    for entry in plan.values():
+        es.indices.put_settings(
+            index=entry["index"], body={"index": {"refresh_interval": "1s"}}
+        )
+        for site in entry["sites"]:
+            alias = f"{prefix}-site-{index_name(site)}"
+            add = {"index": entry["index"], "alias": alias}
+            if len(entry["sites"]) > 1:
+                add["filter"] = {"term": {"site": site}}
+            actions.append({"add": add})
+            routes[site] = alias
+    old -= new
+    if old:
+        # Indexes deleted by hand since would fail the whole request.
+        existing = es.indices.get(index=",".join(old), ignore_unavailable=True)
+        for index in existing:
+            actions.append({"remove_index": {"index": index}})
+    es.indices.update_aliases(body={"actions": actions})
+
+    table = {
+        "sites": routes,
+        "indexes": {
+            entry["index"]: {key: entry[key] for key in ["sites", "docs", "shards"]}
+            for entry in plan.values()
+        },
+        "created": datetime.now(timezone.utc).isoformat(),
+    }
+    # Search workers read the table saved under the prefix (their --index).
+    es.index(index=routing_index, id=prefix, body=table)
+    if routing_file:
+        with open(routing_file, "w") as f:
+            json.dump(table, f, indent=2)
+    logging.info(f"Routed {len(routes)} sites to {len(new)} indexes.")
+
+
+def write(df, args):
+    """
+    Index the questions of df into ES.
+    """
+    mappings = read_mappings(args.mapping)
+    # Raw file contains close to a hundred columns (or keys). We
+    # only select a handful of them (columns saved in args.mapping)
+    # and index them in elastic search.
+    df = df.select(*mappings["properties"])
+    # Question ids are only unique within a site. A stable document id lets
+    # update-es-signals.py update the ranking fields of indexed questions.
+    df = df.withColumn("doc_id", concat_ws("-", col("site"), col("id")))
+    if args.es_partitions:
+        df = df.repartition(args.es_partitions)
+
+    write_mode = "overwrite"
+    if args.index_type == "default":
+        index = args.default_index
+    elif args.index_type == "site":
+        from elasticsearch import Elasticsearch
+
+        es = Elasticsearch(os.getenv("ES_URL"))
+        site_counts = dict(df.groupBy("site").count().collect())
+        plan = plan_indexes(
+            site_counts, args.group_docs, args.docs_per_shard, args.max_shards
+        )
+        site_index = create_site_indexes(
+            es, args.default_index, plan, mappings, args.replicas
+        )
+        routes = create_map(*chain(*((lit(s), lit(i)) for s, i in site_index.items())))
+        df = df.withColumn("index", routes[col("site")])
+        index = "{index}"
+        # The indexes are new (and created with their shard counts).
+        write_mode = "append"
+    else:
+        index_a, index_b = args.custom_index
+        df = df.withColumn(
+            "index", when(col("site") == "stackoverflow", index_a).otherwise(index_b)
+        )
+        index = "{index}"  # use the index column in dataframe as the index.
+
+    df.write.format("org.elasticsearch.spark.sql").option(
+        "es.nodes", os.getenv("ES_URL")
+    ).option("es.port", 443).option("es.resource", index).option(
+        "es.nodes.wan.only", True
+    ).option(
+        "es.mapping.id", "doc_id"
+    ).option(
+        "es.batch.size.entries", args.es_batch_entries
+    ).option(
+        "es.batch.size.bytes", args.es_batch_bytes
+    ).option(
+        # The index and doc_id columns only address the document.
+        "es.mapping.exclude",
+        "index,doc_id",
+    ).mode(
+        write_mode
+    ).save()
+
+    if args.index_type == "site":
+        publish_routing(
+            es, args.default_index, plan, args.routing_index, args.routing_file
+        )
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+ETL the questions of the stackexchange dumps into ES and postgres at once.
+
+Running etl-to-es.py and etl-to-postgres.py scans the dumps once per job.
+This job reads them once (with the explicit schema of dumps.py), keeps the
+questions in Spark's cache and writes them to both sinks from there. Each
+sink has its own parallelism and batch size options. Postgres rows go
+through the staging tables and upserts of loads.py, so the job can be
+re-run.
+"""
+
+from argparse import ArgumentParser
+import logging
+import os
+import time
+
+import findspark
+
+from pyspark import StorageLevel
+from pyspark.sql import SparkSession, SQLContext
+
+import dumps
+import es_sink
+import pg_sink
+from dumps import read_questions
+
+logging.basicConfig(level=logging.WARNING)
+
+# Columns used by the postgres sink, next to those of the ES mapping.
+PG_COLUMNS = ["id", "creation_date", "score", "owner", "site", "answer_count", "link"]
+
+
+def main():
+    parser = ArgumentParser(
+        "ETL stack overflow questions to elastic search and postgres."
+    )
+    parser.add_argument("file", help="Regex corresponding to files in s3.")
+    parser.add_argument("--s3-url", help="S3 URL prefix.", default=os.getenv("S3_URL"))
+    parser.add_argument(
+        "--sinks", help="Comma separated sinks to write to.", default="es,postgres"
+    )
+    parser.add_argument(
+        "--storage-level",
+        help="Spark storage level of the cached questions.",
+        default="MEMORY_AND_DISK",
+        choices=["MEMORY_ONLY", "MEMORY_AND_DISK", "DISK_ONLY"],
+    )
+    dumps.add_arguments(parser)
+    es_sink.add_arguments(parser)
+    pg_sink.add_arguments(parser)
+    args = parser.parse_args()
+
+    sinks = args.sinks.split(",")
+    if set(sinks) - {"es", "postgres"}:
+        parser.error(f"Unknown sinks in {args.sinks}.")
+
+    findspark.init()
+    spark = SparkSession.builder.appName("etl-all").getOrCreate()
+    spark.sparkContext.setLogLevel("ERROR")
+    sqlContext = SQLContext(sparkContext=spark.sparkContext, sparkSession=spark)
+
+    data_file = os.path.join(args.s3_url, args.file)
+    columns = set(PG_COLUMNS)
+    if "es" in sinks:
+        columns.update(es_sink.columns(args))
+    df = read_questions(sqlContext, data_file, args).select(*sorted(columns))
+    df = df.persist(getattr(StorageLevel, args.storage_level))
+
+    # The only scan of the input, it fills the cache both sinks read from.
+    start = time.time()
+    count = df.count()
+    elapsed = {"read": time.time() - start}
+    logging.warning(f"Read {count} questions in {elapsed['read']:.1f} s.")
+
+    fail_status = None
+    if "es" in sinks:
+        start = time.time()
+        es_sink.write(df, args)
+        elapsed["es"] = time.time() - start
+    if "postgres" in sinks:
+        start = time.time()
+        fail_status = pg_sink.upsert(df, args)
+        elapsed["postgres"] = time.time() - start
+    df.unpersist()
+
+    for sink, seconds in elapsed.items():
+        print(
+            f"{sink:<10} {count:>12} questions {seconds:10.1f} s "
+            f"{count / max(seconds, 1e-9):12,.0f} questions/s"
+        )
+    if fail_status:
+        logging.error("ETL into postgres failed.")
+    return fail_status
+
+
+if __name__ == "__main__":
+    main()
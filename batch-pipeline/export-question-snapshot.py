@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+import logging
+import os
+import sys
+import time
+
+import psycopg2
+
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+from snapshot import write_snapshot
+
+logging.basicConfig(level=logging.INFO)
+
+
+def read_questions(conn, fetch_size):
+    """
+    Stream (site, id, answer_count, score, link) rows sorted by (site, id).
+
+    A named (server side) cursor is used so that the questions table is
+    never loaded into memory all at once.
+    """
+    with conn.cursor(name="question-snapshot") as cursor:
+        cursor.itersize = fetch_size
+        cursor.execute(
+            "SELECT site, id, answer_count, score, link FROM questions "
+            "ORDER BY site, id"
+        )
+        yield from cursor
+
+
+def main():
+    parser = ArgumentParser("Export question metadata from postgres to a snapshot.")
+    parser.add_argument("path", help="Path of the snapshot file to (re)write.")
+    parser.add_argument(
+        "--postgres-url", help="PostgreSQL Endpoint", default=os.getenv("POSTGRES_URL")
+    )
+    parser.add_argument("--postgres-db", help="PostgreSQL database", default="postgres")
+    parser.add_argument(
+        "--fetch-size", help="Rows fetched per round-trip.", default=50_000, type=int
+    )
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        host=args.postgres_url,
+        dbname=args.postgres_db,
+        user=os.getenv("POSTGRES_USER"),
+        password=os.getenv("POSTGRES_PWD"),
+    )
+    start = time.time()
+    try:
+        count = write_snapshot(args.path, read_questions(conn, args.fetch_size))
+    finally:
+        conn.close()
+
+    # Curators started with --snapshot pick up the new file on their own.
+    elapsed = time.time() - start
+    logging.info(f"Exported {count} questions to {args.path} in {elapsed:.1f} s.")
+
+
+if __name__ == "__main__":
+    main()
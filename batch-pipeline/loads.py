@@ -0,0 +1,200 @@
+"""
+Incremental, idempotent loads of question metadata into postgres.
+
+New rows are first written to unlogged staging tables (no WAL, so they
+fill up as fast as postgres can take rows) and then merged into questions
+and users with INSERT ... ON CONFLICT upserts. The merge and the record of
+the loaded input files commit in one transaction: a failed or interrupted
+run leaves no trace and re-running it, or loading a file twice, leaves the
+tables as a single load would.
+
+etl_loads keeps one row per loaded input file with its size, modification
+time and watermark (the newest question creation date in the file). A file
+whose size or modification time changed is loaded again.
+
+The upserts need a unique constraint on the keys of questions and users.
+prepare creates the tables with their primary keys (as search/tables.py
+declares them) or, for tables written by Spark's mode="append", which
+creates none, removes duplicate rows and adds a unique constraint.
+"""
+
+import logging
+
+STAGED_QUESTIONS = "questions_staging"
+STAGED_USERS = "users_staging"
+
+CREATE_LOADS = """
+CREATE TABLE IF NOT EXISTS etl_loads (
+    path TEXT PRIMARY KEY,
+    size BIGINT NOT NULL,
+    modified TIMESTAMP NOT NULL,
+    watermark TIMESTAMP,
+    loaded_at TIMESTAMP NOT NULL DEFAULT now()
+)
+"""
+
+CREATE_TABLES = """
+CREATE TABLE IF NOT EXISTS questions (
+    id INTEGER,
+    creation_date TIMESTAMP,
+    score INTEGER,
+    user_id INTEGER,
+    site VARCHAR,
+    answer_count INTEGER,
+    link VARCHAR,
+    PRIMARY KEY (site, id)
+);
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER,
+    reputation INTEGER,
+    site VARCHAR,
+    PRIMARY KEY (site, user_id)
+);
+"""
+
+# Table -> (conflict target of its merge, copy kept among duplicates).
+MERGE_KEYS = {
+    "questions": (["site", "id"], "answer_count DESC NULLS LAST"),
+    "users": (["site", "user_id"], "reputation DESC NULLS LAST"),
+}
+
+# Primary key or unique constraint of a table on exactly the given columns.
+FIND_KEY = """
+SELECT 1 FROM pg_constraint c
+WHERE c.conrelid = %s::regclass AND c.contype IN ('p', 'u')
+AND (
+    SELECT array_agg(a.attname::text ORDER BY a.attname) FROM pg_attribute a
+    WHERE a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey)
+) = %s
+"""
+
+# Same columns as questions and users, without their constraints.
+CREATE_STAGING = f"""
+CREATE UNLOGGED TABLE IF NOT EXISTS {STAGED_QUESTIONS} (
+    id INTEGER,
+    creation_date TIMESTAMP,
+    score INTEGER,
+    user_id INTEGER,
+    site VARCHAR,
+    answer_count INTEGER,
+    link VARCHAR
+);
+CREATE UNLOGGED TABLE IF NOT EXISTS {STAGED_USERS} (
+    user_id INTEGER,
+    reputation INTEGER,
+    site VARCHAR
+);
+"""
+
+# A question staged more than once (it is in several dumps) keeps the copy
+# with the most answers, answer counts only grow.
+MERGE_QUESTIONS = f"""
+INSERT INTO questions (site, id, creation_date, score, user_id, answer_count, link)
+SELECT DISTINCT ON (site, id)
+    site, id, creation_date, score, user_id, answer_count, link
+FROM {STAGED_QUESTIONS}
+WHERE site IS NOT NULL AND id IS NOT NULL
+ORDER BY site, id, answer_count DESC NULLS LAST
+ON CONFLICT (site, id) DO UPDATE SET
+    creation_date = EXCLUDED.creation_date,
+    score = EXCLUDED.score,
+    user_id = EXCLUDED.user_id,
+    answer_count = GREATEST(questions.answer_count, EXCLUDED.answer_count),
+    link = EXCLUDED.link
+"""
+
+# Max reputation wins, see etl_into_users_table of etl-to-postgres.py.
+MERGE_USERS = f"""
+INSERT INTO users (site, user_id, reputation)
+SELECT site, user_id, max(reputation)
+FROM {STAGED_USERS}
+WHERE site IS NOT NULL AND user_id IS NOT NULL
+GROUP BY site, user_id
+ON CONFLICT (site, user_id) DO UPDATE SET
+    reputation = GREATEST(users.reputation, EXCLUDED.reputation)
+"""
+
+
+def add_merge_keys(cursor):
+    """
+    Add the unique constraints the merges need to tables lacking them.
+    """
+    for table, (keys, keep) in MERGE_KEYS.items():
+        cursor.execute(FIND_KEY, (table, sorted(keys)))
+        if cursor.fetchone():
+            continue
+        columns = ", ".join(keys)
+        # Rows with NULL keys never conflict, leave them be.
+        not_null = " AND ".join(f"{key} IS NOT NULL" for key in keys)
+        cursor.execute(
+            f"DELETE FROM {table} WHERE ctid IN (SELECT ctid FROM ("
+            f"SELECT ctid, row_number() OVER (PARTITION BY {columns} "
+            f"ORDER BY {keep}) AS n FROM {table} WHERE {not_null}) ranked "
+            "WHERE n > 1)"
+        )
+        logging.warning(
+            f"Adding a unique constraint on {table} ({columns}), "
+            f"removed {cursor.rowcount} duplicate rows."
+        )
+        cursor.execute(
+            f"ALTER TABLE {table} ADD CONSTRAINT {table}_{'_'.join(keys)}_key "
+            f"UNIQUE ({columns})"
+        )
+
+
+def prepare(conn):
+    """
+    Create the merged, bookkeeping and (empty) staging tables.
+    """
+    with conn, conn.cursor() as cursor:
+        cursor.execute(CREATE_TABLES)
+        add_merge_keys(cursor)
+        cursor.execute(CREATE_LOADS)
+        cursor.execute(CREATE_STAGING)
+        # Left over by a run that failed before merging.
+        cursor.execute(f"TRUNCATE {STAGED_QUESTIONS}, {STAGED_USERS}")
+
+
+def new_files(conn, files):
+    """
+    Return the (path, size, modified) of files that were not loaded yet.
+
+    modified is a datetime (UTC).
+    """
+    with conn, conn.cursor() as cursor:
+        cursor.execute("SELECT path, size, modified FROM etl_loads")
+        loaded = {path: (size, modified) for path, size, modified in cursor}
+    return [
+        (path, size, modified)
+        for path, size, modified in files
+        if loaded.get(path) != (size, modified)
+    ]
+
+
+def merge(conn, files):
+    """
+    Merge the staging tables and record files as loaded, atomically.
+
+    files are (path, size, modified, watermark) tuples.
+
+    Returns (merged questions, merged users).
+    """
+    with conn, conn.cursor() as cursor:
+        # Users first, questions reference them.
+        cursor.execute(MERGE_USERS)
+        users = cursor.rowcount
+        cursor.execute(MERGE_QUESTIONS)
+        questions = cursor.rowcount
+        cursor.executemany(
+            "INSERT INTO etl_loads (path, size, modified, watermark) "
+            "VALUES (%s, %s, %s, %s) "
+            "ON CONFLICT (path) DO UPDATE SET size = EXCLUDED.size, "
+            "modified = EXCLUDED.modified, watermark = EXCLUDED.watermark, "
+            "loaded_at = now()",
+            files,
+        )
+        cursor.execute(f"TRUNCATE {STAGED_QUESTIONS}, {STAGED_USERS}")
+    logging.info(
+        f"Merged {questions} questions and {users} users from {len(files)} files."
+    )
+    return questions, users
@@ -0,0 +1,187 @@
+"""
+COPY of question metadata into the staging tables of loads.py.
+
+Rows are encoded on the fly, in the binary COPY format or as CSV, and fed to
+copy_expert through a file object over the encoded chunks: nothing is
+written to disk and only one chunk is held in memory.
+"""
+
+from datetime import datetime, timezone
+import io
+import os
+import struct
+
+import psycopg2
+
+QUESTION_COLUMNS = [
+    "id",
+    "creation_date",
+    "score",
+    "user_id",
+    "site",
+    "answer_count",
+    "link",
+]
+USER_COLUMNS = ["user_id", "reputation", "site"]
+
+# Binary COPY: signature, flags and header extension length.
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+PGCOPY_TRAILER = struct.pack("!h", -1)
+# Postgres timestamps count microseconds from 2000-01-01.
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc).timestamp()
+
+_NULL = struct.pack("!i", -1)
+_INT = struct.Struct("!ii")
+_TIMESTAMP = struct.Struct("!iq")
+# Column types of the staging tables, in QUESTION_COLUMNS / USER_COLUMNS order.
+QUESTION_TYPES = ["int", "timestamp", "int", "int", "text", "int", "text"]
+USER_TYPES = ["int", "int", "text"]
+
+
+def connect(args):
+    return psycopg2.connect(
+        host=args.postgres_url,
+        dbname=args.postgres_db,
+        user=os.getenv("POSTGRES_USER"),
+        password=os.getenv("POSTGRES_PWD"),
+    )
+
+
+def question_row(doc):
+    """
+    Return the staging row (QUESTION_COLUMNS) of a question record.
+    """
+    owner = doc.get("owner") or {}
+    return (
+        doc.get("id"),
+        doc.get("creation_date"),
+        doc.get("score"),
+        owner.get("user_id"),
+        doc.get("site"),
+        doc.get("answer_count"),
+        doc.get("link"),
+    )
+
+
+def add_user(users, doc):
+    """
+    Keep the max reputation of the owner of doc in users[(site, user_id)].
+    """
+    owner = doc.get("owner") or {}
+    user_id = owner.get("user_id")
+    if user_id is not None:
+        keep_reputation(users, (doc.get("site"), user_id), owner.get("reputation"))
+
+
+def keep_reputation(users, key, reputation):
+    """
+    Set users[key] to reputation unless it holds a larger one.
+    """
+    if key not in users or (
+        reputation is not None and (users[key] is None or reputation > users[key])
+    ):
+        users[key] = reputation
+
+
+def user_rows(users):
+    """
+    Return the staging rows (USER_COLUMNS) of users.
+    """
+    return (
+        (user_id, reputation, site) for (site, user_id), reputation in users.items()
+    )
+
+
+def encode_binary(rows, types):
+    """
+    Yield rows in the binary COPY format.
+    """
+    yield PGCOPY_HEADER
+    count = struct.pack("!h", len(types))
+    for row in rows:
+        fields = [count]
+        for value, type in zip(row, types):
+            if value is None:
+                fields.append(_NULL)
+            elif type == "int":
+                fields.append(_INT.pack(4, value))
+            elif type == "timestamp":
+                micros = int((value - PG_EPOCH) * 1_000_000)
+                fields.append(_TIMESTAMP.pack(8, micros))
+            else:
+                data = str(value).encode("utf-8")
+                fields.append(struct.pack("!i", len(data)) + data)
+        yield b"".join(fields)
+    yield PGCOPY_TRAILER
+
+
+def _csv_field(value, type):
+    if value is None:
+        return ""
+    if type == "timestamp":
+        return datetime.fromtimestamp(value, timezone.utc).isoformat()
+    if type == "int":
+        return str(value)
+    # Always quoted: COPY reads an unquoted empty field as NULL, binary COPY
+    # and Spark keep empty strings.
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def encode_csv(rows, types, rows_per_chunk=1000):
+    """
+    Yield rows as CSV, empty unquoted fields are NULL.
+    """
+    buffer = io.StringIO()
+    for i, row in enumerate(rows, 1):
+        buffer.write(",".join(_csv_field(v, t) for v, t in zip(row, types)) + "\n")
+        if i % rows_per_chunk == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+class ChunkReader:
+    """
+    Read only file object over an iterable of bytes, for copy_expert.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = b""
+
+    def read(self, size=-1):
+        parts = [self.pending]
+        length = len(self.pending)
+        while size < 0 or length < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        data = b"".join(parts)
+        if size < 0:
+            size = len(data)
+        data, self.pending = data[:size], data[size:]
+        return data
+
+
+def copy_rows(cursor, table, columns, types, rows, format):
+    """
+    Stream rows into table with COPY and return the number of rows.
+    """
+    count = 0
+
+    def counted():
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    encode = encode_binary if format == "binary" else encode_csv
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT {format})",
+        ChunkReader(encode(counted(), types)),
+        size=1 << 16,
+    )
+    return count
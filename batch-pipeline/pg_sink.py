@@ -0,0 +1,154 @@
+"""
+Writing question metadata from Spark to postgres.
+
+Shared by etl-to-postgres.py and etl-all.py. add_arguments registers the
+options of the postgres sink on a parser. write appends the questions and
+users of a data frame (as read by dumps.py) to their tables, upsert stages
+them and merges them with the upserts of loads.py.
+"""
+
+import logging
+import os
+
+from py4j.protocol import Py4JJavaError
+from pyspark.sql import functions as func
+
+from loads import STAGED_QUESTIONS, STAGED_USERS, merge, prepare
+from pg_copy import connect
+
+POSTGRES_PREFIX = "jdbc:postgresql://"
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--postgres-url", help="PostgreSQL Endpoint", default=os.getenv("POSTGRES_URL")
+    )
+    parser.add_argument("--postgres-db", help="PostgreSQL database", default="postgres")
+    parser.add_argument(
+        "--pg-partitions",
+        help="Max concurrent JDBC connections writing to postgres. Defaults to "
+        "the partitions of the input.",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--pg-batch-size", help="Rows per JDBC insert batch.", default=1000, type=int
+    )
+
+
+def jdbc_url(args):
+    return POSTGRES_PREFIX + os.path.join(args.postgres_url, args.postgres_db)
+
+
+def jdbc_properties(args):
+    """
+    Credentials and write options passed to DataFrameWriter.jdbc.
+    """
+    properties = {
+        "user": os.getenv("POSTGRES_USER"),
+        "password": os.getenv("POSTGRES_PWD"),
+        "batchsize": str(args.pg_batch_size),
+    }
+    if args.pg_partitions:
+        # Spark coalesces to numPartitions before writing.
+        properties["numPartitions"] = str(args.pg_partitions)
+    return properties
+
+
+def etl_into_questions_table(df, db_url, credentials, table="questions"):
+    """
+    ETL questions metadata into postgresl.
+
+    This function extracts metadata about questions (columns like id,
+    creation_date, score, user_id, site, and answer_count) and loads
+    them to the "questions" table (or the given staging table). It is
+    assumed that the table has already been created.
+    """
+
+    columns = (
+        "id",
+        "creation_date",
+        "score",
+        "owner.user_id",
+        "site",
+        "answer_count",
+        "link",
+    )
+    question_table_df = df.select(*columns)
+    question_table_df = question_table_df.withColumn(
+        "creation_date", df["creation_date"].cast("timestamp")
+    )
+    try:
+        question_table_df.write.jdbc(
+            url=db_url, table=table, mode="append", properties=credentials
+        )
+    except Py4JJavaError:
+        logging.exception("Unable to ETL into questions table.")
+        return 1
+
+
+def etl_into_users_table(df, db_url, credentials, table="users"):
+    """
+    ETL users metadata into postgresql.
+
+    This function extracts metadata about users (like user_id, reputation
+    and site). Null user_ids are excluded and the resulting data frame is
+    transformed to get the latest reputation of the user (based on max
+    reputation) and loaded into "users" table. It is assumed that the table
+    has already been created.
+    """
+
+    columns = ("owner.user_id", "owner.reputation", "site")
+    user_table_df = df.select(*columns)
+    non_null_users = user_table_df.na.drop(subset=["user_id"])
+
+    # user information may be repeated in questions. However, the user
+    # table contains only one entry per user. If user x repeats twice,
+    # we need to find the way to store the latest information about
+    # that user. For this project, we make an assumption that the max
+    # reputation represents the latest information and only store that
+    # reputation in the dataase. In the real world, as reputations change,
+    # the table will be updated directly.
+    latest_user_info = non_null_users.groupby("site", "user_id").agg(
+        func.max("reputation").alias("reputation")
+    )
+
+    try:
+        latest_user_info.write.jdbc(
+            url=db_url, table=table, mode="append", properties=credentials
+        )
+    except Py4JJavaError:
+        logging.exception("Unable to ETL into users table.")
+        return 1
+
+
+def write(df, args):
+    """
+    Append the questions and users of df. Returns 1 on failure.
+    """
+    db_url, properties = jdbc_url(args), jdbc_properties(args)
+    fail_status = etl_into_questions_table(df, db_url, properties)
+    if not fail_status:  # success
+        fail_status = etl_into_users_table(df, db_url, properties)
+    return fail_status
+
+
+def upsert(df, args, files=()):
+    """
+    Stage the questions and users of df and merge them into their tables.
+
+    files, (path, size, modified, watermark) tuples, are recorded as loaded
+    in the same transaction. Returns 1 on failure.
+    """
+    db_url, properties = jdbc_url(args), jdbc_properties(args)
+    conn = connect(args)
+    try:
+        prepare(conn)
+        fail_status = etl_into_questions_table(df, db_url, properties, STAGED_QUESTIONS)
+        if not fail_status:
+            fail_status = etl_into_users_table(df, db_url, properties, STAGED_USERS)
+        if not fail_status:
+            merge(conn, list(files))
+        return fail_status
+    finally:
+        conn.close()
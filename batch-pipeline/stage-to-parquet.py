@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+Convert the stackexchange NDJSON dumps into the Parquet staging layer.
+
+Run once per dump. Questions and answers are written to separate tables,
+compressed and partitioned by site and creation month (see dumps.py for the
+layout). Jobs reading the staging layer (--input-format parquet) then only
+read the columns they use and, with --sites and --months, the partitions
+they need, instead of parsing every JSON record of every site.
+
+Partitions are overwritten one by one: converting a dump again replaces the
+months it covers and leaves the others alone.
+"""
+
+from argparse import ArgumentParser
+import logging
+import os
+import time
+
+import findspark
+
+from pyspark.sql import SparkSession, SQLContext
+
+from dumps import (
+    ANSWER_SCHEMA,
+    ANSWERS,
+    QUESTION_SCHEMA,
+    QUESTIONS,
+    RECORD_SCHEMA,
+    month,
+)
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def write_table(df, schema, path, args):
+    """
+    Write the columns of schema (without type) partitioned by site and month.
+    """
+    columns = [name for name in schema.names if name != "type"]
+    df = df.select(*columns, month(df).alias("month"))
+    # One task per partition, so each writes a few large files.
+    df = df.repartition("site", "month")
+    df.write.partitionBy("site", "month").parquet(
+        path, mode="overwrite", compression=args.compression
+    )
+
+
+def main():
+    parser = ArgumentParser("Convert stackexchange NDJSON dumps to parquet.")
+    parser.add_argument("file", help="Regex corresponding to files in s3.")
+    parser.add_argument("--s3-url", help="S3 URL prefix.", default=os.getenv("S3_URL"))
+    parser.add_argument(
+        "--output",
+        help="Root of the staging layer.",
+        default=os.getenv("STAGING_URL"),
+        required=not os.getenv("STAGING_URL"),
+    )
+    parser.add_argument(
+        "--compression",
+        help="Parquet compression codec.",
+        default="zstd",
+        choices=["snappy", "zstd", "gzip"],
+    )
+    args = parser.parse_args()
+
+    findspark.init()
+    spark = SparkSession.builder.appName("stage-to-parquet").getOrCreate()
+    spark.sparkContext.setLogLevel("ERROR")
+    # Only replace the partitions present in the converted dump.
+    spark.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
+    sqlContext = SQLContext(sparkContext=spark.sparkContext, sparkSession=spark)
+
+    data_file = os.path.join(args.s3_url, args.file)
+    # Parsed once, then split into questions and answers.
+    df = sqlContext.read.json(data_file, schema=RECORD_SCHEMA).cache()
+
+    for table, schema, type in [
+        (QUESTIONS, QUESTION_SCHEMA, "question"),
+        (ANSWERS, ANSWER_SCHEMA, "answer"),
+    ]:
+        start = time.time()
+        write_table(
+            df.filter(df.type == type), schema, os.path.join(args.output, table), args
+        )
+        logging.warning(f"Staged {table} in {time.time() - start:.1f} s.")
+    df.unpersist()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+
+"""
+Stream zstd compressed stackexchange dumps into ES and postgres.
+
+The dumps are read as they are published, from local disk or straight from
+S3, without decompressing them to scratch space first:
+
+    .zst stream -> decompressed blocks of whole lines -> worker processes
+    (json, blacklist_message, ES documents and postgres rows) -> ES bulk
+    sender and postgres COPY, running side by side
+
+Memory stays bounded: at most --max-blocks blocks of --block-size bytes are
+parsed at once and each sink queues at most --queue-size parsed blocks. A
+slow sink holds back the parser instead of filling up memory.
+
+ES documents are addressed by <site>-<id> like etl-to-es.py. Postgres rows
+are COPY'd into the staging tables and merged like copy-to-postgres.py, a
+dump loaded before is skipped (--force to load it again).
+
+The merge, which records the dump as loaded, only runs once the whole dump
+was parsed and every sink succeeded. A dump that failed to read or parse,
+or to index into ES (any document ES rejected, throttled ones included),
+is loaded again by the next run. Documents already indexed into ES are not
+removed, indexing them again is idempotent.
+"""
+
+from abc import ABC, abstractmethod
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+import json
+import logging
+from multiprocessing import Pool
+import os
+from queue import Queue
+import sys
+from threading import BoundedSemaphore, Event, Thread
+import time
+
+from elasticsearch import Elasticsearch, helpers
+
+from loads import STAGED_QUESTIONS, STAGED_USERS, merge, new_files, prepare
+from pg_copy import (
+    QUESTION_COLUMNS,
+    QUESTION_TYPES,
+    USER_COLUMNS,
+    USER_TYPES,
+    add_user,
+    connect,
+    copy_rows,
+    keep_reputation,
+    question_row,
+    user_rows,
+)
+
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+from records import blacklist_message
+
+logging.basicConfig(level=logging.INFO)
+
+STACK_OVERFLOW_SCHEMA = "stackoverflow-schema.json"
+ES_INDEX = "so-questions"
+# The pushshift dumps are compressed with windows of up to 2 GB.
+MAX_WINDOW_SIZE = 1 << 31
+
+# Ends the stream of a sink without loading it, see Sink.batches.
+ABORT = "abort"
+
+# Set in each worker by init_worker.
+_columns = None
+_routes = None
+_index = None
+_sinks = ()
+
+
+def open_source(source):
+    """
+    Return (binary stream, size, modified) of a local path or s3:// URL.
+
+    modified is a datetime (UTC), like the files recorded by loads.py.
+    """
+    if source.startswith("s3://"):
+        # Optional dependency, only needed for dumps read from S3.
+        import boto3
+
+        bucket, _, key = source[len("s3://") :].partition("/")
+        response = boto3.client("s3").get_object(Bucket=bucket, Key=key)
+        stream = response["Body"]
+        size = response["ContentLength"]
+        modified = response["LastModified"].astimezone(timezone.utc)
+        modified = modified.replace(tzinfo=None)
+    else:
+        stat = os.stat(source)
+        stream = open(source, "rb")
+        size = stat.st_size
+        modified = datetime.utcfromtimestamp(stat.st_mtime)
+    if source.endswith(".zst"):
+        # Optional dependency, only needed for compressed dumps.
+        import zstandard
+
+        decompressor = zstandard.ZstdDecompressor(max_window_size=MAX_WINDOW_SIZE)
+        stream = decompressor.stream_reader(stream, closefd=True)
+    return stream, size, modified
+
+
+def read_blocks(stream, block_size):
+    """
+    Yield blocks of about block_size bytes of whole lines of stream.
+    """
+    pending = b""
+    while True:
+        data = stream.read(block_size)
+        if not data:
+            break
+        data = pending + data
+        cut = data.rfind(b"\n") + 1
+        if not cut:
+            # A line longer than a block, keep reading.
+            pending = data
+            continue
+        pending = data[cut:]
+        yield data[:cut]
+    if pending:
+        yield pending
+
+
+def init_worker(columns, routes, index, sinks):
+    global _columns, _routes, _index, _sinks
+    _columns = columns
+    _routes = routes
+    _index = index
+    _sinks = sinks
+
+
+def parse_block(block):
+    """
+    Worker: return (lines, ES documents, question rows, users) of a block.
+    """
+    docs, rows, users = [], [], {}
+    unrouted = set()
+    lines = 0
+    for line in block.splitlines():
+        lines += 1
+        try:
+            msg = json.loads(line)
+        except json.JSONDecodeError:
+            logging.debug(f"Malformed JSON: {line}")
+            continue
+        if not isinstance(msg, dict):
+            logging.debug(f"Not a JSON object: {line}")
+            continue
+        if blacklist_message(msg) or msg.get("id") is None:
+            continue
+        if "es" in _sinks:
+            site = msg.get("site")
+            index = _index if _routes is None else _routes.get(site)
+            if index is None:
+                unrouted.add(site)
+            else:
+                doc = {"_index": index, "_id": f"{site}-{msg['id']}"}
+                doc.update({k: msg.get(k) for k in _columns})
+                docs.append(doc)
+        if "postgres" in _sinks:
+            rows.append(question_row(msg))
+            add_user(users, msg)
+    if unrouted:
+        # --index is only the prefix of the site indexes.
+        logging.warning(
+            f"Skipped ES documents of sites not in the routing table: {unrouted}"
+        )
+    return lines, docs, rows, users
+
+
+class Aborted(Exception):
+    """
+    Raised to a sink whose stream was aborted by a parsing failure.
+    """
+
+
+class Sink(Thread, ABC):
+    """
+    Loads the parsed blocks put on its bounded queue.
+
+    None ends the stream, ABORT ends it after a parsing failure: load gets
+    Aborted from its batches and must not commit anything.
+    """
+
+    def __init__(self, name, queue_size):
+        super().__init__(name=name, daemon=True)
+        self.queue = Queue(queue_size)
+        self.error = None
+        self.aborted = False
+        # Set once None or ABORT was taken from the queue.
+        self.ended = False
+        self.count = 0
+        self.elapsed = 0.0
+
+    def batches(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None or batch is ABORT:
+                self.ended = True
+            if batch is None:
+                return
+            if batch is ABORT:
+                raise Aborted()
+            yield batch
+
+    def run(self):
+        start = time.time()
+        try:
+            self.load(self.batches())
+        except Aborted:
+            logging.warning(f"{self.name} sink aborted.")
+            self.aborted = True
+        except Exception as e:
+            logging.exception(f"{self.name} sink failed.")
+            self.error = e
+            # Keep draining, the parser must not block on a dead sink.
+            try:
+                if not self.ended:
+                    for _ in self.batches():
+                        pass
+            except Aborted:
+                pass
+        self.elapsed = time.time() - start
+
+    @abstractmethod
+    def load(self, batches):
+        """
+        Load the parsed blocks yielded by batches.
+        """
+
+
+class EsSink(Sink):
+    def __init__(self, es, args):
+        super().__init__("es", args.queue_size)
+        self.es = es
+        self.args = args
+        self.failed = 0
+
+    def load(self, batches):
+        actions = (doc for docs in batches for doc in docs)
+        for ok, item in helpers.parallel_bulk(
+            self.es,
+            actions,
+            thread_count=self.args.es_threads,
+            chunk_size=self.args.es_batch_entries,
+            max_chunk_bytes=self.args.es_batch_bytes,
+            queue_size=self.args.es_threads,
+            raise_on_error=False,
+        ):
+            if ok:
+                self.count += 1
+            else:
+                self.failed += 1
+                logging.debug(f"Indexing failed: {item}")
+        if self.failed:
+            # parallel_bulk does not retry rejected (429) documents either,
+            # the dump is loaded again by the next run.
+            raise RuntimeError(f"{self.failed} documents failed to index.")
+
+
+class PgSink(Sink):
+    """
+    COPYs the rows into the staging tables, merge merges them.
+    """
+
+    def __init__(self, file, args):
+        super().__init__("postgres", args.queue_size)
+        self.file = file
+        self.args = args
+        self.watermark = None
+
+    def load(self, batches):
+        users = {}
+        newest = None
+
+        def rows():
+            nonlocal newest
+            for batch_rows, batch_users in batches:
+                for row in batch_rows:
+                    created = row[1]
+                    if created is not None and (newest is None or created > newest):
+                        newest = created
+                    yield row
+                for key, reputation in batch_users.items():
+                    keep_reputation(users, key, reputation)
+
+        conn = connect(self.args)
+        try:
+            # Rolled back if the stream is aborted.
+            with conn, conn.cursor() as cursor:
+                self.count = copy_rows(
+                    cursor,
+                    STAGED_QUESTIONS,
+                    QUESTION_COLUMNS,
+                    QUESTION_TYPES,
+                    rows(),
+                    self.args.format,
+                )
+                copy_rows(
+                    cursor,
+                    STAGED_USERS,
+                    USER_COLUMNS,
+                    USER_TYPES,
+                    user_rows(users),
+                    self.args.format,
+                )
+        finally:
+            conn.close()
+        if newest is not None:
+            self.watermark = datetime.utcfromtimestamp(newest)
+
+    def merge(self):
+        """
+        Merge the staged rows and record the dump as loaded.
+        """
+        conn = connect(self.args)
+        try:
+            merge(conn, [(*self.file, self.watermark)])
+        finally:
+            conn.close()
+
+
+def parse(stream, source, loaders, routes, args):
+    """
+    Parse stream in worker processes and hand the results to loaders.
+
+    Returns (lines, questions).
+    """
+    # Blocks being parsed, released once their results are queued.
+    slots = BoundedSemaphore(args.max_blocks)
+    # Set when the results stop being consumed. The pool's task handler,
+    # reading blocks(), must then return or terminating the pool hangs.
+    stopped = Event()
+
+    def blocks():
+        for block in read_blocks(stream, args.block_size):
+            while not slots.acquire(timeout=1):
+                if stopped.is_set():
+                    return
+            yield block
+
+    columns = []
+    names = [loader.name for loader in loaders]
+    if "es" in names:
+        with open(args.mapping) as f:
+            columns = list(json.load(f)["mappings"]["properties"])
+    start = reported = time.time()
+    lines = questions = 0
+    marker = ABORT
+    with Pool(
+        args.workers,
+        initializer=init_worker,
+        initargs=(columns, routes, args.index, names),
+    ) as pool:
+        # Started after the workers are forked, forking copies the locks
+        # held by running threads.
+        for loader in loaders:
+            loader.start()
+        try:
+            for count, docs, rows, users in pool.imap_unordered(parse_block, blocks()):
+                slots.release()
+                lines += count
+                questions += max(len(docs), len(rows))
+                for loader in loaders:
+                    loader.queue.put(docs if loader.name == "es" else (rows, users))
+                if time.time() - reported >= args.report_interval:
+                    reported = time.time()
+                    logging.info(
+                        f"{source}: {lines} lines, {questions} questions "
+                        f"({questions / (reported - start):,.0f} questions/s)."
+                    )
+            marker = None
+        finally:
+            stopped.set()
+            for loader in loaders:
+                loader.queue.put(marker)
+            for loader in loaders:
+                loader.join()
+    return lines, questions
+
+
+def ingest(source, es, routes, sinks, args):
+    """
+    Stream source into sinks, returns the number of questions parsed.
+    """
+    stream, size, modified = open_source(source)
+    file = (source, size, modified)
+    try:
+        loaders = []
+        if "es" in sinks:
+            loaders.append(EsSink(es, args))
+        if "postgres" in sinks:
+            conn = connect(args)
+            try:
+                prepare(conn)
+                loaded = not args.force and not new_files(conn, [file])
+            finally:
+                conn.close()
+            if loaded:
+                logging.info(f"{source} was loaded into postgres before.")
+            else:
+                loaders.append(PgSink(file, args))
+        if not loaders:
+            return 0
+        start = time.time()
+        lines, questions = parse(stream, source, loaders, routes, args)
+    finally:
+        stream.close()
+    failed = any(loader.error for loader in loaders)
+    for loader in loaders:
+        if isinstance(loader, PgSink):
+            if failed:
+                logging.warning(f"Not merging {source}, a sink failed.")
+            else:
+                loader.merge()
+    elapsed = time.time() - start
+    for loader in loaders:
+        status = "failed" if loader.error else "done"
+        print(
+            f"{source} {loader.name:<10} {loader.count:>12} docs "
+            f"{loader.elapsed:10.1f} s {status}"
+        )
+    print(
+        f"{source} {'total':<10} {questions:>12} docs {elapsed:10.1f} s "
+        f"{questions / max(elapsed, 1e-9):12,.0f} docs/s end to end"
+    )
+    if failed:
+        raise RuntimeError(f"Ingesting {source} failed.")
+    return questions
+
+
+def main():
+    parser = ArgumentParser(
+        "Stream stackexchange dumps into elastic search and postgres."
+    )
+    parser.add_argument(
+        "sources", help="Dumps (.zst or NDJSON), local paths or s3:// URLs.", nargs="+"
+    )
+    parser.add_argument(
+        "--sinks", help="Comma separated sinks to write to.", default="es,postgres"
+    )
+    parser.add_argument(
+        "--workers", help="Parsing processes.", default=os.cpu_count(), type=int
+    )
+    parser.add_argument(
+        "--block-size",
+        help="Decompressed bytes parsed per task.",
+        default=4 << 20,
+        type=int,
+    )
+    parser.add_argument(
+        "--max-blocks",
+        help="Blocks parsed at once. Defaults to twice the workers.",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--queue-size", help="Parsed blocks queued per sink.", default=8, type=int
+    )
+    parser.add_argument(
+        "--report-interval", help="Seconds between progress logs.", default=10, type=int
+    )
+    parser.add_argument(
+        "--mapping", help="Path to mapping.json.", default=STACK_OVERFLOW_SCHEMA
+    )
+    parser.add_argument(
+        "--index", help="ES index (or prefix).", default=os.getenv("ES_INDEX", ES_INDEX)
+    )
+    parser.add_argument(
+        "--routing-index",
+        help="Index holding the site routing table of etl-to-es.py "
+        "--index-type site. Documents go to the alias of their site, those "
+        "of sites not in the table are skipped.",
+        default=os.getenv("ES_ROUTING_INDEX"),
+    )
+    parser.add_argument(
+        "--es-threads", help="Concurrent bulk requests.", default=4, type=int
+    )
+    parser.add_argument(
+        "--es-batch-entries", help="Documents per bulk request.", default=1000, type=int
+    )
+    parser.add_argument(
+        "--es-batch-bytes",
+        help="Max bytes of a bulk request.",
+        default=10 << 20,
+        type=int,
+    )
+    parser.add_argument(
+        "--postgres-url", help="PostgreSQL Endpoint", default=os.getenv("POSTGRES_URL")
+    )
+    parser.add_argument("--postgres-db", help="PostgreSQL database", default="postgres")
+    parser.add_argument(
+        "--format", help="COPY format.", default="binary", choices=["binary", "csv"]
+    )
+    parser.add_argument(
+        "--force",
+        help="Load dumps into postgres even if they were loaded before.",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    sinks = args.sinks.split(",")
+    if set(sinks) - {"es", "postgres"}:
+        parser.error(f"Unknown sinks in {args.sinks}.")
+    args.max_blocks = args.max_blocks or 2 * args.workers
+
+    es = routes = None
+    if "es" in sinks:
+        es = Elasticsearch(os.getenv("ES_URL"))
+        if args.routing_index:
+            table = es.get(index=args.routing_index, id=args.index)["_source"]
+            routes = table["sites"]
+
+    start = time.time()
+    questions = 0
+    for source in args.sources:
+        questions += ingest(source, es, routes, sinks, args)
+    elapsed = time.time() - start
+    logging.info(
+        f"Ingested {questions} questions from {len(args.sources)} dumps in "
+        f"{elapsed:.1f} s ({questions / max(elapsed, 1e-9):,.0f} docs/s)."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+Keep the ranking fields of indexed questions fresh.
+
+search-es.py --rank-in-es ranks with the answer_count of the ES documents,
+so those fields have to follow the site as answers arrive. This script reads
+NDJSON files of new stackexchange records (the API format of the dumps) and
+sends partial updates, without reindexing the question text:
+
+- question records set answer_count, score and link of the question,
+- answer records add one to the answer_count of their question. A record
+  of the question in the same files supersedes its answer records.
+
+Answer ids grow over time within a site, so the answers already counted are
+those up to the highest answer id counted per site, kept in the --state
+file next to (not in) the index. Replaying a file does not count an answer
+twice. The answers of the dump the index was built from are already in
+answer_count: until a site has a state, answers created before --indexed-at
+are skipped.
+
+Documents are addressed by <site>-<id> (see etl-to-es.py). Questions that are
+not indexed yet are skipped, the next ETL run indexes them.
+"""
+
+from argparse import ArgumentParser
+import json
+import logging
+import os
+import time
+
+from elasticsearch import Elasticsearch, helpers
+
+logging.basicConfig(level=logging.INFO)
+
+SIGNALS = ["answer_count", "score", "link"]
+
+ADD_ANSWERS = """
+ctx._source.answer_count = (ctx._source.answer_count == null ? 0 : ctx._source.answer_count) + params.added;
+"""
+
+
+def read_updates(files, counted, indexed_at=None):
+    """
+    Return ({(site, id): signals}, {(site, question id): [answer ids]}).
+
+    The last record of a question wins. Answers up to counted[site] (or
+    created before indexed_at for sites not in counted) are skipped,
+    counted is raised to the highest answer id read.
+
+    Raises ValueError on answers of a site not in counted without indexed_at.
+    """
+    questions, answers = {}, {}
+    last = dict(counted)
+    for path in files:
+        with open(path) as f:
+            for line in f:
+                try:
+                    doc = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.debug(f"Malformed JSON: {line}")
+                    continue
+                type, site = doc.get("type", "").lower(), doc.get("site")
+                if type == "question" and "id" in doc:
+                    signals = {k: doc[k] for k in SIGNALS if doc.get(k) is not None}
+                    if signals:
+                        questions[(site, doc["id"])] = signals
+                elif type == "answer" and "question_id" in doc:
+                    answer_id = doc.get("answer_id", doc.get("id"))
+                    if site is None or answer_id is None:
+                        continue
+                    counted[site] = max(counted.get(site, answer_id), answer_id)
+                    if site in last:
+                        if answer_id <= last[site]:
+                            continue
+                    elif indexed_at is None:
+                        raise ValueError(
+                            f"No state for site {site}, --indexed-at is required."
+                        )
+                    elif doc.get("creation_date", 0) < indexed_at:
+                        continue
+                    key = (site, doc["question_id"])
+                    answers.setdefault(key, []).append(answer_id)
+    return questions, answers
+
+
+def update_actions(questions, answers, index_of):
+    for (site, id), signals in questions.items():
+        yield {
+            "_op_type": "update",
+            "_index": index_of(site),
+            "_id": f"{site}-{id}",
+            "doc": signals,
+            "retry_on_conflict": 3,
+        }
+    for (site, id), answer_ids in answers.items():
+        if (site, id) in questions:
+            # The answer_count of the question record is newer.
+            continue
+        yield {
+            "_op_type": "update",
+            "_index": index_of(site),
+            "_id": f"{site}-{id}",
+            "script": {
+                "source": ADD_ANSWERS,
+                "lang": "painless",
+                "params": {"added": len(answer_ids)},
+            },
+            "retry_on_conflict": 3,
+        }
+
+
+def main():
+    parser = ArgumentParser("Update the ranking fields of indexed questions.")
+    parser.add_argument("files", help="NDJSON files of new records.", nargs="+")
+    parser.add_argument(
+        "--index", help="ES index (or prefix).", default=os.getenv("ES_INDEX")
+    )
+    parser.add_argument(
+        "--routing-index",
+        help="Index holding the site routing table of etl-to-es.py "
+        "--index-type site. Updates go to the alias of each site.",
+        default=os.getenv("ES_ROUTING_INDEX"),
+    )
+    parser.add_argument(
+        "--state",
+        help="JSON file of the highest answer id counted per site.",
+        default=os.getenv("ES_SIGNALS_STATE", "es-signals-state.json"),
+    )
+    parser.add_argument(
+        "--indexed-at",
+        help="Unix time of the dump the index was built from. Answers created "
+        "before it are already counted. Required for sites without a state.",
+        type=int,
+    )
+    parser.add_argument(
+        "--chunk-size", help="Updates per bulk request.", default=1000, type=int
+    )
+    args = parser.parse_args()
+    if not args.index:
+        parser.error("Empty ES index. Update ES_INDEX environment variable.")
+
+    state = {}
+    if os.path.exists(args.state):
+        with open(args.state) as f:
+            state = json.load(f)
+    counted = state.setdefault(args.index, {})
+
+    es = Elasticsearch(os.getenv("ES_URL"))
+    routes = {}
+    if args.routing_index:
+        routes = es.get(index=args.routing_index, id=args.index)["_source"]["sites"]
+
+    def index_of(site):
+        return routes.get(site, args.index)
+
+    start = time.time()
+    try:
+        questions, answers = read_updates(args.files, counted, args.indexed_at)
+    except ValueError as e:
+        parser.error(str(e))
+    counts = {"updated": 0, "noop": 0, "missing": 0, "failed": 0}
+    for ok, item in helpers.streaming_bulk(
+        es,
+        update_actions(questions, answers, index_of),
+        chunk_size=args.chunk_size,
+        raise_on_error=False,
+    ):
+        result = item["update"]
+        if ok:
+            counts["noop" if result.get("result") == "noop" else "updated"] += 1
+        elif result.get("status") == 404:
+            counts["missing"] += 1
+        else:
+            counts["failed"] += 1
+            logging.error(
+                f"Update of {result.get('_id')} failed: {result.get('error')}"
+            )
+
+    tmp = f"{args.state}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, args.state)
+
+    elapsed = time.time() - start
+    logging.info(
+        f"Updated {len(questions)} questions and the answers of {len(answers)} "
+        f"questions in {elapsed:.1f} s: {counts}."
+    )
+
+
+if __name__ == "__main__":
+    main()
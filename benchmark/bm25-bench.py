@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+Latency of the embedded BM25 index (search-es.py --query-type bm25).
+
+Queries are the first --body-length characters of questions sampled from
+an NDJSON dump, as typed by the web clients. The script reports self@k
+(share of queries whose own question is in the top k), latency and the
+number of postings scored per query.
+
+With --es-url the same queries are sent to ES as match queries (built by
+search-es.py). ES latency is split into the time ES spends on the query
+(took) and the rest of the round trip (network hop and serialization),
+which an in-process index does not pay. overlap@k compares the top k of
+both.
+"""
+
+from argparse import ArgumentParser
+import os
+import sys
+import time
+
+import numpy as np
+
+from queries import ROOT, overlap, percentiles, run_es, sample_queries, self_rate
+
+sys.path.append(os.path.join(ROOT, "common"))
+from bm25 import BM25Index
+
+
+def run_bm25(index, queries, k):
+    """
+    Return ([[ids]], latencies, scored postings) of BM25 searches of queries.
+    """
+    results, latencies, scored = [], [], []
+    for site, _, text in queries:
+        began = time.perf_counter()
+        count, hits = index.search(text, site, k)
+        latencies.append(time.perf_counter() - began)
+        scored.append(count)
+        results.append([id for id, _, _ in hits])
+    return results, latencies, scored
+
+
+def main():
+    parser = ArgumentParser("Benchmark the embedded BM25 index against ES.")
+    parser.add_argument("index", help="BM25 index directory.")
+    parser.add_argument("file", help="NDJSON file with questions to query.")
+    parser.add_argument("--queries", help="Queries sampled.", default=1000, type=int)
+    parser.add_argument(
+        "--body-length", help="Characters of the body typed.", default=100, type=int
+    )
+    parser.add_argument("--k", help="Results per query.", default=10, type=int)
+    parser.add_argument(
+        "--es-url", help="ES to compare with.", default=os.getenv("ES_URL")
+    )
+    parser.add_argument("--es-index", help="ES index.", default=os.getenv("ES_INDEX"))
+    parser.add_argument("--field", help="ES field to match.", default="body")
+    parser.add_argument("--seed", help="Random seed.", default=0, type=int)
+    args = parser.parse_args()
+
+    queries = sample_queries(args.file, args.queries, args.body_length, args.seed)
+    if not queries:
+        raise SystemExit("No questions with a body, an id and a site in the file.")
+    index = BM25Index(args.index)
+    # The first search of a site maps its segments, keep it out of the numbers.
+    for site in {site for site, _, _ in queries}:
+        index.search("", site, args.k)
+
+    results, latencies, scored = run_bm25(index, queries, args.k)
+    print(f"{len(queries)} queries, k={args.k}.")
+    print(
+        f"{'bm25':<12} self@k {self_rate(queries, results):6.1%}  "
+        f"{percentiles(latencies)}  "
+        f"{len(queries) / sum(latencies):8.0f} q/s  "
+        f"{np.mean(scored):8.0f} postings scored/query"
+    )
+
+    if args.es_url and args.es_index:
+        es_results, es_latencies, took = run_es(
+            args.es_url, args.es_index, args.field, queries, args.k
+        )
+        hop = np.asarray(es_latencies) - np.asarray(took)
+        print(
+            f"{'es match':<12} self@k {self_rate(queries, es_results):6.1%}  "
+            f"{percentiles(es_latencies)}  "
+            f"{len(queries) / sum(es_latencies):8.0f} q/s"
+        )
+        print(f"{'  es took':<12} {'':13}  {percentiles(took)}")
+        print(f"{'  es hop':<12} {'':13}  {percentiles(hop)}")
+        print(
+            f"overlap@k of bm25 and es match: "
+            f"{overlap(results, es_results, args.k):.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+In-process stand-ins for pulsar, elasticsearch and postgres.
+
+The stages of the pipeline take their pulsar client, ES client and question
+store as arguments, so the benchmark hands them these fakes instead of
+connections to a live cluster:
+
+- FakeClient: queue backed topics shared by all consumers of a topic
+  (like a Shared subscription; Key_Shared routing is not emulated).
+- StubElasticsearch / AsyncStubElasticsearch: answer searches with random
+  hits after a delay drawn from a LatencyModel, which can also inject
+  latency spikes and timeouts.
+- SqliteQuestionStore: the questions table in an in-memory sqlite database.
+"""
+
+import asyncio
+from itertools import count
+import math
+import queue
+import random
+import sqlite3
+from threading import Lock
+import time
+
+from elasticsearch.exceptions import ConnectionTimeout
+from pulsar import Timeout
+from runtime import Stopped
+
+
+class Exhausted(Stopped):
+    """
+    Raised by FakeConsumer.receive once its topic is closed and drained.
+
+    Stages end on it as they do when their runtime is stopped.
+    """
+
+
+class LatencyModel:
+    """
+    Lognormal latency with optional spikes and timeouts.
+    """
+
+    def __init__(
+        self,
+        median_ms,
+        sigma=0.5,
+        spike_prob=0.0,
+        spike_ms=0.0,
+        timeout_prob=0.0,
+        timeout_ms=0.0,
+        seed=None,
+    ):
+        self.median = median_ms / 1000
+        self.sigma = sigma
+        self.spike_prob = spike_prob
+        self.spike = spike_ms / 1000
+        self.timeout_prob = timeout_prob
+        self.timeout = timeout_ms / 1000
+        self._random = random.Random(seed)
+        self._lock = Lock()
+
+    def sample(self):
+        """
+        Return (seconds, timed_out) for one request.
+        """
+        with self._lock:
+            if self._random.random() < self.timeout_prob:
+                return self.timeout, True
+            seconds = 0.0
+            if self.median > 0:
+                seconds = self._random.lognormvariate(math.log(self.median), self.sigma)
+            if self._random.random() < self.spike_prob:
+                seconds += self.spike
+            return seconds, False
+
+
+class FakeTopic:
+    def __init__(self, name):
+        self.name = name
+        self.queue = queue.Queue()
+        self.closed = False
+
+
+class FakeMessage:
+    _ids = count()
+
+    def __init__(self, content, properties=None, partition_key=None):
+        self._content = content
+        self._properties = properties or {}
+        self._partition_key = partition_key
+        self._id = next(self._ids)
+
+    def data(self):
+        return self._content
+
+    def properties(self):
+        return self._properties
+
+    def partition_key(self):
+        return self._partition_key
+
+    def message_id(self):
+        return self._id
+
+
+class FakeConsumer:
+    def __init__(self, topic):
+        self.topic = topic
+
+    def receive(self, timeout_millis=None):
+        deadline = None
+        if timeout_millis is not None:
+            deadline = time.monotonic() + timeout_millis / 1000
+        while True:
+            try:
+                return self.topic.queue.get(timeout=0.05)
+            except queue.Empty:
+                # A receive with a timeout is part of a batch, let the
+                # batch finish before the blocking receive ends the worker.
+                if deadline is not None and (
+                    self.topic.closed or time.monotonic() >= deadline
+                ):
+                    raise Timeout()
+                if self.topic.closed:
+                    raise Exhausted(self.topic.name)
+
+    def acknowledge(self, msg):
+        pass
+
+    def negative_acknowledge(self, msg):
+        self.topic.queue.put(msg)
+
+
+class FakeProducer:
+    def __init__(self, topic):
+        self.topic = topic
+
+    def send(self, content, properties=None, partition_key=None):
+        msg = FakeMessage(content, properties, partition_key)
+        self.topic.queue.put(msg)
+        return msg.message_id()
+
+    def send_async(self, content, callback, properties=None, partition_key=None):
+        msg_id = self.send(content, properties, partition_key)
+        if callback is not None:
+            callback("ok", msg_id)
+
+    def flush(self):
+        pass
+
+
+class FakeClient:
+    def __init__(self):
+        self.topics = {}
+        self._lock = Lock()
+
+    def topic(self, name):
+        with self._lock:
+            if name not in self.topics:
+                self.topics[name] = FakeTopic(name)
+            return self.topics[name]
+
+    def subscribe(self, topic, subscription_name, **kwargs):
+        return FakeConsumer(self.topic(topic))
+
+    def create_producer(self, topic, **kwargs):
+        return FakeProducer(self.topic(topic))
+
+    def close_topic(self, name):
+        self.topic(name).closed = True
+
+    def close(self):
+        pass
+
+
+def _site_of(body):
+    return body["query"]["bool"]["filter"][0]["term"]["site"]
+
+
+class StubElasticsearch:
+    """
+    Synchronous ES stand-in returning random questions of the queried site.
+    """
+
+    def __init__(self, latency, questions, total_hits=1000, seed=None):
+        self.latency = latency
+        self.questions = questions  # site -> list of question ids
+        self.total_hits = total_hits
+        self._random = random.Random(seed)
+        self._lock = Lock()
+
+    def _response(self, body):
+        ids = self.questions.get(_site_of(body), [])
+        with self._lock:
+            hits = self._random.sample(ids, min(body["size"], len(ids)))
+        return {
+            "took": 0,
+            "hits": {
+                "total": {"value": self.total_hits},
+                "hits": [
+                    {
+                        "_score": 10.0 / (rank + 1),
+                        "_source": {"id": id, "title": f"Question {id}"},
+                    }
+                    for rank, id in enumerate(hits)
+                ],
+            },
+        }
+
+    def _wait(self):
+        seconds, timed_out = self.latency.sample()
+        time.sleep(seconds)
+        if timed_out:
+            raise ConnectionTimeout("Stub ES request timed out.")
+
+    def search(self, index, body):
+        self._wait()
+        return self._response(body)
+
+    def msearch(self, body):
+        self._wait()
+        queries = body[1::2]
+        return {"responses": [self._response(query) for query in queries]}
+
+
+class AsyncStubElasticsearch(StubElasticsearch):
+    """
+    AsyncElasticsearch stand-in.
+    """
+
+    async def search(self, index, body):
+        seconds, timed_out = self.latency.sample()
+        await asyncio.sleep(seconds)
+        if timed_out:
+            raise ConnectionTimeout("Stub ES request timed out.")
+        return self._response(body)
+
+
+class SqliteQuestionStore:
+    """
+    QuestionStore backed by an in-memory sqlite questions table.
+
+    Postgres errors are not handled by the curator, so the latency model
+    only adds delay here; its timeouts are ignored.
+    """
+
+    def __init__(self, rows, latency=None):
+        self.latency = latency
+        self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE questions (site TEXT, id INTEGER, answer_count INTEGER, "
+            "link TEXT, PRIMARY KEY (site, id))"
+        )
+        self._conn.executemany("INSERT INTO questions VALUES (?, ?, ?, ?)", rows)
+        self._lock = Lock()
+
+    def fetch(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        if self.latency is not None:
+            seconds, _ = self.latency.sample()
+            time.sleep(seconds)
+        values = ", ".join(["(?, ?)"] * len(keys))
+        params = [value for key in keys for value in key]
+        with self._lock:
+            # Join like QuestionStore does, so lookups use the primary key.
+            rows = self._conn.execute(
+                f"WITH keys(site, id) AS (VALUES {values}) "
+                "SELECT q.site, q.id, q.answer_count, q.link "
+                "FROM keys CROSS JOIN questions AS q "
+                "ON q.site = keys.site AND q.id = keys.id",
+                params,
+            ).fetchall()
+        return {
+            (site, id): (answer_count, link) for site, id, answer_count, link in rows
+        }
+
+    def start_reporting(self, interval):
+        pass
+
+
+class RecordingSocketIO:
+    """
+    Replacement for the web-server's socketio that records emitted packets.
+    """
+
+    def __init__(self):
+        self.emitted = []
+        self._lock = Lock()
+
+    def emit(self, event, packet, room=None):
+        with self._lock:
+            self.emitted.append(packet)
@@ -0,0 +1,543 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the real-time pipeline without pulsar, ES or postgres.
+
+Runs the actual stage loops (find_suggestions of search/search-es.py,
+find_suggestions of search/curate.py and consumer_thread of
+web-server/main.py) against the in-process fakes of fakes.py and reports
+throughput and latency per stage.
+
+Each stage is benchmarked in isolation: its input topic is filled with
+--messages packets, --workers threads consume it and the stage is timed
+until the topic is drained. With --stage pipeline all stages run together
+and requests are fed open-loop at --rate messages per second, which also
+exercises the freshness filters and deadlines.
+
+Latencies are read from the stages' own metrics (common/metrics.py). A
+summary can be saved as JSON and compared against a baseline run; the
+script exits with status 1 if throughput dropped or a p99 latency grew by
+more than --threshold.
+
+Example:
+
+    python benchmark/pipeline-bench.py --es-median-ms 5 --es-spike-prob 0.01 \\
+        --es-spike-ms 200 --es-timeout-prob 0.001 --workers 4
+"""
+
+from argparse import ArgumentParser, Namespace
+import asyncio
+from datetime import datetime
+import importlib.util
+import json
+import logging
+import os
+import random
+import sys
+from threading import Thread
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+# Stage scripts import their siblings and the shared modules by name.
+sys.path.append(os.path.join(ROOT, "search"))
+sys.path.append(os.path.join(ROOT, "common"))
+from cache import MemoryStore, QueryCache
+from codec import CODECS, DEFAULT_CODEC, Codec
+from fakes import (
+    AsyncStubElasticsearch,
+    Exhausted,
+    FakeClient,
+    LatencyModel,
+    RecordingSocketIO,
+    SqliteQuestionStore,
+    StubElasticsearch,
+)
+from freshness import FreshnessFilter
+from metrics import REGISTRY
+
+logging.basicConfig(level=logging.WARN)
+
+STAGES = ["search", "curate", "web-server"]
+TOPICS = ["suggest-topic", "curate-topic", "suggestions-topic"]
+QUANTILES = [0.5, 0.9, 0.99, 0.999]
+WORDS = (
+    "how why what python java list sort file string error install server "
+    "database query index memory thread async loop array map json parse"
+).split()
+
+
+def load_script(name, path):
+    """
+    Import a pipeline script by path (their names are not valid modules).
+    """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_questions(args, rng):
+    """
+    Return ({site: [ids]}, rows of the questions table).
+    """
+    sites = {f"site{i}": [] for i in range(args.sites)}
+    rows = []
+    for site, ids in sites.items():
+        for id in range(1, args.questions + 1):
+            ids.append(id)
+            link = f"https://{site}.stackexchange.com/questions/{id}"
+            rows.append((site, id, rng.randrange(20), link))
+    return sites, rows
+
+
+def make_requests(args, sites, rng):
+    """
+    Yield web-server style request packets for --rooms users typing.
+    """
+    seq_ids = [0] * args.rooms
+    site_names = list(sites)
+    for _ in range(args.messages):
+        room = rng.randrange(args.rooms)
+        seq_ids[room] += 1
+        yield {
+            "text": " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12))),
+            "stage": "send-request",
+            "site": site_names[room % len(site_names)],
+            "room": f"room{room}",
+            "sequence_id": seq_ids[room],
+        }
+
+
+def stamp(packet, args):
+    """
+    Mark packet as received by the web-server now, like get_suggestions.
+    """
+    now = datetime.utcnow().timestamp()
+    packet["spans"] = {"client_send": now, "server_req": now}
+    if args.deadline_ms:
+        packet["deadline"] = now + args.deadline_ms / 1000
+    return packet
+
+
+def with_suggestions(packet, sites, args, rng):
+    """
+    Turn a request into the packet search-es.py sends to the curator.
+    """
+    ids = rng.sample(sites[packet["site"]], args.limit_result_count)
+    packet["suggestions"] = {
+        id: {"title": f"Question {id}", "score": 10.0 / (rank + 1)}
+        for rank, id in enumerate(ids)
+    }
+    packet["total_hits"] = 1000
+    return packet
+
+
+def worker(target, *args):
+    """
+    Run a stage loop until its input topic is drained.
+    """
+
+    def run():
+        try:
+            target(*args)
+        except Exhausted:
+            pass
+
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def async_worker(search, es, client, args, cache, freshness):
+    """
+    Run find_suggestions_async until drained, finishing in-flight searches.
+    """
+
+    async def run():
+        try:
+            await search.find_suggestions_async(
+                es, TOPICS[0], TOPICS[1], client, args, cache, freshness
+            )
+        except Exhausted:
+            current = asyncio.current_task()
+            await asyncio.gather(*(asyncio.all_tasks() - {current}))
+
+    thread = Thread(target=asyncio.run, args=(run(),), daemon=True)
+    thread.start()
+    return thread
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.sites, rows = make_questions(args, self.rng)
+        es_latency = LatencyModel(
+            args.es_median_ms,
+            args.sigma,
+            args.es_spike_prob,
+            args.es_spike_ms,
+            args.es_timeout_prob,
+            args.es_timeout_ms,
+            seed=args.seed,
+        )
+        pg_latency = LatencyModel(
+            args.pg_median_ms,
+            args.sigma,
+            args.pg_spike_prob,
+            args.pg_spike_ms,
+            seed=args.seed,
+        )
+        stub = AsyncStubElasticsearch if args.async_mode else StubElasticsearch
+        self.es = stub(es_latency, self.sites, seed=args.seed)
+        self.store = SqliteQuestionStore(rows, pg_latency)
+        self.stage_args = Namespace(
+            index=args.index,
+            field="body",
+            query_type="match",
+            rank_in_es=False,
+            limit_result_count=args.limit_result_count,
+            batch_size=args.batch_size,
+            linger_ms=args.linger_ms,
+            max_in_flight=args.max_in_flight,
+        )
+        self.cache = None
+        if args.cache_size:
+            self.cache = QueryCache(MemoryStore(args.cache_size), args.cache_ttl)
+        self.modules = {}
+        self.freshness = {
+            stage: FreshnessFilter(stage, supersede=args.drop_superseded)
+            for stage in STAGES[:2]
+        }
+
+    def module(self, stage):
+        if stage not in self.modules:
+            if stage == "search":
+                module = load_script("search_es", "search/search-es.py")
+            elif stage == "curate":
+                module = load_script("curate", "search/curate.py")
+            else:
+                module = load_script("web_server", "web-server/main.py")
+                module.socketio = RecordingSocketIO()
+                module.freshness.supersede = self.args.drop_superseded
+            module.codec = Codec(self.args.codec)
+            self.modules[stage] = module
+        return self.modules[stage]
+
+    def start(self, stage, client):
+        """
+        Start the workers of stage, returning their threads.
+        """
+        module = self.module(stage)
+        if stage == "web-server":
+            # Replies are routed by room, a single consumer thread per server.
+            return [worker(module.consumer_thread, client, TOPICS[2])]
+
+        freshness = self.freshness[stage]
+        threads = []
+        for _ in range(self.args.workers):
+            if stage == "search" and self.args.async_mode:
+                threads.append(
+                    async_worker(
+                        module, self.es, client, self.stage_args, self.cache, freshness
+                    )
+                )
+            elif stage == "search":
+                threads.append(
+                    worker(
+                        module.find_suggestions,
+                        self.es,
+                        TOPICS[0],
+                        TOPICS[1],
+                        client,
+                        self.stage_args,
+                        self.cache,
+                        freshness,
+                    )
+                )
+            else:
+                threads.append(
+                    worker(
+                        module.find_suggestions,
+                        TOPICS[1],
+                        TOPICS[2],
+                        client,
+                        self.store,
+                        freshness,
+                        self.stage_args,
+                    )
+                )
+        return threads
+
+    def run_stage(self, stage):
+        """
+        Drain a pre-filled input topic with the workers of stage.
+        """
+        client = FakeClient()
+        in_topic = TOPICS[STAGES.index(stage)]
+        producer = client.create_producer(in_topic)
+        codec = Codec(self.args.codec)
+        for packet in make_requests(self.args, self.sites, self.rng):
+            stamp(packet, self.args)
+            if stage != "search":
+                packet = with_suggestions(packet, self.sites, self.args, self.rng)
+            producer.send(codec.encode(packet), properties=codec.properties)
+        client.close_topic(in_topic)
+
+        start = time.perf_counter()
+        for thread in self.start(stage, client):
+            thread.join()
+        return time.perf_counter() - start
+
+    def run_pipeline(self):
+        """
+        Feed requests open-loop at --rate through all stages.
+        """
+        client = FakeClient()
+        threads = {stage: self.start(stage, client) for stage in STAGES}
+        producer = client.create_producer(TOPICS[0])
+        codec = Codec(self.args.codec)
+
+        start = time.perf_counter()
+        next_send = start
+        for packet in make_requests(self.args, self.sites, self.rng):
+            if self.args.rate:
+                next_send += self.rng.expovariate(self.args.rate)
+                time.sleep(max(next_send - time.perf_counter(), 0))
+            stamp(packet, self.args)
+            producer.send(
+                codec.encode(packet),
+                properties=codec.properties,
+                partition_key=packet["room"],
+            )
+        elapsed = {}
+        for stage, topic in zip(STAGES, TOPICS):
+            client.close_topic(topic)
+            for thread in threads[stage]:
+                thread.join()
+            elapsed[stage] = time.perf_counter() - start
+
+        return elapsed
+
+    def counters(self, stage):
+        """
+        Return the messages sent, errors and drops of stage.
+        """
+        found = {}
+        for kind in ["es_timeout", "es_error", "postgres"]:
+            value = REGISTRY.counter(
+                "ycm_errors_total", "", stage=stage, kind=kind
+            ).value
+            if value:
+                found[f"error:{kind}"] = value
+        if stage == "web-server":
+            drops = self.module(stage).freshness.drops
+        else:
+            drops = self.freshness[stage].drops
+        for reason, value in drops.items():
+            if value:
+                found[f"dropped:{reason}"] = value
+        return found
+
+
+def histograms(stage, isolated):
+    """
+    Return {name: histogram} of the latencies recorded by stage.
+
+    Queue waits of an isolated stage only measure how long its pre-filled
+    topic took to drain, they are left out.
+    """
+    names = {
+        "queue_wait": "ycm_queue_wait_seconds",
+        "stage": "ycm_stage_seconds",
+        "es": "ycm_es_seconds",
+        "postgres": "ycm_postgres_seconds",
+        "end_to_end": "ycm_pipeline_seconds",
+    }
+    if isolated:
+        del names["queue_wait"], names["end_to_end"]
+    found = {}
+    for key, name in names.items():
+        histogram = REGISTRY.histogram(name, "", stage=stage)
+        if histogram.count:
+            found[key] = histogram
+    return found
+
+
+def summarize(bench, stage, seconds, isolated):
+    messages = bench.args.messages
+    return {
+        "messages": messages,
+        "sent": REGISTRY.counter("ycm_messages_total", "", stage=stage).value,
+        "seconds": seconds,
+        "throughput": messages / seconds,
+        "latency": {
+            name: {str(q): histogram.quantile(q) for q in QUANTILES}
+            for name, histogram in histograms(stage, isolated).items()
+        },
+        "counters": bench.counters(stage),
+    }
+
+
+def print_summary(report):
+    header = "".join(
+        f"{'p' + str(q * 100).rstrip('0').rstrip('.'):>10}" for q in QUANTILES
+    )
+    for stage, summary in report.items():
+        print(
+            f"\n{stage}: {summary['messages']} messages in {summary['seconds']:.2f} s, "
+            f"{summary['throughput']:.0f} msg/s, {summary['sent']} sent downstream."
+        )
+        if summary["counters"]:
+            print(f"  {summary['counters']}")
+        if summary["latency"]:
+            print(f"  {'latency':<14}{header}")
+        for name, quantiles in summary["latency"].items():
+            values = "".join(f"{v * 1000:>10.2f}" for v in quantiles.values())
+            print(f"  {name:<14}{values}")
+    print("(milliseconds, upper bound of the histogram bucket)")
+
+
+def compare(report, baseline, threshold):
+    """
+    Return a list of regressions of report against baseline.
+    """
+    regressions = []
+    for stage, summary in report.items():
+        previous = baseline.get(stage)
+        if previous is None:
+            continue
+        change = summary["throughput"] / previous["throughput"] - 1
+        print(f"{stage:<12} throughput: {change:+.1%}")
+        if change < -threshold:
+            regressions.append(f"{stage} throughput")
+        for name, quantiles in summary["latency"].items():
+            before = previous["latency"].get(name, {}).get("0.99")
+            if not before:
+                continue
+            change = quantiles["0.99"] / before - 1
+            print(f"{stage:<12} {name} p99: {change:+.1%}")
+            if change > threshold:
+                regressions.append(f"{stage} {name} p99")
+    return regressions
+
+
+def main():
+    parser = ArgumentParser("Benchmark pipeline stages against in-process fakes.")
+    parser.add_argument(
+        "--stage",
+        help="Stage to benchmark. Defaults to every stage in isolation.",
+        choices=STAGES + ["pipeline", "all"],
+        default="all",
+    )
+    parser.add_argument("--messages", help="Messages to send.", default=5000, type=int)
+    parser.add_argument(
+        "--rate",
+        help="Requests per second fed to --stage pipeline (0 for no limit).",
+        default=0,
+        type=float,
+    )
+    parser.add_argument(
+        "--workers", help="Consumer threads per stage.", default=4, type=int
+    )
+    parser.add_argument("--rooms", help="Concurrent users.", default=200, type=int)
+    parser.add_argument("--sites", help="Stackexchange sites.", default=10, type=int)
+    parser.add_argument(
+        "--questions", help="Questions per site.", default=2000, type=int
+    )
+    parser.add_argument("--index", help="Index name.", default="questions")
+    parser.add_argument(
+        "--limit-result-count", help="Hits per search.", default=10, type=int
+    )
+    parser.add_argument("--batch-size", help="Stage batch size.", default=1, type=int)
+    parser.add_argument("--linger-ms", help="Stage linger.", default=5, type=int)
+    parser.add_argument(
+        "--async-mode", help="Use find_suggestions_async.", action="store_true"
+    )
+    parser.add_argument(
+        "--max-in-flight", help="Async searches per worker.", default=32, type=int
+    )
+    parser.add_argument(
+        "--cache-size", help="Query cache entries (0 disables).", default=0, type=int
+    )
+    parser.add_argument("--cache-ttl", help="Query cache TTL.", default=60, type=float)
+    parser.add_argument(
+        "--codec", help="Wire codec.", choices=CODECS, default=DEFAULT_CODEC
+    )
+    parser.add_argument(
+        "--deadline-ms",
+        help="Request deadline (0 disables). Expired requests are dropped.",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--drop-superseded",
+        help="Drop requests superseded by a newer request of the same room.",
+        action="store_true",
+    )
+    parser.add_argument("--sigma", help="Lognormal sigma.", default=0.5, type=float)
+    parser.add_argument("--es-median-ms", help="ES latency.", default=5.0, type=float)
+    parser.add_argument(
+        "--es-spike-prob", help="Chance of an ES spike.", default=0.0, type=float
+    )
+    parser.add_argument(
+        "--es-spike-ms", help="Extra latency of a spike.", default=200.0, type=float
+    )
+    parser.add_argument(
+        "--es-timeout-prob", help="Chance of an ES timeout.", default=0.0, type=float
+    )
+    parser.add_argument(
+        "--es-timeout-ms", help="Time until a timeout.", default=1000.0, type=float
+    )
+    parser.add_argument(
+        "--pg-median-ms", help="Postgres latency.", default=1.0, type=float
+    )
+    parser.add_argument(
+        "--pg-spike-prob", help="Chance of a postgres spike.", default=0.0, type=float
+    )
+    parser.add_argument(
+        "--pg-spike-ms", help="Extra latency of a spike.", default=100.0, type=float
+    )
+    parser.add_argument("--seed", help="Random seed.", default=0, type=int)
+    parser.add_argument("--save", help="Save the summary as JSON to this path.")
+    parser.add_argument("--baseline", help="Summary JSON to compare with.")
+    parser.add_argument(
+        "--threshold",
+        help="Max allowed relative regression, e.g. 0.1 for 10%%.",
+        default=0.1,
+        type=float,
+    )
+    args = parser.parse_args()
+
+    bench = Bench(args)
+    report = {}
+    # Stage errors (e.g. injected ES timeouts) are counted in the report,
+    # logging every one of them would slow the stages down.
+    logging.disable(logging.ERROR)
+    if args.stage == "pipeline":
+        for stage, seconds in bench.run_pipeline().items():
+            report[f"pipeline/{stage}"] = summarize(bench, stage, seconds, False)
+    else:
+        stages = STAGES if args.stage == "all" else [args.stage]
+        for stage in stages:
+            seconds = bench.run_stage(stage)
+            report[stage] = summarize(bench, stage, seconds, True)
+    logging.disable(logging.NOTSET)
+    print_summary(report)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            logging.error(f"Regression over {args.threshold:.0%} in: {regressions}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
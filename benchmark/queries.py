@@ -0,0 +1,91 @@
+"""
+Query sampling and ES baselines shared by the search benchmarks.
+"""
+
+from argparse import Namespace
+import importlib.util
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(ROOT, "common"))
+from records import blacklist_message
+
+
+def sample_queries(path, count, body_length, seed):
+    """
+    Return a uniform sample of (site, id, query text) from an NDJSON dump.
+    """
+    rng = random.Random(seed)
+    sample = []
+    seen = 0
+    with open(path) as f:
+        for line in f:
+            try:
+                doc = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if blacklist_message(doc) or "body" not in doc:
+                continue
+            if "id" not in doc or "site" not in doc:
+                continue
+            seen += 1
+            query = (doc["site"], doc["id"], doc["body"][:body_length])
+            if len(sample) < count:
+                sample.append(query)
+            elif rng.randrange(seen) < count:
+                sample[rng.randrange(count)] = query
+    return sample
+
+
+def percentiles(seconds):
+    p50, p99 = np.percentile(np.asarray(seconds) * 1000, [50, 99])
+    return f"p50 {p50:8.2f} ms  p99 {p99:8.2f} ms"
+
+
+def run_es(es_url, es_index, field, queries, k):
+    """
+    Return ([[ids]], latencies, took) of ES match queries built by search-es.py.
+
+    latencies are measured by the client, took (seconds) is the time ES
+    reports spending on the query. The difference is the network hop plus
+    (de)serialization.
+    """
+    from elasticsearch import Elasticsearch
+
+    # search-es.py imports its siblings by name.
+    sys.path.append(os.path.join(ROOT, "search"))
+    spec = importlib.util.spec_from_file_location(
+        "search_es", os.path.join(ROOT, "search", "search-es.py")
+    )
+    search = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(search)
+    args = Namespace(
+        query_type="match", field=field, limit_result_count=k, rank_in_es=False
+    )
+
+    es = Elasticsearch(es_url)
+    results, latencies, took = [], [], []
+    for site, _, text in queries:
+        body = search.build_query({"text": text, "site": site}, args)
+        began = time.perf_counter()
+        response = es.search(index=es_index, body=body)
+        latencies.append(time.perf_counter() - began)
+        took.append(response.get("took", 0) / 1000)
+        _, hits = search.extract_results(response)
+        results.append(list(hits))
+    return results, latencies, took
+
+
+def self_rate(queries, results):
+    return np.mean([id in ids for (_, id, _), ids in zip(queries, results)])
+
+
+def overlap(results, baseline, k):
+    return np.mean([len(set(a) & set(b)) / k for a, b in zip(results, baseline)])
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+Recall and latency of the vector index (search-es.py --query-type vector).
+
+Queries are the first --body-length characters of questions sampled from
+an NDJSON dump, as typed by the web clients. For every --nprobe the script
+reports:
+
+- recall@k: share of the exact k nearest neighbours (all lists scanned)
+  that the IVF search returns,
+- self@k: share of queries whose own question is in the top k,
+- latency per batch of --batch-size queries and queries per second.
+
+With --es-url the same queries are sent to ES as match queries (built by
+search-es.py) to compare self@k and latency, along with the overlap of the
+vector and match top k.
+"""
+
+from argparse import ArgumentParser
+import os
+import sys
+import time
+
+import numpy as np
+
+from queries import ROOT, overlap, percentiles, run_es, sample_queries, self_rate
+
+sys.path.append(os.path.join(ROOT, "common"))
+from vectors import VectorIndex
+
+
+def run_vector(index, queries, k, nprobe, batch_size):
+    """
+    Return ([[ids]], batch latencies) of the vector search of queries.
+    """
+    results, latencies = [], []
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start : start + batch_size]
+        began = time.perf_counter()
+        found = index.search(
+            [text for _, _, text in batch], [site for site, _, _ in batch], k, nprobe
+        )
+        latencies.append(time.perf_counter() - began)
+        results.extend([id for id, _, _ in hits] for _, hits in found)
+    return results, latencies
+
+
+def main():
+    parser = ArgumentParser("Benchmark the vector index against exact search and ES.")
+    parser.add_argument("index", help="Vector index directory.")
+    parser.add_argument("file", help="NDJSON file with questions to query.")
+    parser.add_argument("--queries", help="Queries sampled.", default=1000, type=int)
+    parser.add_argument(
+        "--body-length", help="Characters of the body typed.", default=100, type=int
+    )
+    parser.add_argument("--k", help="Results per query.", default=10, type=int)
+    parser.add_argument(
+        "--nprobe", help="Comma separated nprobe values.", default="1,2,4,8,16,32"
+    )
+    parser.add_argument(
+        "--batch-size", help="Queries encoded per batch.", default=32, type=int
+    )
+    parser.add_argument(
+        "--es-url", help="ES to compare with.", default=os.getenv("ES_URL")
+    )
+    parser.add_argument("--es-index", help="ES index.", default=os.getenv("ES_INDEX"))
+    parser.add_argument("--field", help="ES field to match.", default="body")
+    parser.add_argument("--seed", help="Random seed.", default=0, type=int)
+    args = parser.parse_args()
+
+    queries = sample_queries(args.file, args.queries, args.body_length, args.seed)
+    if not queries:
+        raise SystemExit("No questions with a body, an id and a site in the file.")
+    index = VectorIndex(args.index)
+    # Scanning every list of a site is an exact search.
+    exact, latencies = run_vector(index, queries, args.k, 2 ** 31, args.batch_size)
+    print(f"{len(queries)} queries, k={args.k}, batches of {args.batch_size}.")
+    print(
+        f"{'exact':<12} self@k {self_rate(queries, exact):6.1%}  "
+        f"{percentiles(latencies)}  "
+        f"{len(queries) / sum(latencies):8.0f} q/s"
+    )
+
+    vector_results = {}
+    for nprobe in [int(n) for n in args.nprobe.split(",")]:
+        results, latencies = run_vector(index, queries, args.k, nprobe, args.batch_size)
+        vector_results[nprobe] = results
+        recall = np.mean(
+            [
+                len(set(found) & set(truth)) / len(truth)
+                for found, truth in zip(results, exact)
+                if truth
+            ]
+        )
+        print(
+            f"{'nprobe ' + str(nprobe):<12} self@k {self_rate(queries, results):6.1%}  "
+            f"{percentiles(latencies)}  "
+            f"{len(queries) / sum(latencies):8.0f} q/s  recall@k {recall:6.1%}"
+        )
+
+    if args.es_url and args.es_index:
+        results, latencies, _ = run_es(
+            args.es_url, args.es_index, args.field, queries, args.k
+        )
+        print(
+            f"{'es match':<12} self@k {self_rate(queries, results):6.1%}  "
+            f"{percentiles(latencies)}  "
+            f"{len(queries) / sum(latencies):8.0f} q/s  (one query at a time)"
+        )
+        for nprobe, vector in vector_results.items():
+            print(
+                f"overlap@k of nprobe {nprobe} and es match: "
+                f"{overlap(vector, results, args.k):.1%}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+Helpers to consume pulsar messages in micro-batches.
+"""
+
+import time
+
+from metrics import now
+from pulsar import Timeout
+
+
+def receive_batch(consumer, batch_size, linger_ms):
+    """
+    Receive up to batch_size messages, waiting at most linger_ms.
+
+    The first receive blocks until a message arrives. Subsequent
+    receives only wait for whatever is left of the linger window, so
+    a lone message is never held back longer than linger_ms.
+
+    Returns (message, timestamp) pairs, timestamp being when the message
+    was received, so the time it lingered in the batch is not counted
+    as queue wait.
+    """
+    msgs = [(consumer.receive(), now())]
+    deadline = time.monotonic() + linger_ms / 1000
+    while len(msgs) < batch_size:
+        remaining_ms = int((deadline - time.monotonic()) * 1000)
+        if remaining_ms <= 0:
+            break
+        try:
+            msgs.append((consumer.receive(timeout_millis=remaining_ms), now()))
+        except Timeout:
+            break
+    return msgs
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmark of the wire codecs on typical pipeline packets.
+
+For every hop the sender encodes the packet and the receiver decodes it.
+This script reports the encode + decode time per hop and the encoded
+size for each available codec.
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime
+import timeit
+
+from codec import CODECS, Codec, available, decode
+from metrics import SPANS
+
+
+def sample_packets(text_length, num_suggestions):
+    """
+    Return the packet sent on each hop, in pipeline order.
+    """
+    now = datetime.utcnow().timestamp()
+
+    def spans(count):
+        # Spans marked by the time the packet leaves each stage.
+        return {name: now for name in SPANS[:count]}
+
+    request = {
+        "text": "how do I merge two dictionaries in a single expression "[
+            :text_length
+        ].ljust(text_length, "x"),
+        "stage": "send-request",
+        "spans": spans(2),
+        "sequence_id": 42,
+        "site": "stackoverflow",
+        "room": "d2b3c7a5e1f94bbf8c3ed2d8a0f0b6c1",
+        "deadline": now + 2,
+    }
+    searched = dict(request, spans=spans(4), total_hits=10000)
+    searched["suggestions"] = {
+        38987
+        + i: {
+            "title": f"How do I merge two dictionaries in Python? (variant {i})",
+            "score": 12.5 - i,
+        }
+        for i in range(num_suggestions)
+    }
+    curated = dict(searched, spans=spans(6))
+    curated["suggestions"] = [
+        dict(
+            suggestion,
+            link=f"https://stackoverflow.com/questions/{id}/how-do-i-merge-two-dicts",
+        )
+        for id, suggestion in searched["suggestions"].items()
+    ]
+    return [
+        ("web-server -> search", request),
+        ("search -> curate", searched),
+        ("curate -> web-server", curated),
+    ]
+
+
+def main():
+    parser = ArgumentParser("Benchmark pipeline wire codecs.")
+    parser.add_argument("--text-length", default=100, type=int)
+    parser.add_argument("--num-suggestions", default=10, type=int)
+    parser.add_argument("--repeat", default=20000, type=int)
+    args = parser.parse_args()
+
+    codecs = [Codec(name) for name in CODECS if available(name)]
+    print(f"{'hop':<22} {'codec':<8} {'bytes':>6} {'us/hop':>8}")
+    for hop, packet in sample_packets(args.text_length, args.num_suggestions):
+        for codec in codecs:
+            data = codec.encode(packet)
+            seconds = timeit.timeit(
+                lambda: decode(codec.encode(packet), codec.properties),
+                number=args.repeat,
+            )
+            us = seconds / args.repeat * 1e6
+            print(f"{hop:<22} {codec.name:<8} {len(data):>6} {us:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
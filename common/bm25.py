@@ -0,0 +1,487 @@
+"""
+Embedded BM25 inverted index, partitioned by site.
+
+An alternative to an ES round trip per keystroke for small sites and edge
+deployments. The index is a directory written by
+batch-pipeline/build-bm25-index.py:
+
+    meta.json               indexed fields and BM25 parameters
+    files.json              input files indexed so far, see
+                            build-bm25-index.py
+    sites/<site>/
+        segments.json       names of the live segments, oldest first
+        <segment>/          immutable segment of questions:
+            meta.json       number of questions and their total length
+            terms.bin       sorted utf-8 terms, concatenated
+            term_offsets.npy  int64[terms + 1], offsets into terms.bin
+            df.npy          int32[terms], questions containing the term
+            max_tf.npy      int32[terms], highest frequency of the term
+            min_length.npy  int32[terms], shortest question with the term
+            postings.bin    per term: doc id gaps then term frequencies,
+                            variable byte encoded
+            postings_offsets.npy  int64[terms + 1], offsets into postings.bin
+            ids.npy         int64[questions], question ids
+            lengths.npy     int32[questions], terms per question
+            titles.bin      utf-8 titles, concatenated
+            title_offsets.npy  int64[questions + 1], offsets into titles.bin
+
+Everything is memory-mapped. Appending questions writes a new segment and
+then atomically replaces segments.json; readers notice the change on their
+next check. Collection statistics (document count, average length and
+document frequencies) are summed over the segments of a site, so scores do
+not depend on how questions are split into segments. A question indexed
+again in a newer segment is only scored there, its older copies are masked
+out when the segments are loaded, but they still count in the statistics.
+
+Queries are evaluated term at a time with MaxScore pruning. Terms are
+processed by decreasing score upper bound (from max_tf and min_length).
+Once the k-th best partial score reaches the sum of the upper bounds of the
+remaining terms, a question that has not matched yet can no longer make it
+into the top k, so the remaining posting lists only update the current
+candidates, and candidates that cannot catch up are dropped.
+"""
+
+from bisect import bisect_left
+import json
+import logging
+import mmap
+import os
+import re
+import time
+
+import numpy as np
+
+from text import tokenize
+
+META = "meta.json"
+SEGMENTS = "segments.json"
+K1 = 1.2
+B = 0.75
+
+
+def site_dir(path, site):
+    # Site names come from the data, keep them inside the index directory.
+    return os.path.join(path, "sites", re.sub(r"[^\w.-]", "_", site))
+
+
+def vbyte_encode(values):
+    """
+    Variable byte encode non-negative integers, 7 bits per byte.
+
+    The high bit of a byte is set if more bytes of the value follow.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    sizes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        sizes += rest > 0
+        rest >>= np.uint64(7)
+    ends = np.cumsum(sizes)
+    out = np.zeros(ends[-1] if len(ends) else 0, dtype=np.uint8)
+    starts = ends - sizes
+    for i in range(int(sizes.max()) if len(sizes) else 0):
+        has = sizes > i
+        byte = (values[has] >> np.uint64(7 * i)) & np.uint64(0x7F)
+        more = np.where(sizes[has] > i + 1, 0x80, 0).astype(np.uint64)
+        out[starts[has] + i] = (byte | more).astype(np.uint8)
+    return out
+
+
+def vbyte_decode(data):
+    """
+    Decode variable byte encoded integers.
+    """
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.int64)
+    last = (data & 0x80) == 0
+    ends = np.flatnonzero(last)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    value_of_byte = np.concatenate(([0], np.cumsum(last[:-1])))
+    shift = (np.arange(len(data)) - starts[value_of_byte]) * 7
+    parts = (data & 0x7F).astype(np.int64) << shift
+    return np.add.reduceat(parts, starts)
+
+
+def write_meta(path, fields):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, META), "w") as f:
+        json.dump({"fields": fields, "k1": K1, "b": B}, f)
+
+
+def segment_names(site_path):
+    try:
+        with open(os.path.join(site_path, SEGMENTS)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def write_segment(path, site, questions):
+    """
+    Append a segment with questions, a list of (id, title, text), to site.
+
+    Returns the name of the new segment.
+    """
+    site_path = site_dir(path, site)
+    existing = segment_names(site_path)
+    name = f"{int(time.time() * 1000):015d}-{len(existing):06d}"
+    segment = os.path.join(site_path, name)
+    os.makedirs(segment)
+
+    # (term, doc, tf) triples, docs numbered in the order of questions.
+    vocabulary = {}
+    term_ids, docs, tfs, lengths = [], [], [], []
+    for doc, (_, _, text) in enumerate(questions):
+        terms = tokenize(text)
+        lengths.append(len(terms))
+        counts = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, tf in counts.items():
+            term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+            docs.append(doc)
+            tfs.append(tf)
+
+    terms = sorted(vocabulary)
+    # Renumber terms in sorted order and group postings by term.
+    rank = np.zeros(len(terms), dtype=np.int64)
+    rank[[vocabulary[term] for term in terms]] = np.arange(len(terms))
+    term_ids = rank[np.asarray(term_ids, dtype=np.int64)]
+    docs = np.asarray(docs, dtype=np.int64)
+    tfs = np.asarray(tfs, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int32)
+    order = np.lexsort((docs, term_ids))
+    term_ids, docs, tfs = term_ids[order], docs[order], tfs[order]
+
+    df = np.bincount(term_ids, minlength=len(terms))
+    first = np.concatenate(([0], np.cumsum(df)[:-1]))
+    position = np.arange(len(docs)) - first[term_ids]
+    gaps = docs - np.where(position > 0, np.roll(docs, 1), 0)
+    # Each term stores its df gaps followed by its df term frequencies.
+    values = np.empty(2 * len(docs), dtype=np.int64)
+    values[2 * first[term_ids] + position] = gaps
+    values[2 * first[term_ids] + df[term_ids] + position] = tfs
+    encoded = vbyte_encode(values)
+    # Byte offset of every value, then of the first value of every term.
+    byte_starts = np.concatenate(([0], np.flatnonzero((encoded & 0x80) == 0) + 1))
+    postings_offsets = np.append(byte_starts[2 * first], len(encoded))
+
+    max_tf = np.zeros(len(terms), dtype=np.int32)
+    np.maximum.at(max_tf, term_ids, tfs)
+    min_length = np.full(len(terms), np.iinfo(np.int32).max, dtype=np.int32)
+    np.minimum.at(min_length, term_ids, lengths[docs])
+
+    encoded_terms = [term.encode("utf-8") for term in terms]
+    titles = [title.encode("utf-8") for _, title, _ in questions]
+
+    def save(name, array):
+        np.save(os.path.join(segment, name), array)
+
+    def save_blob(name, offsets_name, items):
+        offsets = np.zeros(len(items) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(item) for item in items])
+        save(offsets_name, offsets)
+        with open(os.path.join(segment, name), "wb") as f:
+            f.write(b"".join(items))
+
+    save_blob("terms.bin", "term_offsets.npy", encoded_terms)
+    save_blob("titles.bin", "title_offsets.npy", titles)
+    save("df.npy", df.astype(np.int32))
+    save("max_tf.npy", max_tf)
+    save("min_length.npy", min_length)
+    save("postings_offsets.npy", postings_offsets.astype(np.int64))
+    with open(os.path.join(segment, "postings.bin"), "wb") as f:
+        f.write(encoded.tobytes())
+    save("ids.npy", np.asarray([id for id, _, _ in questions], dtype=np.int64))
+    save("lengths.npy", lengths)
+    with open(os.path.join(segment, META), "w") as f:
+        json.dump({"docs": len(questions), "total_length": int(lengths.sum())}, f)
+
+    # Publish the segment. Readers only look at segments listed here.
+    tmp = os.path.join(site_path, f"{SEGMENTS}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(existing + [name], f)
+    os.replace(tmp, os.path.join(site_path, SEGMENTS))
+    return name
+
+
+def _map_blob(path):
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _Strings:
+    """
+    Sequence view of a blob of concatenated strings, for bisect.
+
+    Plain mmap and memoryview indexing is several times cheaper than
+    indexing numpy memory maps, which matters for the ~20 probes of a
+    binary search.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = memoryview(offsets).cast("B").cast("q")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i] : self.offsets[i + 1]]
+
+
+class Segment:
+    def __init__(self, path):
+        def load(name):
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        with open(os.path.join(path, META)) as f:
+            meta = json.load(f)
+        self.docs = meta["docs"]
+        self.total_length = meta["total_length"]
+        self.terms = _Strings(
+            _map_blob(os.path.join(path, "terms.bin")), load("term_offsets.npy")
+        )
+        self.df = load("df.npy")
+        self.max_tf = load("max_tf.npy")
+        self.min_length = load("min_length.npy")
+        postings = _map_blob(os.path.join(path, "postings.bin"))
+        self.postings = np.frombuffer(postings, dtype=np.uint8)
+        self.postings_offsets = load("postings_offsets.npy")
+        self.ids = load("ids.npy")
+        self.lengths = load("lengths.npy")
+        self.titles = _Strings(
+            _map_blob(os.path.join(path, "titles.bin")), load("title_offsets.npy")
+        )
+        self._sorted_ids = None
+
+    def contains(self, ids):
+        """
+        Return a mask of the question ids (an array) present in the segment.
+        """
+        if self._sorted_ids is None:
+            self._sorted_ids = np.sort(self.ids)
+        if not len(self._sorted_ids):
+            return np.zeros(len(ids), dtype=bool)
+        found = np.searchsorted(self._sorted_ids, ids)
+        found = np.minimum(found, len(self._sorted_ids) - 1)
+        return self._sorted_ids[found] == ids
+
+    def lookup(self, term):
+        """
+        Return the term id of term (str) or None.
+        """
+        encoded = term.encode("utf-8")
+        i = bisect_left(self.terms, encoded)
+        if i < len(self.terms) and self.terms[i] == encoded:
+            return i
+        return None
+
+    def postings_of(self, term_id):
+        """
+        Return (docs, tfs) of a term.
+        """
+        start, end = self.postings_offsets[term_id], self.postings_offsets[term_id + 1]
+        values = vbyte_decode(self.postings[start:end])
+        df = int(self.df[term_id])
+        return np.cumsum(values[:df]), values[df:]
+
+    def title(self, doc):
+        return self.titles[doc].decode("utf-8")
+
+
+def _tf_part(tfs, lengths, avg_length):
+    norm = K1 * (1 - B + B * lengths / avg_length)
+    return tfs * (K1 + 1) / (tfs + norm)
+
+
+class SiteIndex:
+    """
+    Live segments of one site.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self.segments = []
+        self.reload()
+
+    def reload(self):
+        names = segment_names(self.path)
+        if names == self.names:
+            return
+        loaded = dict(zip(self.names, self.segments))
+        self.segments = [
+            loaded.get(name) or Segment(os.path.join(self.path, name)) for name in names
+        ]
+        self.names = names
+        self.stale = self._stale_masks()
+        self.docs = sum(segment.docs for segment in self.segments)
+        total_length = sum(segment.total_length for segment in self.segments)
+        self.avg_length = total_length / self.docs if self.docs else 1.0
+
+    def _stale_masks(self):
+        """
+        Return per segment a mask of its docs indexed again later, or None.
+
+        A doc is stale if its question id comes again in the same segment
+        or in a newer one. Only the newest copy of a question is scored.
+        """
+        masks = []
+        for position, segment in enumerate(self.segments):
+            ids = np.asarray(segment.ids)
+            stale = np.ones(len(ids), dtype=bool)
+            # Last occurrence of every id within the segment.
+            _, last = np.unique(ids[::-1], return_index=True)
+            stale[len(ids) - 1 - last] = False
+            for newer in self.segments[position + 1 :]:
+                stale |= newer.contains(ids)
+            masks.append(stale if stale.any() else None)
+        return masks
+
+    def search(self, text, k):
+        """
+        Return (scored, [(id, title, score)]) of the top k questions.
+
+        scored is the number of questions that were scored.
+        """
+        query_tf = {}
+        for term in tokenize(text):
+            query_tf[term] = query_tf.get(term, 0) + 1
+        # Look up terms in every segment, document frequencies are summed
+        # over the segments of the site.
+        weights = []  # (weight, {segment index: term id})
+        for term, qtf in query_tf.items():
+            ids = {}
+            for position, segment in enumerate(self.segments):
+                term_id = segment.lookup(term)
+                if term_id is not None:
+                    ids[position] = term_id
+            if ids:
+                df = sum(int(self.segments[p].df[i]) for p, i in ids.items())
+                idf = np.log(1 + (self.docs - df + 0.5) / (df + 0.5))
+                weights.append((qtf * idf, ids))
+
+        candidates = []  # (segment index, docs, scores), newest segment first
+        theta = 0.0
+        scored = 0
+        for position in reversed(range(len(self.segments))):
+            segment = self.segments[position]
+            terms = []
+            for weight, ids in weights:
+                if position in ids:
+                    term_id = ids[position]
+                    bound = _tf_part(
+                        float(segment.max_tf[term_id]),
+                        float(segment.min_length[term_id]),
+                        self.avg_length,
+                    )
+                    terms.append((weight * bound, weight, term_id))
+            docs, scores, theta, count = self._max_score(
+                segment, self.stale[position], terms, k, theta
+            )
+            scored += count
+            candidates.append((position, docs, scores))
+        return scored, self._top(candidates, k)
+
+    def _max_score(self, segment, stale, terms, k, theta):
+        """
+        Score the terms of one segment, see the module docstring.
+
+        stale masks the docs not to score (see _stale_masks), terms is a
+        list of (upper bound, weight, term id). theta is the k-th best
+        score found in other segments so far.
+        """
+        terms.sort(key=lambda term: term[0], reverse=True)
+        remaining = np.cumsum([bound for bound, _, _ in terms][::-1])[::-1]
+        docs = np.zeros(0, dtype=np.int64)
+        scores = np.zeros(0)
+        count = 0
+        for i, (_, weight, term_id) in enumerate(terms):
+            term_docs, tfs = segment.postings_of(term_id)
+            if stale is not None:
+                live = ~stale[term_docs]
+                term_docs, tfs = term_docs[live], tfs[live]
+            if not len(term_docs):
+                continue
+            lengths = segment.lengths[term_docs]
+            term_scores = weight * _tf_part(tfs, lengths, self.avg_length)
+            if len(scores) >= k:
+                theta = max(theta, np.partition(scores, -k)[-k])
+            if len(scores) >= k and remaining[i] <= theta:
+                # No new question can make it, only update candidates.
+                matches = np.searchsorted(term_docs, docs)
+                matches = np.minimum(matches, len(term_docs) - 1)
+                hit = term_docs[matches] == docs
+                scores[hit] += term_scores[matches[hit]]
+            else:
+                count += len(term_docs)
+                merged, inverse = np.unique(
+                    np.concatenate((docs, term_docs)), return_inverse=True
+                )
+                scores = np.bincount(
+                    inverse, weights=np.concatenate((scores, term_scores))
+                )
+                docs = merged
+            after = remaining[i + 1] if i + 1 < len(terms) else 0.0
+            if len(scores) > k and theta > 0:
+                keep = scores + after >= theta
+                docs, scores = docs[keep], scores[keep]
+        if len(scores) >= k:
+            theta = max(theta, np.partition(scores, -k)[-k])
+        return docs, scores, theta, max(count, len(docs))
+
+    def _top(self, candidates, k):
+        # Stale copies were never scored, every question has one candidate.
+        hits = {}
+        for position, docs, scores in candidates:
+            segment = self.segments[position]
+            ids = np.asarray(segment.ids[docs])
+            for i in np.argsort(-scores, kind="stable")[:k]:
+                id, score = int(ids[i]), float(scores[i])
+                if id not in hits or score > hits[id][0]:
+                    hits[id] = (score, segment, int(docs[i]))
+        top = sorted(hits.items(), key=lambda hit: hit[1][0], reverse=True)[:k]
+        return [(id, segment.title(doc), score) for id, (score, segment, doc) in top]
+
+
+class BM25Index:
+    """
+    Site indexes of an index directory, loaded on first use.
+
+    Sites check for new segments at most every check_interval seconds.
+    """
+
+    def __init__(self, path, check_interval=30.0):
+        self.path = path
+        self.check_interval = check_interval
+        with open(os.path.join(path, META)) as f:
+            self.meta = json.load(f)
+        self.sites = {}  # site -> (SiteIndex or None, last check)
+
+    def site(self, site):
+        index, checked = self.sites.get(site, (None, None))
+        now = time.monotonic()
+        if checked is not None and now - checked < self.check_interval:
+            return index
+        path = site_dir(self.path, site)
+        if index is None and segment_names(path):
+            index = SiteIndex(path)
+        elif index is not None:
+            index.reload()
+        elif checked is None:
+            logging.warning(f"No BM25 index for site {site}.")
+        self.sites[site] = (index, now)
+        return index
+
+    def search(self, text, site, k):
+        """
+        Return (scored, [(id, title, score)]) of the top k questions of site.
+        """
+        index = self.site(site)
+        if index is None:
+            return 0, []
+        return index.search(text, k)
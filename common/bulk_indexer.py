@@ -0,0 +1,358 @@
+"""
+Parallel bulk indexing of NDJSON dumps into elastic search.
+
+helpers.bulk parses the dump and sends its chunks one after the other, in a
+single thread. BulkIndexer scans the dump in parallel (scanner.py), worker
+processes turn its lines into ready to send bulk actions, and sends them
+from several threads:
+
+- an Extractor picks the documents of a dump (what to skip, their id and
+  fields), so the same indexer loads stack overflow questions and reddit
+  submissions,
+- chunks are cut by documents and by bytes. ChunkSizer grows them while
+  bulk requests stay under the target latency and halves them when ES
+  pushes back (429) or slows down,
+- 429 responses, and documents rejected with 429, are retried with
+  exponential backoff,
+- refresh and replicas are turned off for the load and restored after.
+
+The parsed ranges waiting to be sent are bounded (--max-ranges), memory does
+not grow with the dump. A failure to parse the dump (an extractor raising
+in a worker) stops the load: the ranges not sent yet are dropped and the
+error is raised by run.
+"""
+
+from abc import ABC, abstractmethod
+import json
+import logging
+import os
+from queue import Queue
+from threading import Event, Lock, Thread
+import time
+
+from elasticsearch.exceptions import TransportError
+
+from scanner import Scan
+
+
+class Extractor(ABC):
+    """
+    Picks the documents of a dump, subclasses implement extract.
+
+    where ({field: value}) is pushed down to the Scan of the dump, lines
+    that do not match are skipped before they are decoded.
+    """
+
+    where = None
+
+    @abstractmethod
+    def extract(self, msg):
+        """
+        Return (id, document) of a parsed line, None to skip it.
+        """
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--workers", help="Parsing processes.", default=os.cpu_count(), type=int
+    )
+    parser.add_argument(
+        "--senders", help="Concurrent bulk requests.", default=4, type=int
+    )
+    parser.add_argument(
+        "--range-size", help="Bytes parsed per task.", default=16 << 20, type=int
+    )
+    parser.add_argument(
+        "--max-ranges",
+        help="Parsed ranges waiting to be sent. Defaults to twice the workers.",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--chunk-docs",
+        help="Initial documents per bulk request.",
+        default=1000,
+        type=int,
+    )
+    parser.add_argument(
+        "--chunk-bytes",
+        help="Initial bytes per bulk request.",
+        default=5 << 20,
+        type=int,
+    )
+    parser.add_argument(
+        "--max-chunk-docs",
+        help="Max documents per bulk request.",
+        default=10000,
+        type=int,
+    )
+    parser.add_argument(
+        "--max-chunk-bytes",
+        help="Max bytes per bulk request.",
+        default=50 << 20,
+        type=int,
+    )
+    parser.add_argument(
+        "--target-latency",
+        help="Bulk request seconds chunks grow towards.",
+        default=1.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--max-retries",
+        help="Retries of throttled (429) requests.",
+        default=8,
+        type=int,
+    )
+    parser.add_argument(
+        "--keep-settings",
+        help="Do not turn off refresh and replicas during the load.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--report-interval", help="Seconds between progress logs.", default=10, type=int
+    )
+
+
+class ChunkSizer:
+    """
+    Documents and bytes per bulk request, shared by the senders.
+
+    Grows by a quarter after requests faster than target_latency, halves
+    after throttled or twice as slow ones.
+    """
+
+    MIN_DOCS = 10
+    MIN_BYTES = 64 << 10
+
+    def __init__(self, docs, bytes, max_docs, max_bytes, target_latency):
+        self.docs = docs
+        self.bytes = bytes
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.lock = Lock()
+
+    def limits(self):
+        with self.lock:
+            return int(self.docs), int(self.bytes)
+
+    def observe(self, latency):
+        if latency > 2 * self.target_latency:
+            self.shrink()
+        elif latency < self.target_latency:
+            with self.lock:
+                self.docs = min(self.docs * 1.25, self.max_docs)
+                self.bytes = min(self.bytes * 1.25, self.max_bytes)
+
+    def shrink(self):
+        with self.lock:
+            self.docs = max(self.docs / 2, self.MIN_DOCS)
+            self.bytes = max(self.bytes / 2, self.MIN_BYTES)
+
+
+class BulkIndexer:
+    """
+    Index the documents an Extractor picks from NDJSON files.
+    """
+
+    def __init__(self, es, index, extractor, args):
+        self.es = es
+        self.index = index
+        self.extractor = extractor
+        self.args = args
+        self.sizer = ChunkSizer(
+            args.chunk_docs,
+            args.chunk_bytes,
+            args.max_chunk_docs,
+            args.max_chunk_bytes,
+            args.target_latency,
+        )
+        self.queue = Queue(args.max_ranges or 2 * args.workers)
+        self.lock = Lock()
+        # Set when parsing failed, the senders drop what is left.
+        self.aborted = Event()
+        self.indexed = self.failed = self.sent_bytes = 0
+        self.errors = []
+
+    def run(self, paths):
+        """
+        Index paths, returns (indexed, failed) documents.
+        """
+        previous = None
+        if not self.args.keep_settings:
+            previous = self.disable_refresh()
+        try:
+            start = time.time()
+            self.load(paths)
+        finally:
+            if previous is not None:
+                self.restore(previous)
+        elapsed = time.time() - start
+        logging.info(
+            f"Indexed {self.indexed} documents ({self.failed} failed) in "
+            f"{elapsed:.1f} s: {self.indexed / max(elapsed, 1e-9):,.0f} docs/s, "
+            f"{self.sent_bytes / max(elapsed, 1e-9) / (1 << 20):.1f} MB/s."
+        )
+        if self.errors:
+            raise self.errors[0]
+        return self.indexed, self.failed
+
+    def disable_refresh(self):
+        """
+        Turn off refresh and replicas, returns the settings to restore.
+        """
+        response = self.es.indices.get_settings(
+            index=self.index, name="index.refresh_interval,index.number_of_replicas"
+        )
+        previous = {}
+        for index, settings in response.items():
+            current = settings["settings"].get("index", {})
+            previous[index] = {
+                "refresh_interval": current.get("refresh_interval", "1s"),
+                "number_of_replicas": current.get("number_of_replicas", "1"),
+            }
+        self.es.indices.put_settings(
+            index=self.index,
+            body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}},
+        )
+        return previous
+
+    def restore(self, previous):
+        for index, settings in previous.items():
+            self.es.indices.put_settings(index=index, body={"index": settings})
+        self.es.indices.refresh(index=self.index)
+
+    def action(self, msg):
+        """
+        Return the bulk action (NDJSON bytes) of a line, in the workers.
+        """
+        extracted = self.extractor.extract(msg)
+        if extracted is None:
+            return None
+        id, doc = extracted
+        meta = {"index": {"_index": self.index, "_id": id}}
+        return f"{json.dumps(meta)}\n{json.dumps(doc)}\n".encode("utf-8")
+
+    def load(self, paths):
+        scan = Scan(
+            paths,
+            where=self.extractor.where,
+            workers=self.args.workers,
+            chunk_size=self.args.range_size,
+            max_pending=self.queue.maxsize,
+        )
+        # Forks the workers, the threads are started after: forking copies
+        # the locks held by running threads.
+        batches = scan.map(self.action, batched=True)
+        done = Event()
+        senders = [
+            Thread(target=self.send, daemon=True) for _ in range(self.args.senders)
+        ]
+        reporter = Thread(target=self.report, args=(done,), daemon=True)
+        for thread in senders + [reporter]:
+            thread.start()
+        try:
+            for actions in batches:
+                self.queue.put(actions)
+        except BaseException:
+            self.aborted.set()
+            raise
+        finally:
+            for _ in senders:
+                self.queue.put(None)
+            for thread in senders:
+                thread.join()
+            done.set()
+            reporter.join()
+
+    def send(self):
+        """
+        Sender thread: cut the queued actions into chunks and send them.
+        """
+        pending = []
+        finished = False
+        while pending or not finished:
+            docs, size = self.sizer.limits()
+            chunk, chunk_bytes = [], 0
+            while len(chunk) < docs and chunk_bytes < size:
+                if not pending:
+                    if finished:
+                        break
+                    actions = self.queue.get()
+                    if actions is None:
+                        finished = True
+                        continue
+                    # Oldest first, pop() takes from the end.
+                    pending = actions[::-1]
+                    continue
+                action = pending.pop()
+                chunk.append(action)
+                chunk_bytes += len(action)
+            if not chunk:
+                continue
+            if self.aborted.is_set():
+                pending = []
+                continue
+            try:
+                self.bulk(chunk)
+            except Exception as e:
+                logging.exception("Bulk request failed.")
+                with self.lock:
+                    self.errors.append(e)
+                    self.failed += len(chunk)
+
+    def bulk(self, chunk):
+        """
+        Send one chunk, retrying throttled documents with backoff.
+        """
+        for attempt in range(self.args.max_retries + 1):
+            if attempt:
+                time.sleep(min(2 ** (attempt - 1), 60))
+            body = b"".join(chunk)
+            start = time.time()
+            try:
+                response = self.es.bulk(body=body)
+            except TransportError as e:
+                if e.status_code != 429:
+                    raise
+                logging.info(f"Throttled, retrying {len(chunk)} documents.")
+                self.sizer.shrink()
+                continue
+            self.sizer.observe(time.time() - start)
+            throttled, failed = [], 0
+            for action, item in zip(chunk, response["items"]):
+                status = item["index"]["status"]
+                if status == 429:
+                    throttled.append(action)
+                elif status >= 300:
+                    failed += 1
+                    logging.debug(f"Indexing failed: {item}")
+            with self.lock:
+                self.indexed += len(chunk) - len(throttled) - failed
+                self.failed += failed
+                self.sent_bytes += len(body)
+            if not throttled:
+                return
+            self.sizer.shrink()
+            chunk = throttled
+        with self.lock:
+            self.failed += len(chunk)
+        logging.warning(f"Gave up on {len(chunk)} throttled documents.")
+
+    def report(self, done):
+        start = last = time.time()
+        indexed = sent = 0
+        while not done.wait(self.args.report_interval):
+            now = time.time()
+            with self.lock:
+                docs, bytes = self.indexed - indexed, self.sent_bytes - sent
+                indexed, sent = self.indexed, self.sent_bytes
+            docs_limit, bytes_limit = self.sizer.limits()
+            logging.info(
+                f"{indexed} documents in {now - start:.0f} s: "
+                f"{docs / (now - last):,.0f} docs/s, "
+                f"{bytes / (now - last) / (1 << 20):.1f} MB/s "
+                f"(chunks of {docs_limit} docs / {bytes_limit >> 10} KB)."
+            )
+            last = now
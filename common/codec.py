@@ -0,0 +1,102 @@
+"""
+Wire codecs for packets exchanged between pipeline stages.
+
+Every hop encodes and decodes the whole packet, so the codec is on the hot
+path of every stage. Producers pick a codec (stdlib json, orjson or msgpack)
+and tag each message with it in the "codec" message property. Consumers
+decode whatever codec a message was tagged with, defaulting to json for
+untagged messages, so stages can switch codecs one at a time as long as the
+consumers are upgraded before the producers.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CODEC_PROPERTY = "codec"
+DEFAULT_CODEC = "json"
+CODECS = ["json", "orjson", "msgpack"]
+
+
+def _json_dumps(packet):
+    return json.dumps(packet, separators=(",", ":")).encode("utf-8")
+
+
+def _orjson_dumps(packet):
+    # ES ids are ints, json turns dict keys into strings. Keep doing that.
+    return orjson.dumps(packet, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _msgpack_dumps(packet):
+    return msgpack.packb(packet, use_bin_type=True)
+
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+def _dumps(name):
+    return {"json": _json_dumps, "orjson": _orjson_dumps, "msgpack": _msgpack_dumps}[
+        name
+    ]
+
+
+def _loads(name):
+    # json.loads accepts bytes, no need for an intermediate str.
+    return {
+        "json": json.loads,
+        "orjson": orjson.loads if orjson else None,
+        "msgpack": _msgpack_loads,
+    }[name]
+
+
+def available(name):
+    """
+    Return True if the library behind codec name is installed.
+    """
+    return {"json": True, "orjson": orjson is not None, "msgpack": msgpack is not None}[
+        name
+    ]
+
+
+class Codec:
+    """
+    Encoder of outgoing packets.
+    """
+
+    def __init__(self, name=DEFAULT_CODEC):
+        if name not in CODECS:
+            raise ValueError(f"Unknown codec {name}. Choose one of {CODECS}.")
+        if not available(name):
+            raise ValueError(f"Codec {name} requires the {name} package.")
+        self.name = name
+        self.properties = {CODEC_PROPERTY: name}
+        self._dumps = _dumps(name)
+
+    def encode(self, packet):
+        return self._dumps(packet)
+
+
+def decode(data, properties=None):
+    """
+    Decode a packet encoded with the codec named in properties.
+    """
+    name = (properties or {}).get(CODEC_PROPERTY, DEFAULT_CODEC)
+    if name not in CODECS or not available(name):
+        raise ValueError(f"Unable to decode message encoded with codec {name}.")
+    return _loads(name)(data)
+
+
+def decode_message(msg):
+    """
+    Decode the packet carried by a pulsar message.
+    """
+    return decode(msg.data(), msg.properties())
@@ -0,0 +1,113 @@
+"""
+Drop stale suggestion requests.
+
+Clients emit a get-suggestions request on every space, so a user typing a
+sentence sends a burst of requests for the same room where only the latest
+one matters. Every stage of the pipeline keeps a FreshnessFilter that drops
+requests whose deadline (set by the web-server from the client timestamp,
+with --deadline-ms) has passed and, with --drop-superseded, remembers the
+newest sequence_id seen per room and drops requests superseded by it.
+
+Both are off by default: clients sending many independent requests in one
+room (web-client/file-input.py) expect a reply to each of them.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+import logging
+from threading import Lock, Thread
+import time
+
+SUPERSEDED = "superseded"
+EXPIRED = "expired"
+
+# Client clocks can't be trusted blindly. If the client timestamp is further
+# than this from the server clock, the deadline is computed from server time.
+MAX_CLOCK_SKEW = 5.0
+
+
+def set_deadline(packet, budget, now=None):
+    """
+    Set packet["deadline"] to budget seconds after the client sent it.
+    """
+    now = datetime.utcnow().timestamp() if now is None else now
+    sent = packet.get("spans", {}).get("client_send", now)
+    if not isinstance(sent, (int, float)) or abs(now - sent) > MAX_CLOCK_SKEW:
+        sent = now
+    packet["deadline"] = sent + budget
+
+
+class FreshnessFilter:
+    """
+    Per-stage tracker of the newest sequence_id per room.
+
+    Packets are only superseded if supersede is set, and packets without
+    a sequence_id never are. Packets without a deadline never expire.
+    The number of tracked rooms is bounded; the least recently seen rooms
+    are forgotten first.
+    """
+
+    def __init__(self, stage, max_rooms=100_000, supersede=False):
+        self.stage = stage
+        self.max_rooms = max_rooms
+        self.supersede = supersede
+        self.drops = {SUPERSEDED: 0, EXPIRED: 0}
+        self._latest = OrderedDict()
+        self._lock = Lock()
+
+    def observe(self, packet):
+        """
+        Record that packet has been received by this stage.
+        """
+        seq_id = packet.get("sequence_id")
+        if seq_id is None or not self.supersede:
+            return
+        room = packet["room"]
+        with self._lock:
+            if self._latest.get(room, seq_id) <= seq_id:
+                self._latest[room] = seq_id
+            self._latest.move_to_end(room)
+            if len(self._latest) > self.max_rooms:
+                self._latest.popitem(last=False)
+
+    def is_latest(self, packet):
+        seq_id = packet.get("sequence_id")
+        if seq_id is None or not self.supersede:
+            return True
+        with self._lock:
+            return self._latest.get(packet["room"], seq_id) <= seq_id
+
+    def drop_reason(self, packet, now=None):
+        """
+        Return why packet should be dropped (or None to keep it).
+
+        Dropped packets are counted per reason.
+        """
+        reason = None
+        deadline = packet.get("deadline")
+        now = datetime.utcnow().timestamp() if now is None else now
+        if deadline is not None and now > deadline:
+            reason = EXPIRED
+        elif not self.is_latest(packet):
+            reason = SUPERSEDED
+
+        if reason is not None:
+            with self._lock:
+                self.drops[reason] += 1
+            logging.debug(
+                f"{self.stage}: dropping {reason} message "
+                f"{packet.get('sequence_id')} of room {packet.get('room')}"
+            )
+        return reason
+
+    def start_reporting(self, interval):
+        """
+        Log the drop counts every interval seconds from a daemon thread.
+        """
+
+        def report():
+            while True:
+                time.sleep(interval)
+                logging.warning(f"{self.stage}: dropped {self.drops}")
+
+        Thread(target=report, daemon=True).start()
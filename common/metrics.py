@@ -0,0 +1,315 @@
+"""
+Latency histograms, counters and a Prometheus /metrics endpoint.
+
+Every pipeline process records how long messages wait in pulsar, how long
+ES, postgres and (de)serialization take and how long the whole stage takes.
+Histograms use HDR-style log-linear buckets (a few linear sub-buckets per
+power of two) so relative precision is the same from microseconds to
+seconds. Metrics are rendered in the Prometheus text format, either by the
+stand-alone server started with start_metrics_server or by any web framework
+calling REGISTRY.render().
+
+Packets carry named spans (packet["spans"], a dict of name -> utc timestamp)
+instead of a positional list of timestamps. The spans recorded along the
+pipeline are listed in SPANS, in pipeline order.
+"""
+
+from bisect import bisect_left
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+SPANS = [
+    "client_send",  # client sent the request.
+    "server_req",  # web-server received the request.
+    "es_start",  # search stage received the request.
+    "es_end",  # search stage sent the ES results.
+    "pg_start",  # curator received the ES results.
+    "pg_end",  # curator sent the curated suggestions.
+    "server_rsp",  # web-server received the suggestions.
+    "client_rsp",  # client received the suggestions.
+]
+
+SUB_BUCKETS = 4
+MIN_EXPONENT = -17  # ~7.6 us
+MAX_EXPONENT = 6  # 64 s
+
+
+def _hdr_buckets():
+    buckets = []
+    for exponent in range(MIN_EXPONENT, MAX_EXPONENT):
+        low = 2.0 ** exponent
+        step = low / SUB_BUCKETS
+        buckets.extend(low + step * i for i in range(1, SUB_BUCKETS + 1))
+    return buckets
+
+
+BUCKETS = _hdr_buckets()
+
+
+def now():
+    return datetime.utcnow().timestamp()
+
+
+def mark(packet, name, timestamp=None):
+    """
+    Record span name on packet and return its timestamp.
+    """
+    timestamp = now() if timestamp is None else timestamp
+    packet.setdefault("spans", {})[name] = timestamp
+    return timestamp
+
+
+def _format_labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    pairs = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, _format_labels(self.labels), self.value)]
+
+
+class Gauge:
+    """
+    Metric whose value is read from a callback when rendered.
+
+    Used to expose counters that live elsewhere (e.g. cache statistics).
+    """
+
+    def __init__(self, name, labels, read, type="gauge"):
+        self.name = name
+        self.labels = labels
+        self.read = read
+        self.type = type
+
+    def samples(self):
+        return [(self.name, _format_labels(self.labels), self.read())]
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, seconds):
+        i = bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def quantile(self, q):
+        """
+        Return the upper bound of the bucket holding quantile q.
+        """
+        with self._lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+        return float("inf")
+
+    def samples(self):
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        samples = []
+        cumulative = 0
+        for bucket, bucket_count in zip(BUCKETS, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labels, le=f"{bucket:.9g}")
+            samples.append((f"{self.name}_bucket", labels, cumulative))
+        labels = _format_labels(self.labels, le="+Inf")
+        samples.append((f"{self.name}_bucket", labels, count))
+        samples.append((f"{self.name}_sum", _format_labels(self.labels), total))
+        samples.append((f"{self.name}_count", _format_labels(self.labels), count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}  # (name, labels) -> metric
+        self._help = {}
+        self._lock = Lock()
+
+    def _get(self, cls, name, help, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._metrics:
+                self._metrics[key] = cls(name, labels, *args)
+                self._help[name] = help
+            return self._metrics[key]
+
+    def counter(self, name, help, **labels):
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name, help, **labels):
+        return self._get(Histogram, name, help, labels)
+
+    def gauge(self, name, help, read, type="gauge", **labels):
+        return self._get(Gauge, name, help, labels, read, type)
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+            help = dict(self._help)
+        lines = []
+        previous = None
+        for (name, _), metric in metrics:
+            if name != previous:
+                lines.append(f"# HELP {name} {help[name]}")
+                lines.append(f"# TYPE {name} {metric.type}")
+                previous = name
+            for sample, labels, value in metric.samples():
+                lines.append(f"{sample}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class StageMetrics:
+    """
+    Standard set of metrics recorded by every pipeline stage.
+    """
+
+    def __init__(self, stage, registry=REGISTRY):
+        self.stage = stage
+        self.registry = registry
+        self.queue_wait = registry.histogram(
+            "ycm_queue_wait_seconds",
+            "Time between the previous stage sending and this stage receiving.",
+            stage=stage,
+        )
+        self.stage_time = registry.histogram(
+            "ycm_stage_seconds",
+            "Time between receiving and sending a message.",
+            stage=stage,
+        )
+        self.es = registry.histogram(
+            "ycm_es_seconds", "Duration of ES requests.", stage=stage
+        )
+        self.postgres = registry.histogram(
+            "ycm_postgres_seconds", "Duration of postgres queries.", stage=stage
+        )
+        self.encode = registry.histogram(
+            "ycm_serialization_seconds",
+            "Time spent encoding and decoding packets.",
+            stage=stage,
+            op="encode",
+        )
+        self.decode = registry.histogram(
+            "ycm_serialization_seconds",
+            "Time spent encoding and decoding packets.",
+            stage=stage,
+            op="decode",
+        )
+        self.messages = registry.counter(
+            "ycm_messages_total", "Messages processed.", stage=stage
+        )
+
+    def error(self, kind):
+        self.registry.counter(
+            "ycm_errors_total", "Errors by kind.", stage=self.stage, kind=kind
+        ).inc()
+
+    def received(self, packet, previous_span, span, timestamp=None):
+        """
+        Mark span on packet and record the wait since previous_span.
+        """
+        timestamp = mark(packet, span, timestamp)
+        sent = packet["spans"].get(previous_span)
+        if sent is not None:
+            # Spans come from different hosts. Clamp small negative skews.
+            self.queue_wait.observe(max(timestamp - sent, 0.0))
+        return timestamp
+
+    def sent(self, packet, received_span, span):
+        """
+        Mark span on packet and record the stage time since received_span.
+        """
+        timestamp = mark(packet, span)
+        received = packet["spans"].get(received_span)
+        if received is not None:
+            self.stage_time.observe(max(timestamp - received, 0.0))
+        self.messages.inc()
+        return timestamp
+
+    def watch_drops(self, freshness):
+        for reason in freshness.drops:
+            self.registry.gauge(
+                "ycm_dropped_total",
+                "Messages dropped as superseded or expired.",
+                lambda reason=reason: freshness.drops[reason],
+                type="counter",
+                stage=self.stage,
+                reason=reason,
+            )
+
+    def watch_cache(self, cache):
+        for stat in cache.stats:
+            self.registry.gauge(
+                f"ycm_cache_{stat}_total",
+                f"Query cache {stat}.",
+                lambda stat=stat: cache.stats[stat],
+                type="counter",
+                stage=self.stage,
+            )
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host="127.0.0.1", registry=REGISTRY):
+    """
+    Serve registry on http://host:port/metrics from a daemon thread.
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
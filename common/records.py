@@ -0,0 +1,9 @@
+"""
+Cleaning rules of the stackexchange records, shared by the loaders.
+"""
+
+
+# Data cleaning: Consolidate rules to blacklist in a single function.
+def blacklist_message(msg):
+    if msg.get("type", "").lower() != "question":
+        return True
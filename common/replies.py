@@ -0,0 +1,20 @@
+"""
+Routing of suggestions back to the web-server that asked for them.
+"""
+
+
+def reply_producer(client, producers, packet, out_topic):
+    """
+    Return the producer of the topic the packet's web-server listens on.
+
+    Web-servers name their own reply topic (out_topic-<instance id>) in
+    packet["reply_to"]. Packets without one (or with a topic that is not a
+    reply topic of out_topic) go to out_topic. Producers are created once
+    per topic and kept in producers.
+    """
+    topic = packet.get("reply_to", out_topic)
+    if not topic.startswith(f"{out_topic}-"):
+        topic = out_topic
+    if topic not in producers:
+        producers[topic] = client.create_producer(topic)
+    return producers[topic]
@@ -0,0 +1,328 @@
+"""
+Pulsar clients, producers and consumers tuned by named profiles.
+
+Stages create their pulsar client with connect and then use it like a
+pulsar.Client (subscribe, create_producer). The profile decides how the
+client, its producers and its consumers trade latency for throughput:
+
+- low-latency: every message is sent on its own, uncompressed, and acked
+  as soon as it is processed.
+- high-throughput: producers batch messages for up to a few ms (batches
+  are built per key, so Key_Shared consumers still see every message of a
+  room), payloads are LZ4 compressed, consumers prefetch more messages and
+  acks are sent in groups.
+
+Messages are acked after they are processed, never before: a stage that
+dies mid-batch has its messages redelivered. Exclusive and failover
+subscriptions ack a group with one cumulative ack, shared ones ack each
+message of the group. Pending acks are flushed after ack_delay_ms even if
+no further message arrives.
+
+The profile is picked with --pulsar-profile (or PULSAR_PROFILE) and the
+compression can be overridden with --pulsar-compression (or
+PULSAR_COMPRESSION). start_reporting logs the messages and bytes sent and
+received per second, to compare profiles on the same load.
+
+stop makes the consumers raise Stopped instead of waiting for the next
+message, so a worker finishes the message it holds and exits. close then
+flushes the pending acks and the messages not yet sent.
+"""
+
+import logging
+import os
+from threading import Event, Lock, Thread
+import time
+
+import pulsar
+from pulsar import ConsumerType, Timeout
+
+DEFAULT_PROFILE = "low-latency"
+
+PROFILES = {
+    "low-latency": {
+        "io_threads": 1,
+        "connection_timeout_ms": 10000,
+        "batching": False,
+        "batching_max_publish_delay_ms": 0,
+        "batching_max_messages": 1,
+        "batching_max_bytes": 0,
+        "compression": "none",
+        "receiver_queue_size": 1000,
+        "ack_batch": 1,
+        "ack_delay_ms": 0,
+    },
+    "high-throughput": {
+        "io_threads": 4,
+        "connection_timeout_ms": 10000,
+        "batching": True,
+        "batching_max_publish_delay_ms": 5,
+        "batching_max_messages": 1000,
+        "batching_max_bytes": 128 << 10,
+        "compression": "lz4",
+        "receiver_queue_size": 5000,
+        "ack_batch": 100,
+        "ack_delay_ms": 100,
+    },
+}
+
+# Compression name -> pulsar.CompressionType member.
+COMPRESSION_TYPES = {
+    "none": "NONE",
+    "lz4": "LZ4",
+    "zstd": "ZSTD",
+    "zlib": "ZLib",
+    "snappy": "SNAPPY",
+}
+COMPRESSIONS = list(COMPRESSION_TYPES)
+
+# Longest a receive blocks before checking whether the runtime was stopped.
+POLL_INTERVAL = 0.2
+
+# Subscriptions with a single active consumer, where cumulative acks apply.
+_CUMULATIVE = {ConsumerType.Exclusive, ConsumerType.Failover}
+
+
+class Stopped(Exception):
+    """
+    Raised by Consumer.receive once the runtime is stopped.
+    """
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--pulsar-profile",
+        help="Pulsar performance profile.",
+        default=os.getenv("PULSAR_PROFILE", DEFAULT_PROFILE),
+        choices=list(PROFILES),
+    )
+    parser.add_argument(
+        "--pulsar-compression",
+        help="Compression of produced messages. Defaults to the profile's.",
+        default=os.getenv("PULSAR_COMPRESSION"),
+        choices=COMPRESSIONS,
+    )
+
+
+def profile_settings(name, compression=None):
+    """
+    Return the settings of profile name, with compression overridden.
+    """
+    if name not in PROFILES:
+        raise ValueError(
+            f"Unknown pulsar profile {name}. Choose one of {list(PROFILES)}."
+        )
+    settings = dict(PROFILES[name])
+    if compression:
+        if compression not in COMPRESSIONS:
+            raise ValueError(
+                f"Unknown compression {compression}. Choose one of {COMPRESSIONS}."
+            )
+        settings["compression"] = compression
+    return settings
+
+
+def connect(url, profile=DEFAULT_PROFILE, compression=None):
+    """
+    Return a Runtime over a pulsar client configured by profile.
+    """
+    settings = profile_settings(profile, compression)
+    client = pulsar.Client(
+        url,
+        io_threads=settings["io_threads"],
+        connection_timeout_ms=settings["connection_timeout_ms"],
+    )
+    return Runtime(client, profile, compression)
+
+
+class Runtime:
+    """
+    pulsar.Client look-alike applying a profile to producers and consumers.
+    """
+
+    def __init__(self, client, profile=DEFAULT_PROFILE, compression=None):
+        self.client = client
+        self.profile = profile
+        self.settings = profile_settings(profile, compression)
+        self.stats = {"received": 0, "received_bytes": 0, "sent": 0, "sent_bytes": 0}
+        self.stopped = Event()
+        self.consumers = []
+        self.producers = []
+        self._lock = Lock()
+
+    def count(self, direction, data):
+        with self._lock:
+            self.stats[direction] += 1
+            self.stats[f"{direction}_bytes"] += len(data)
+
+    def create_producer(self, topic):
+        settings = self.settings
+        kwargs = {
+            "batching_enabled": settings["batching"],
+            "compression_type": getattr(
+                pulsar.CompressionType, COMPRESSION_TYPES[settings["compression"]]
+            ),
+            "block_if_queue_full": True,
+        }
+        if settings["batching"]:
+            kwargs.update(
+                batching_max_publish_delay_ms=settings["batching_max_publish_delay_ms"],
+                batching_max_messages=settings["batching_max_messages"],
+                batching_max_allowed_size_in_bytes=settings["batching_max_bytes"],
+            )
+            if hasattr(pulsar, "BatchingType"):
+                # Key_Shared consumers get whole batches, keep keys apart.
+                kwargs["batching_type"] = pulsar.BatchingType.KeyBased
+        producer = Producer(self, self.client.create_producer(topic, **kwargs))
+        self.producers.append(producer)
+        return producer
+
+    def subscribe(self, topic, subscription_name, consumer_type=ConsumerType.Shared):
+        consumer = self.client.subscribe(
+            topic,
+            subscription_name,
+            consumer_type=consumer_type,
+            receiver_queue_size=self.settings["receiver_queue_size"],
+        )
+        consumer = Consumer(self, consumer, consumer_type in _CUMULATIVE)
+        self.consumers.append(consumer)
+        return consumer
+
+    def stop(self):
+        """
+        Make receive raise Stopped, safe to call from a signal handler.
+        """
+        self.stopped.set()
+
+    def close(self):
+        for consumer in self.consumers:
+            consumer.flush()
+        for producer in self.producers:
+            producer.flush()
+        self.client.close()
+
+    def start_reporting(self, interval, stage):
+        """
+        Log message and byte rates every interval seconds from a daemon thread.
+        """
+
+        def report():
+            last = dict(self.stats)
+            while True:
+                time.sleep(interval)
+                with self._lock:
+                    current = dict(self.stats)
+                rates = {k: (current[k] - last[k]) / interval for k in current}
+                last = current
+                logging.warning(
+                    f"{stage} [{self.profile}]: "
+                    f"received {rates['received']:,.0f} msg/s "
+                    f"({rates['received_bytes'] / 1024:,.1f} KB/s), "
+                    f"sent {rates['sent']:,.0f} msg/s "
+                    f"({rates['sent_bytes'] / 1024:,.1f} KB/s)"
+                )
+
+        Thread(target=report, daemon=True).start()
+
+
+class Producer:
+    def __init__(self, runtime, producer):
+        self.runtime = runtime
+        self.producer = producer
+
+    def send(self, content, **kwargs):
+        self.runtime.count("sent", content)
+        return self.producer.send(content, **kwargs)
+
+    def send_async(self, content, callback, **kwargs):
+        self.runtime.count("sent", content)
+        self.producer.send_async(content, callback, **kwargs)
+
+    def flush(self):
+        self.producer.flush()
+
+    def close(self):
+        self.producer.close()
+
+
+class Consumer:
+    """
+    Consumer acking processed messages in groups of the profile's ack_batch.
+    """
+
+    def __init__(self, runtime, consumer, cumulative):
+        self.runtime = runtime
+        self.consumer = consumer
+        self.cumulative = cumulative
+        self.ack_batch = runtime.settings["ack_batch"]
+        self.ack_delay = runtime.settings["ack_delay_ms"] / 1000
+        self.pending = []
+        self.oldest = None
+        # Async workers receive on an executor thread and ack on the loop.
+        self._lock = Lock()
+
+    def _receive(self, timeout_millis):
+        msg = self.consumer.receive(timeout_millis=timeout_millis)
+        self.runtime.count("received", msg.data())
+        return msg
+
+    def receive(self, timeout_millis=None):
+        """
+        Receive a message, raises Stopped once the runtime is stopped.
+
+        Pending acks are flushed if no message arrives before they are due.
+        """
+        deadline = None
+        if timeout_millis is not None:
+            deadline = time.monotonic() + timeout_millis / 1000
+        while True:
+            if self.runtime.stopped.is_set():
+                raise Stopped()
+            now = time.monotonic()
+            wait = POLL_INTERVAL
+            if self.pending:
+                wait = min(wait, self.oldest + self.ack_delay - now)
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            try:
+                return self._receive(max(int(wait * 1000), 1))
+            except Timeout:
+                if self.pending and time.monotonic() - self.oldest >= self.ack_delay:
+                    self.flush()
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+
+    def acknowledge(self, msg):
+        """
+        Ack msg once processed, in a group with the following ones.
+        """
+        with self._lock:
+            if not self.pending:
+                self.oldest = time.monotonic()
+            self.pending.append(msg)
+            due = (
+                len(self.pending) >= self.ack_batch
+                or time.monotonic() - self.oldest >= self.ack_delay
+            )
+        if due:
+            self.flush()
+
+    def negative_acknowledge(self, msg):
+        """
+        Have pulsar redeliver msg, its processing failed.
+        """
+        self.consumer.negative_acknowledge(msg)
+
+    def flush(self):
+        with self._lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        if self.cumulative:
+            self.consumer.acknowledge_cumulative(pending[-1])
+        else:
+            for msg in pending:
+                self.consumer.acknowledge(msg)
+
+    def close(self):
+        self.flush()
+        self.consumer.close()
@@ -0,0 +1,231 @@
+"""
+Parallel scans of NDJSON dumps.
+
+A Scan memory-maps its files and splits them into chunks at newline aligned
+byte offsets. Worker processes parse the chunks and hand back records, or
+fold them into one aggregate per chunk (like Spark's RDD.aggregate):
+
+    counts = Scan(path, fields=["subreddit"]).count_by("subreddit")
+
+    scan = Scan(path, where={"type": "question"}, fields=["site", "title"])
+    for batch in scan.map(lambda record: record["title"], batched=True):
+        ...
+
+where is pushed down below the JSON decode: a line that does not contain
+every (string) value quoted is rejected by a substring search and only the
+remaining lines are decoded and compared. filter is any predicate on the
+decoded record. fields projects the records, only those keys go back to the
+calling process.
+
+Workers are forked for every map or aggregate, so the functions passed to a
+scan may be lambdas or closures. At most max_pending chunks are parsed
+ahead of the consumer, a slow consumer does not fill up memory.
+"""
+
+from collections import Counter
+import copy
+import json
+import logging
+import mmap
+from multiprocessing import get_context
+import os
+import re
+from threading import BoundedSemaphore, Event
+
+CHUNK_SIZE = 64 << 20
+# Values that appear verbatim in any JSON encoding of a line. Others (escaped
+# characters, non ASCII text) are only compared after the decode.
+PUSHDOWN = re.compile(r"[\w .:+#-]*", re.ASCII)
+
+# Set in each worker by _init_worker.
+_scan = None
+_maps = {}
+
+
+def split(path, chunk_size):
+    """
+    Return the (start, end) byte ranges of path, cut after newlines.
+    """
+    size = os.path.getsize(path)
+    if not size:
+        return []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        ranges = []
+        start = 0
+        while start < size:
+            end = m.find(b"\n", min(start + chunk_size, size) - 1) + 1 or size
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _init_worker(scan):
+    global _scan
+    _scan = scan
+
+
+def _lines(path, start, end):
+    if path not in _maps:
+        with open(path, "rb") as f:
+            _maps[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return _maps[path][start:end].splitlines()
+
+
+def _scan_chunk(task):
+    """
+    Worker: return the mapped records, or their aggregate, of a chunk.
+    """
+    path, start, end = task
+    records = _scan.records(_lines(path, start, end))
+    if _scan.aggregation is None:
+        return list(records)
+    zero, seq_op, _ = _scan.aggregation
+    acc = copy.deepcopy(zero)
+    for record in records:
+        acc = seq_op(acc, record)
+    return acc
+
+
+class Scan:
+    """
+    Parallel scan of NDJSON files, see the module docstring.
+    """
+
+    def __init__(
+        self,
+        paths,
+        fields=None,
+        where=None,
+        filter=None,
+        workers=None,
+        chunk_size=CHUNK_SIZE,
+        max_pending=None,
+    ):
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self.fields = fields
+        self.where = where or {}
+        self.filter = filter
+        self.workers = workers or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending or 2 * self.workers
+        # Raw needles of where, one of them missing rejects a line.
+        self.needles = [
+            f'"{value}"'.encode("ascii")
+            for value in self.where.values()
+            if isinstance(value, str) and PUSHDOWN.fullmatch(value)
+        ]
+        self.mapper = None
+        self.aggregation = None
+
+    def chunks(self):
+        return [
+            (path, start, end)
+            for path in self.paths
+            for start, end in split(path, self.chunk_size)
+        ]
+
+    def records(self, lines):
+        """
+        Yield the (mapped) records of lines that pass where and filter.
+        """
+        for line in lines:
+            if not all(needle in line for needle in self.needles):
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logging.debug(f"Malformed JSON: {line}")
+                continue
+            if any(record.get(k) != v for k, v in self.where.items()):
+                continue
+            if self.filter is not None and not self.filter(record):
+                continue
+            if self.fields is not None:
+                record = {k: record.get(k) for k in self.fields}
+            if self.mapper is not None:
+                record = self.mapper(record)
+                if record is None:
+                    continue
+            yield record
+
+    def _start(self, mapper=None, aggregation=None):
+        """
+        Fork the workers and return the iterator of chunk results, in the
+        order the chunks complete.
+        """
+        # The workers get a copy of the scan, mapper and aggregation
+        # included, when they are forked.
+        self.mapper = mapper
+        self.aggregation = aggregation
+        pool = get_context("fork").Pool(
+            self.workers, initializer=_init_worker, initargs=(self,)
+        )
+        slots = BoundedSemaphore(self.max_pending)
+        # Set when the results stop being consumed (done, failed or closed
+        # early). The pool's task handler, reading tasks(), must then
+        # return or terminating the pool hangs.
+        stopped = Event()
+
+        def tasks():
+            for task in self.chunks():
+                while not slots.acquire(timeout=0.1):
+                    if stopped.is_set():
+                        return
+                yield task
+
+        def results():
+            try:
+                for result in pool.imap_unordered(_scan_chunk, tasks()):
+                    slots.release()
+                    yield result
+            finally:
+                stopped.set()
+                pool.terminate()
+
+        return results()
+
+    def map(self, fn=None, batched=False):
+        """
+        Return an iterator of fn(record) of the matching records, skipping
+        None results. batched iterates over a list per chunk instead.
+
+        The workers are forked by this call, before the first record is
+        read, so start threads after it.
+        """
+        results = self._start(mapper=fn)
+        if batched:
+            return results
+
+        def records():
+            try:
+                for batch in results:
+                    yield from batch
+            finally:
+                results.close()
+
+        return records()
+
+    def aggregate(self, zero, seq_op, comb_op):
+        """
+        Fold the records of each chunk into a copy of zero with seq_op and
+        combine the chunks with comb_op.
+        """
+        result = copy.deepcopy(zero)
+        for acc in self._start(aggregation=(zero, seq_op, comb_op)):
+            result = comb_op(result, acc)
+        return result
+
+    def count(self):
+        return self.aggregate(0, lambda n, _: n + 1, lambda a, b: a + b)
+
+    def count_by(self, key):
+        """
+        Return a Counter of records by key, a field name or a function.
+        """
+        get = key if callable(key) else lambda record: record.get(key)
+
+        def add(counter, record):
+            counter[get(record)] += 1
+            return counter
+
+        return self.aggregate(Counter(), add, lambda a, b: a + b)
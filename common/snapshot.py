@@ -0,0 +1,197 @@
+"""
+Memory-mapped snapshot of question metadata.
+
+The curator needs (answer_count, link) for the handful of questions returned
+by ES for every message. Instead of a postgres round-trip per message, the
+batch pipeline exports the questions table into a read-only binary file that
+every curator process maps into memory. The file is shared between processes
+through the page cache and opening it costs the same regardless of its size.
+
+File layout (native little-endian, sections aligned to 8 bytes):
+
+    header        magic, version, number of records and section offsets
+    keys          uint64 per question: site index << 40 | question id,
+                  sorted ascending so lookups can binary search
+    answer_count  int32 per question
+    score         int32 per question
+    link offsets  uint64 per question + 1, offsets into the links blob
+    links         utf-8 encoded links, concatenated
+    sites         JSON list of site names, position = site index
+"""
+
+from array import array
+from bisect import bisect_left
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from threading import Lock
+import time
+
+MAGIC = b"YCMQ"
+VERSION = 1
+HEADER = struct.Struct("<4sIQQQQQQQ")
+ID_BITS = 40
+MAX_ID = (1 << ID_BITS) - 1
+
+if sys.byteorder != "little":
+    raise ImportError("Question snapshots are only supported on little-endian hosts.")
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def write_snapshot(path, rows):
+    """
+    Write a snapshot of rows to path.
+
+    rows is an iterable of (site, id, answer_count, score, link) tuples
+    sorted by (site, id). The snapshot is written to a temporary file and
+    atomically renamed, so readers never see a partially written file.
+    Returns the number of questions written.
+    """
+    sites = []
+    site_set = set()
+    keys = array("Q")
+    answer_counts = array("i")
+    scores = array("i")
+    link_offsets = array("Q", [0])
+    links = bytearray()
+
+    for site, id, answer_count, score, link in rows:
+        if not sites or sites[-1] != site:
+            if site in site_set:
+                raise ValueError(f"Snapshot rows of site {site} are not contiguous.")
+            sites.append(site)
+            site_set.add(site)
+        if id > MAX_ID:
+            raise ValueError(f"Question id {id} does not fit in {ID_BITS} bits.")
+        key = (len(sites) - 1) << ID_BITS | id
+        if keys and key <= keys[-1]:
+            raise ValueError("Snapshot rows must be unique and sorted by (site, id).")
+        keys.append(key)
+        answer_counts.append(answer_count or 0)
+        scores.append(score or 0)
+        links += (link or "").encode("utf-8")
+        link_offsets.append(len(links))
+
+    sections = [keys, answer_counts, scores, link_offsets, links]
+    offsets = []
+    offset = HEADER.size
+    for section in sections:
+        offset = _align(offset)
+        offsets.append(offset)
+        offset += len(section) * getattr(section, "itemsize", 1)
+    sites_offset = _align(offset)
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(keys), *offsets, sites_offset))
+        for offset, section in zip(offsets + [sites_offset], sections + [None]):
+            f.write(b"\0" * (offset - f.tell()))
+            if section is None:
+                f.write(json.dumps(sites).encode("utf-8"))
+            elif isinstance(section, array):
+                section.tofile(f)
+            else:
+                f.write(section)
+    os.replace(tmp_path, path)
+    return len(keys)
+
+
+class QuestionSnapshot:
+    """
+    Read-only view of a snapshot file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, n, *offsets, sites_offset = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} question snapshot.")
+        (
+            keys_offset,
+            answers_offset,
+            scores_offset,
+            link_offsets_offset,
+            links_offset,
+        ) = offsets
+        view = memoryview(self._mmap)
+        self._keys = view[keys_offset : keys_offset + 8 * n].cast("Q")
+        self._answer_counts = view[answers_offset : answers_offset + 4 * n].cast("i")
+        self._scores = view[scores_offset : scores_offset + 4 * n].cast("i")
+        self._link_offsets = view[
+            link_offsets_offset : link_offsets_offset + 8 * (n + 1)
+        ].cast("Q")
+        self._links_offset = links_offset
+        sites = json.loads(bytes(view[sites_offset:]).decode("utf-8"))
+        self.sites = {site: i for i, site in enumerate(sites)}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def lookup(self, site, id):
+        """
+        Return (answer_count, score, link) for a question or None.
+        """
+        site_index = self.sites.get(site)
+        if site_index is None or not 0 <= id <= MAX_ID:
+            return None
+        key = site_index << ID_BITS | id
+        i = bisect_left(self._keys, key)
+        if i == len(self._keys) or self._keys[i] != key:
+            return None
+        start = self._links_offset + self._link_offsets[i]
+        end = self._links_offset + self._link_offsets[i + 1]
+        link = self._mmap[start:end].decode("utf-8")
+        return self._answer_counts[i], self._scores[i], link
+
+
+class ReloadingSnapshot:
+    """
+    Snapshot that picks up a new file swapped in at path.
+
+    The file is checked at most once every check_interval seconds. The
+    previous mapping stays valid until the new one has been loaded, so the
+    exporter can replace the file while curators are running.
+    """
+
+    def __init__(self, path, check_interval=30.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.current = QuestionSnapshot(path)
+        self._checked_at = time.monotonic()
+        self._lock = Lock()
+
+    def get(self):
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval:
+            with self._lock:
+                self._checked_at = now
+                self._maybe_reload()
+        return self.current
+
+    def _maybe_reload(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            logging.warning(f"Snapshot {self.path} is missing. Keeping old snapshot.")
+            return
+        old = self.current.stat
+        if (stat.st_ino, stat.st_mtime_ns) == (old.st_ino, old.st_mtime_ns):
+            return
+        try:
+            self.current = QuestionSnapshot(self.path)
+        except (OSError, ValueError):
+            logging.exception(f"Unable to load snapshot {self.path}.")
+        else:
+            logging.warning(
+                f"Loaded snapshot {self.path} with {len(self.current)} questions."
+            )
@@ -0,0 +1,252 @@
+"""
+Pre-forking supervisor of the consumers of a stage.
+
+A stage loads its read-only state (question snapshot, local indexes,
+routing table) once and hands a worker function to a Supervisor, which
+forks --workers processes running it. The workers share the pages of that
+state with the supervisor until one of them writes to it (copy-on-write),
+N workers cost about as much memory as one. Sockets and threads do not
+survive a fork: pulsar, ES and postgres clients, sqlite connections and
+reporting threads are created by the worker function.
+
+The supervisor:
+
+- pins worker i to the i-th CPU it may run on with --pin-cpus,
+- restarts workers that exit without being asked to, backing off while
+  they keep dying right after their start,
+- on SIGTERM (or SIGINT), forwards SIGTERM to the workers and gives them
+  --drain-timeout seconds to finish the messages they hold before killing
+  them,
+- logs the messages and bytes received and sent per second by the stage
+  and by each worker, from counters the workers publish in shared memory.
+
+Worker functions take a Worker. They register a callback telling them to
+drain with worker.on_stop (runtime.Runtime.stop fits) and publish their
+counts with worker.watch(client), client being a runtime.Runtime.
+"""
+
+import logging
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+import os
+import signal
+from threading import Thread
+import time
+
+# Counters published by every worker, keys of runtime.Runtime.stats.
+FIELDS = ["received", "received_bytes", "sent", "sent_bytes"]
+# Workers dying within MIN_UPTIME seconds of their start are restarted
+# after a delay doubling up to MAX_BACKOFF seconds.
+MIN_UPTIME = 10.0
+MAX_BACKOFF = 60.0
+PUBLISH_INTERVAL = 1.0
+
+_context = get_context("fork")
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--workers",
+        help="Worker processes. Defaults to the number of CPUs.",
+        default=os.cpu_count(),
+        type=int,
+    )
+    parser.add_argument(
+        "--pin-cpus", help="Pin every worker to its own CPU.", action="store_true"
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        help="Seconds workers get to finish their messages on SIGTERM.",
+        default=30.0,
+        type=float,
+    )
+
+
+class Worker:
+    """
+    The worker process a worker function runs in.
+    """
+
+    def __init__(self, index, counters):
+        self.index = index
+        self.counters = counters
+        self.stopping = False
+        self._on_stop = []
+
+    def on_stop(self, callback):
+        """
+        Call callback (without arguments) when the worker has to drain.
+        """
+        self._on_stop.append(callback)
+        if self.stopping:
+            callback()
+
+    def stop(self, *_):
+        # SIGTERM handler.
+        self.stopping = True
+        for callback in self._on_stop:
+            callback()
+
+    def watch(self, client):
+        """
+        Publish the message counts of client to the supervisor.
+        """
+        offset = self.index * len(FIELDS)
+
+        def publish():
+            while True:
+                stats = dict(client.stats)
+                for i, field in enumerate(FIELDS):
+                    self.counters[offset + i] = stats[field]
+                time.sleep(PUBLISH_INTERVAL)
+
+        Thread(target=publish, daemon=True).start()
+
+
+class Supervisor:
+    """
+    Fork and supervise the workers of stage, see the module docstring.
+    """
+
+    def __init__(
+        self,
+        stage,
+        target,
+        workers=None,
+        pin_cpus=False,
+        drain_timeout=30.0,
+        stats_interval=60.0,
+    ):
+        if workers is not None and workers < 1:
+            raise ValueError("--workers must be at least 1.")
+        self.stage = stage
+        self.target = target
+        self.workers = workers or os.cpu_count()
+        self.cpus = None
+        if pin_cpus:
+            if not hasattr(os, "sched_setaffinity"):
+                raise ValueError("--pin-cpus is only supported on Linux.")
+            self.cpus = sorted(os.sched_getaffinity(0))
+        self.drain_timeout = drain_timeout
+        self.stats_interval = stats_interval
+        # Written by the workers only, one slot each, no lock needed.
+        self.counters = _context.Array("q", self.workers * len(FIELDS), lock=False)
+        self.processes = [None] * self.workers
+        self.started = [0.0] * self.workers
+        self.crashes = [0] * self.workers
+        self.restart_at = {}
+        self.stopping = False
+
+    def run(self):
+        """
+        Fork the workers and supervise them until SIGTERM or SIGINT.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.workers):
+            self.start(index)
+        logging.warning(f"{self.stage}: started {self.workers} workers.")
+
+        last, reported_at = list(self.counters), time.monotonic()
+        while not self.stopping:
+            wait([p.sentinel for p in self.processes if p is not None], timeout=1.0)
+            if self.stopping:
+                break
+            self.check()
+            now = time.monotonic()
+            if now - reported_at >= self.stats_interval:
+                current = list(self.counters)
+                self.report(current, last, now - reported_at)
+                last, reported_at = current, now
+        self.drain()
+
+    def stop(self, *_):
+        # SIGTERM and SIGINT handler.
+        self.stopping = True
+
+    def start(self, index):
+        offset = index * len(FIELDS)
+        for i in range(len(FIELDS)):
+            self.counters[offset + i] = 0
+        process = _context.Process(
+            target=self.run_worker, args=(index,), name=f"{self.stage}-{index}"
+        )
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+
+    def run_worker(self, index):
+        """
+        Entry point of the forked worker index.
+        """
+        # Ctrl-C reaches every process of the group, let the supervisor
+        # drain the workers instead.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        worker = Worker(index, self.counters)
+        signal.signal(signal.SIGTERM, worker.stop)
+        if self.cpus:
+            os.sched_setaffinity(0, {self.cpus[index % len(self.cpus)]})
+        self.target(worker)
+
+    def check(self):
+        """
+        Schedule the restart of dead workers and restart those due.
+        """
+        now = time.monotonic()
+        for index, process in enumerate(self.processes):
+            if process is None or process.is_alive():
+                continue
+            process.join()
+            self.processes[index] = None
+            if now - self.started[index] < MIN_UPTIME:
+                self.crashes[index] += 1
+            else:
+                self.crashes[index] = 0
+            delay = 0.0
+            if self.crashes[index]:
+                delay = min(2 ** (self.crashes[index] - 1), MAX_BACKOFF)
+            logging.error(
+                f"{self.stage}: worker {index} exited with code {process.exitcode}, "
+                f"restarting it in {delay:.0f} s."
+            )
+            self.restart_at[index] = now + delay
+        for index, at in list(self.restart_at.items()):
+            if at <= now:
+                del self.restart_at[index]
+                self.start(index)
+
+    def drain(self):
+        """
+        SIGTERM the workers and kill those still running after drain_timeout.
+        """
+        running = [p for p in self.processes if p is not None and p.is_alive()]
+        logging.warning(f"{self.stage}: draining {len(running)} workers.")
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + self.drain_timeout
+        for process in running:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logging.error(f"{self.stage}: killing {process.name}, still draining.")
+                process.kill()
+                process.join()
+
+    def report(self, current, last, elapsed):
+        # Restarted workers start from zero again.
+        rates = [max(c - l, 0) / elapsed for c, l in zip(current, last)]
+        per_worker = [
+            rates[offset : offset + len(FIELDS)]
+            for offset in range(0, len(rates), len(FIELDS))
+        ]
+        received, received_bytes, sent, sent_bytes = (
+            sum(rates[i :: len(FIELDS)]) for i in range(len(FIELDS))
+        )
+        logging.warning(
+            f"{self.stage}: received {received:,.0f} msg/s "
+            f"({received_bytes / 1024:,.1f} KB/s), sent {sent:,.0f} msg/s "
+            f"({sent_bytes / 1024:,.1f} KB/s); per worker received/sent msg/s: "
+            + ", ".join(
+                f"{index}: {worker[0]:,.0f}/{worker[2]:,.0f}"
+                for index, worker in enumerate(per_worker)
+            )
+        )
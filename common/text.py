@@ -0,0 +1,15 @@
+"""
+Tokenization shared by the local search indexes.
+"""
+
+import re
+
+TAGS = re.compile(r"<[^>]+>")
+TOKENS = re.compile(r"[a-z0-9][a-z0-9+#]*")
+
+
+def tokenize(text):
+    """
+    Lower case terms of text, ignoring html tags.
+    """
+    return TOKENS.findall(TAGS.sub(" ", text).lower())
@@ -0,0 +1,280 @@
+"""
+Dense question vectors and a per-site approximate nearest neighbour index.
+
+Questions (title and body) are turned into hashed TF-IDF vectors and
+projected onto a few hundred latent dimensions learned with a truncated SVD
+(latent semantic analysis), all with numpy on the CPU. Queries are encoded
+the same way, so the cosine similarity of a query and a question reflects
+shared topics rather than exact terms.
+
+The index is a directory built by batch-pipeline/build-vector-index.py:
+
+    model.json          n_features, dims and the list of sites
+    idf.npy             float32[n_features], inverse document frequencies
+    projection.npy      float32[n_features, dims], maps TF-IDF to vectors
+    sites/<site>/       one inverted file (IVF) index per site:
+        centroids.npy   float32[lists, dims], spherical k-means centroids
+        offsets.npy     int64[lists + 1], vectors of list i are rows
+                        offsets[i]:offsets[i + 1]
+        vectors.npy     float32[questions, dims], unit length, grouped by list
+        ids.npy         int64[questions], question id of every row
+        titles.bin      utf-8 titles, concatenated
+        title_offsets.npy  int64[questions + 1], offsets into titles.bin
+
+Every array is memory-mapped, so search workers on the same host share one
+copy through the page cache. A query scores the centroids, then only the
+vectors of its nprobe closest lists.
+"""
+
+import json
+import logging
+import os
+import re
+import zlib
+
+import numpy as np
+
+from text import tokenize
+
+MODEL = "model.json"
+
+
+def hash_terms(text, n_features):
+    """
+    Return (columns, counts) of the hashed terms of text.
+    """
+    columns = np.fromiter(
+        (zlib.crc32(term.encode("utf-8")) % n_features for term in tokenize(text)),
+        dtype=np.int64,
+    )
+    return np.unique(columns, return_counts=True)
+
+
+def tfidf_rows(texts, idf):
+    """
+    Return the unit length TF-IDF rows of texts in CSR form.
+
+    Returns (indptr, columns, weights). Term frequencies are dampened
+    (1 + log tf) so a long body does not drown its title.
+    """
+    n_features = len(idf)
+    indptr = [0]
+    columns = []
+    weights = []
+    for text in texts:
+        cols, counts = hash_terms(text, n_features)
+        w = (1 + np.log(counts)) * idf[cols]
+        norm = np.sqrt(np.dot(w, w))
+        columns.append(cols)
+        weights.append(w / norm if norm else w)
+        indptr.append(indptr[-1] + len(cols))
+    if not columns:
+        return np.zeros(1, np.int64), np.zeros(0, np.int64), np.zeros(0, np.float32)
+    return (
+        np.asarray(indptr, dtype=np.int64),
+        np.concatenate(columns),
+        np.concatenate(weights).astype(np.float32),
+    )
+
+
+def csr_dot(indptr, columns, weights, dense, chunk_rows=4096):
+    """
+    Multiply a CSR matrix by a dense matrix, chunk_rows rows at a time.
+    """
+    n_rows = len(indptr) - 1
+    out = np.zeros((n_rows, dense.shape[1]), dtype=np.float32)
+    for start in range(0, n_rows, chunk_rows):
+        end = min(start + chunk_rows, n_rows)
+        low, high = indptr[start], indptr[end]
+        if low == high:
+            continue
+        products = weights[low:high, None] * dense[columns[low:high]]
+        # reduceat can't sum empty rows, leave those at zero.
+        nonempty = np.diff(indptr[start : end + 1]) > 0
+        starts = indptr[start:end][nonempty] - low
+        out[start:end][nonempty] = np.add.reduceat(products, starts, axis=0)
+    return out
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _site_dir(path, site):
+    # Site names come from the data, keep them inside the index directory.
+    return os.path.join(path, "sites", re.sub(r"[^\w.-]", "_", site))
+
+
+def write_model(path, idf, projection, sites):
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "idf.npy"), idf.astype(np.float32))
+    np.save(os.path.join(path, "projection.npy"), projection.astype(np.float32))
+    with open(os.path.join(path, MODEL), "w") as f:
+        json.dump(
+            {
+                "n_features": len(idf),
+                "dims": projection.shape[1],
+                "sites": sorted(sites),
+            },
+            f,
+        )
+
+
+def write_site_index(path, site, vectors, ids, titles, centroids, lists):
+    """
+    Write the IVF index of one site.
+
+    vectors, ids and titles describe the questions of the site, lists is
+    the centroid each question was assigned to.
+    """
+    site_dir = _site_dir(path, site)
+    os.makedirs(site_dir, exist_ok=True)
+    order = np.argsort(lists, kind="stable")
+    offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(lists, minlength=len(centroids)))
+    encoded = [titles[i].encode("utf-8") for i in order]
+    title_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    title_offsets[1:] = np.cumsum([len(title) for title in encoded])
+
+    np.save(os.path.join(site_dir, "centroids.npy"), centroids.astype(np.float32))
+    np.save(os.path.join(site_dir, "offsets.npy"), offsets)
+    # vectors may be a memory map larger than RAM, reorder it in chunks.
+    out = np.lib.format.open_memmap(
+        os.path.join(site_dir, "vectors.npy"),
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(order), vectors.shape[1]),
+    )
+    for start in range(0, len(order), 65536):
+        out[start : start + 65536] = vectors[order[start : start + 65536]]
+    out.flush()
+    del out
+    np.save(os.path.join(site_dir, "ids.npy"), np.asarray(ids, np.int64)[order])
+    np.save(os.path.join(site_dir, "title_offsets.npy"), title_offsets)
+    with open(os.path.join(site_dir, "titles.bin"), "wb") as f:
+        f.write(b"".join(encoded))
+
+
+class Encoder:
+    """
+    Turns texts into unit length vectors with the model of an index.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, MODEL)) as f:
+            self.model = json.load(f)
+        self.idf = np.load(os.path.join(path, "idf.npy"), mmap_mode="r")
+        self.projection = np.load(os.path.join(path, "projection.npy"), mmap_mode="r")
+
+    def encode(self, texts):
+        """
+        Encode a batch of texts into a float32[len(texts), dims] array.
+        """
+        indptr, columns, weights = tfidf_rows(texts, self.idf)
+        return normalize(csr_dot(indptr, columns, weights, self.projection))
+
+
+class SiteIndex:
+    """
+    Memory-mapped IVF index of the questions of one site.
+    """
+
+    def __init__(self, site_dir):
+        def load(name):
+            return np.load(os.path.join(site_dir, name), mmap_mode="r")
+
+        self.centroids = np.asarray(load("centroids.npy"))
+        self.offsets = np.asarray(load("offsets.npy"))
+        self.vectors = load("vectors.npy")
+        self.ids = load("ids.npy")
+        self.title_offsets = load("title_offsets.npy")
+        with open(os.path.join(site_dir, "titles.bin"), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.titles = np.memmap(f, dtype=np.uint8, mode="r") if size else b""
+
+    def __len__(self):
+        return len(self.ids)
+
+    def title(self, row):
+        start, end = self.title_offsets[row], self.title_offsets[row + 1]
+        return bytes(self.titles[start:end]).decode("utf-8")
+
+    def search(self, queries, k, nprobe):
+        """
+        Return [(rows, scores, scanned)] with the top k rows per query.
+
+        Only the vectors of the nprobe lists closest to a query are
+        scored. scanned is the number of vectors that were.
+        """
+        nprobe = min(nprobe, len(self.centroids))
+        closest = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)
+        results = []
+        for query, lists in zip(queries, closest[:, :nprobe]):
+            rows = np.concatenate(
+                [np.arange(self.offsets[i], self.offsets[i + 1]) for i in lists]
+            )
+            if not len(rows):
+                results.append((rows, np.zeros(0, np.float32), 0))
+                continue
+            # Rows of a list are contiguous, read them as slices of the map.
+            scores = np.concatenate(
+                [
+                    self.vectors[self.offsets[i] : self.offsets[i + 1]] @ query
+                    for i in lists
+                ]
+            )
+            top = min(k, len(rows))
+            best = np.argpartition(-scores, top - 1)[:top]
+            best = best[np.argsort(-scores[best])]
+            results.append((rows[best], scores[best], len(rows)))
+        return results
+
+
+class VectorIndex:
+    """
+    Encoder and site indexes of an index directory, loaded on first use.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.encoder = Encoder(path)
+        self.sites = {}
+
+    def site(self, site):
+        if site not in self.sites:
+            site_dir = _site_dir(self.path, site)
+            if not os.path.isdir(site_dir):
+                logging.warning(f"No vector index for site {site}.")
+                self.sites[site] = None
+            else:
+                self.sites[site] = SiteIndex(site_dir)
+        return self.sites[site]
+
+    def search(self, texts, sites, k, nprobe):
+        """
+        Search a batch of texts, each within its site.
+
+        Returns a list of (total, [(id, title, score)]) in the order of
+        texts, where total is the number of vectors scanned.
+        """
+        vectors = self.encoder.encode(texts)
+        results = [(0, [])] * len(texts)
+        by_site = {}
+        for i, site in enumerate(sites):
+            by_site.setdefault(site, []).append(i)
+        for site, positions in by_site.items():
+            index = self.site(site)
+            if index is None or not len(index):
+                continue
+            found = index.search(vectors[positions], k, nprobe)
+            for i, (rows, scores, scanned) in zip(positions, found):
+                results[i] = (
+                    scanned,
+                    [
+                        (int(index.ids[row]), index.title(row), float(score))
+                        for row, score in zip(rows, scores)
+                    ],
+                )
+        return results
@@ -1,28 +1,31 @@
 #!/usr/bin/env python
 
-import json
+from argparse import ArgumentParser
+import os
+import sys
 
-from collections import defaultdict
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+from scanner import Scan
 
-import pandas as pd
 
+def main():
+    parser = ArgumentParser("Count reddit submissions per subreddit.")
+    parser.add_argument(
+        "path", help="Path to raw file.", nargs="?", default="/mnt/RS_2017-01"
+    )
+    parser.add_argument("--top", help="Subreddits to print.", default=10, type=int)
+    parser.add_argument(
+        "--workers", help="Parsing processes.", default=os.cpu_count(), type=int
+    )
+    args = parser.parse_args()
 
-file_name = "/mnt/RS_2017-01"
-counter = defaultdict(int)
+    scan = Scan(args.path, fields=["subreddit"], workers=args.workers)
+    counter = scan.count_by("subreddit")
+    sorted_count = [[k, v] for k, v in counter.most_common(args.top)]
 
-x = 0
-with open(file_name) as f:
-    for line in f:
-        l_json = json.loads(line)
-        sub_reddit = l_json.get("subreddit", None)
-        counter[sub_reddit] += 1
-        if x > 100_000_000:
-            break
-        x += 1
+    print(sorted_count)
 
 
-sorted_count = [
-    [k, v] for k, v in sorted(counter.items(), key=lambda item: item[1], reverse=True)
-]
-
-print(sorted_count[:10])
+if __name__ == "__main__":
+    main()
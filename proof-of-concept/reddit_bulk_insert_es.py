@@ -2,10 +2,18 @@
 
 from argparse import ArgumentParser, FileType
 import json
+import logging
 import os
+import sys
 
 from elasticsearch import Elasticsearch
-from elasticsearch import helpers
+
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+import bulk_indexer
+from bulk_indexer import BulkIndexer, Extractor
+
+logging.basicConfig(level=logging.INFO)
 
 
 # Data cleaning: Consolidate rules to blacklist in a single function.
@@ -20,23 +28,26 @@ def blacklist_message(msg, subreddit):
         return True
 
 
-def extract_documents(subreddit, file_path, index, columns):
-    with open(file_path) as f:
-        for line in f:
-            l_json = json.loads(line)
-            if blacklist_message(l_json, subreddit):
-                continue
+class SubmissionExtractor(Extractor):
+    def __init__(self, subreddit, columns):
+        self.subreddit = subreddit
+        self.columns = list(columns)
 
-            doc = {"_index": index, "_id": l_json["id"]}
-            doc.update({k: l_json.get(k) for k in columns})
-            yield doc
+    def extract(self, msg):
+        if blacklist_message(msg, self.subreddit):
+            return None
+        if msg.get("id") is None:
+            logging.debug(f"Submission without an id: {msg}")
+            return None
+        return msg["id"], {k: msg.get(k) for k in self.columns}
 
 
 def main():
     parser = ArgumentParser("Bulk insert subreddit submissions into elastic search")
     parser.add_argument("subreddit", type=str.lower, help="Subreddit name.")
-    parser.add_argument("path", help="Path to raw file.")
+    parser.add_argument("path", help="Path to raw file.", nargs="+")
     parser.add_argument("mapping", help="Path to mapping.json", type=FileType("r"))
+    bulk_indexer.add_arguments(parser)
     args = parser.parse_args()
     es_url = os.getenv("ES_URL")
     es = Elasticsearch(es_url)
@@ -49,8 +60,8 @@ def main():
     es.indices.create(index, mappings, ignore=400)
     columns = mappings["mappings"]["properties"].keys()
 
-    docs = extract_documents(args.subreddit, args.path, index, columns)
-    helpers.bulk(es, docs)
+    extractor = SubmissionExtractor(args.subreddit, columns)
+    BulkIndexer(es, index, extractor, args).run(args.path)
 
 
 if __name__ == "__main__":
@@ -4,39 +4,43 @@ from argparse import ArgumentParser, FileType
 import json
 import logging
 import os
+import sys
 
 from elasticsearch import Elasticsearch
-from elasticsearch import helpers
 
-logging.basicConfig(level=logging.WARNING)
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+import bulk_indexer
+from bulk_indexer import BulkIndexer, Extractor
+from records import blacklist_message
 
-# Data cleaning: Consolidate rules to blacklist in a single function.
-def blacklist_message(msg):
-    if msg.get("type", "").lower() != "question":
-        return True
+logging.basicConfig(level=logging.INFO)
 
 
-def extract_documents(file_path, index, columns):
-    with open(file_path) as f:
-        for line in f:
-            try:
-                l_json = json.loads(line)
-            except json.JSONDecodeError as e:
-                logging.debug(f"Malformed JSON: {line}")
-                continue
+class QuestionExtractor(Extractor):
+    # Answers are skipped before they are decoded.
+    where = {"type": "question"}
 
-            if blacklist_message(l_json):
-                continue
+    def __init__(self, columns):
+        self.columns = list(columns)
 
-            doc = {"_index": index, "_id": l_json["id"]}
-            doc.update({k: l_json.get(k) for k in columns})
-            yield doc
+    def extract(self, msg):
+        if blacklist_message(msg):
+            return None
+        if msg.get("site") is None or msg.get("id") is None:
+            logging.debug(f"Question without a site or id: {msg}")
+            return None
+        # Same document id as batch-pipeline/etl-to-es.py, question ids
+        # are only unique within a site.
+        id = f"{msg['site']}-{msg['id']}"
+        return id, {k: msg.get(k) for k in self.columns}
 
 
 def main():
     parser = ArgumentParser("Bulk insert stack overflow questions into elastic search")
-    parser.add_argument("path", help="Path to raw file.")
+    parser.add_argument("path", help="Path to raw file.", nargs="+")
     parser.add_argument("mapping", help="Path to mapping.json", type=FileType("r"))
+    bulk_indexer.add_arguments(parser)
     args = parser.parse_args()
     es_url = os.getenv("ES_URL")
     es = Elasticsearch(es_url)
@@ -49,8 +53,7 @@ def main():
     es.indices.create(index, mappings, ignore=400)
     columns = mappings["mappings"]["properties"].keys()
 
-    docs = extract_documents(args.path, index, columns)
-    helpers.bulk(es, docs)
+    BulkIndexer(es, index, QuestionExtractor(columns), args).run(args.path)
 
 
 if __name__ == "__main__":
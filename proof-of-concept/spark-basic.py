@@ -4,12 +4,19 @@ from argparse import ArgumentParser
 import json
 import logging
 import os
+import sys
 
 import findspark
 
 from pyspark.sql import SparkSession, SQLContext, types
 from pyspark.sql import functions as func
 
+# Readers of the dumps and of their parquet staging layer.
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "../batch-pipeline")
+)
+import dumps  # noqa: E402
+
 logging.basicConfig(level=logging.WARNING)
 
 
@@ -19,6 +26,7 @@ def main():
         "--file", help="Regex corresponding to files.", default="STX_2017-01"
     )
     parser.add_argument("--url", help="S3 URL prefix", default=os.getenv("S3_URL"))
+    dumps.add_arguments(parser)
     args = parser.parse_args()
 
     findspark.init()
@@ -27,7 +35,20 @@ def main():
     sqlContext = SQLContext(sparkContext=spark.sparkContext, sparkSession=spark)
 
     data_file = os.path.join(args.url, args.file)
-    df = sqlContext.read.json(data_file)
+    # Only creation_date is read, of every record.
+    if args.input_format == "json":
+        # A single pass over the dumps, records of any type count.
+        records = sqlContext.read.json(data_file, schema=dumps.RECORD_SCHEMA)
+        df = dumps.restrict(records, args).select("creation_date")
+    else:
+        # The staging layer only keeps questions and answers.
+        df = (
+            dumps.read_questions(sqlContext, data_file, args)
+            .select("creation_date")
+            .union(
+                dumps.read_answers(sqlContext, data_file, args).select("creation_date")
+            )
+        )
     # convert creation_date bigint into timestamp.
     df = df.withColumn("creation_ts", df["creation_date"].cast("timestamp"))
     # extract date from timestamp
@@ -0,0 +1,110 @@
+"""
+Local search engines that stand in for the Elasticsearch client.
+
+search-es.py builds ES query bodies and sends them with es.search and
+es.msearch. The backends here implement that subset of the client API on
+top of indexes stored on the search host, so caching, batching, freshness
+and metrics in search-es.py work the same whatever answers the query.
+"""
+
+import os
+import sys
+
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+from bm25 import BM25Index
+from vectors import VectorIndex
+
+
+def parse_query(body):
+    """
+    Return (clause, text, site) of a query built by select_query_type.
+    """
+    query = body["query"]["bool"]
+    (clause,) = query["must"][0].keys()
+    params = query["must"][0][clause]
+    site = query["filter"][0]["term"]["site"]
+    return clause, params["like"], site
+
+
+def _site_dirs(path):
+    sites = os.path.join(path, "sites")
+    return sorted(os.listdir(sites)) if os.path.isdir(sites) else []
+
+
+def _response(total, hits):
+    return {
+        "took": 0,
+        "hits": {
+            "total": {"value": total},
+            "hits": [
+                {"_score": score, "_source": {"id": id, "title": title}}
+                for id, title, score in hits
+            ],
+        },
+    }
+
+
+class BM25Backend:
+    """
+    Embedded BM25 index (common/bm25.py), searched in-process.
+
+    Sites check for newly appended segments every check_interval seconds.
+    """
+
+    def __init__(self, path, check_interval):
+        self.index = BM25Index(path, check_interval)
+
+    def warm(self):
+        """
+        Load every site, before the workers fork so that they share them.
+        """
+        for site in _site_dirs(self.index.path):
+            self.index.site(site)
+
+    def search(self, index, body):
+        _, text, site = parse_query(body)
+        scored, hits = self.index.search(text, site, body["size"])
+        return _response(scored, hits)
+
+    def msearch(self, body):
+        return {"responses": [self.search(None, query) for query in body[1::2]]}
+
+
+class VectorBackend:
+    """
+    Nearest neighbour search over a vector index (common/vectors.py).
+
+    _msearch requests are encoded as one batch. The index argument of ES
+    requests is ignored, the vector index covers every site.
+    """
+
+    def __init__(self, path, nprobe):
+        self.index = VectorIndex(path)
+        self.nprobe = nprobe
+
+    def warm(self):
+        """
+        Load every site, before the workers fork so that they share them.
+        """
+        for site in _site_dirs(self.index.path):
+            self.index.site(site)
+
+    def _search(self, bodies):
+        texts, sites = [], []
+        for body in bodies:
+            _, text, site = parse_query(body)
+            texts.append(text)
+            sites.append(site)
+        size = max(body["size"] for body in bodies)
+        results = self.index.search(texts, sites, size, self.nprobe)
+        return [
+            _response(total, hits[: body["size"]])
+            for body, (total, hits) in zip(bodies, results)
+        ]
+
+    def search(self, index, body):
+        return self._search([body])[0]
+
+    def msearch(self, body):
+        return {"responses": self._search(body[1::2])}
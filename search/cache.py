@@ -0,0 +1,237 @@
+"""
+Query result cache for the search stage.
+
+Identical queries (same text, site, index, query type and field) reach the
+search consumers all the time. Keystroke driven clients resend the same
+prefix, popular questions repeat and load tests replay the same dataset.
+QueryCache keeps the trimmed ES response ((total_hits, results)) for such
+queries with a TTL and LRU eviction, and coalesces concurrent misses for the
+same key into a single ES call.
+
+Entries are kept in a pluggable store. MemoryStore is private to a process,
+SqliteStore keeps entries in a sqlite file (ideally on /dev/shm) so that all
+workers on a host share one cache.
+"""
+
+import asyncio
+from collections import OrderedDict
+import json
+import sqlite3
+from threading import Event, Lock
+import time
+
+
+def normalize_key(text, site, index, query_type, field):
+    """
+    Build a cache key for a search.
+
+    ES analyzers lowercase and tokenize on whitespace, so queries that only
+    differ in case or spacing return the same hits and share a key.
+    """
+    text = " ".join(text.lower().split())
+    return "\x1f".join([text, site, index, query_type, field])
+
+
+class MemoryStore:
+    """
+    In-process LRU store.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key, entry):
+        """
+        Save entry under key and return the number of evicted entries.
+        """
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        evicted = 0
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            evicted += 1
+        return evicted
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteStore:
+    """
+    LRU store in a sqlite file shared by all workers on a host.
+
+    Entries are (expires_at, value) tuples; values must be JSON
+    serializable. Note that JSON turns integer dict keys into strings.
+    """
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, expires_at REAL, accessed_at REAL, value TEXT)"
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        row = self._conn.execute(
+            "SELECT expires_at, value FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        with self._conn:
+            self._conn.execute(
+                "UPDATE cache SET accessed_at = ? WHERE key = ?", (time.time(), key)
+            )
+        return row[0], json.loads(row[1])
+
+    def set(self, key, entry):
+        expires_at, value = entry
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, expires_at, time.time(), json.dumps(value)),
+            )
+            cursor = self._conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache "
+                "ORDER BY accessed_at LIMIT max(0, (SELECT COUNT(*) FROM cache) - ?))",
+                (self.max_entries,),
+            )
+        return cursor.rowcount
+
+    def delete(self, key):
+        with self._conn:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class QueryCache:
+    """
+    TTL cache with single-flight misses in front of a store.
+
+    Cached values are shared between callers and must not be mutated.
+    """
+
+    def __init__(self, store, ttl):
+        self.store = store
+        self.ttl = ttl
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expired": 0,
+            "coalesced": 0,
+        }
+        self._lock = Lock()
+        # key -> Event (threads) or Future (asyncio) of the in-flight miss.
+        self._pending = {}
+        self._pending_async = {}
+
+    def get(self, key):
+        """
+        Return the cached value for key or None.
+        """
+        with self._lock:
+            entry = self.store.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                self.store.delete(key)
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            return value
+
+    def coalesced(self):
+        """
+        Count a miss served by a computation already in flight.
+        """
+        with self._lock:
+            self.stats["coalesced"] += 1
+
+    def put(self, key, value):
+        with self._lock:
+            self.stats["evictions"] += self.store.set(
+                key, (time.time() + self.ttl, value)
+            )
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached value for key, calling compute() on a miss.
+
+        Threads missing on a key that is already being computed wait for
+        that computation instead of issuing their own. compute() returning
+        None (e.g. on an ES timeout) is passed through but not cached.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                self._pending[key] = Event()
+            else:
+                self.stats["coalesced"] += 1
+        if pending is not None:
+            pending.wait()
+            value = self.get(key)
+            return value if value is not None else compute()
+
+        try:
+            value = compute()
+            if value is not None:
+                self.put(key, value)
+            return value
+        finally:
+            with self._lock:
+                self._pending.pop(key).set()
+
+    async def get_or_compute_async(self, key, compute):
+        """
+        Asyncio flavour of get_or_compute. compute is a coroutine function.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        pending = self._pending_async.get(key)
+        if pending is not None:
+            self.coalesced()
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending_async[key] = future
+        try:
+            value = await compute()
+            if value is not None:
+                self.put(key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Waiters get the exception, nobody else needs to retrieve it.
+            future.exception()
+            raise
+        finally:
+            del self._pending_async[key]
@@ -1,22 +1,32 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
-from datetime import datetime
-import json
 import logging
 import os
+import sys
+import time
 
-from pulsar import Client
 from pulsar import ConsumerType
 
-from sqlalchemy import create_engine, and_
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.query import Query
+from metadata import QuestionStore
 
-from tables import Questions
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+from batching import receive_batch
+from codec import CODECS, DEFAULT_CODEC, Codec, decode_message
+from freshness import FreshnessFilter
+from metrics import StageMetrics, start_metrics_server
+from replies import reply_producer
+import runtime
+from snapshot import ReloadingSnapshot
+import supervisor
 
 logging.basicConfig(level=logging.WARN)
 
+# Codec of outgoing messages, set from the command line.
+codec = Codec()
+metrics = StageMetrics("curate")
+
 
 def msg_received_callback(status, msg_id):
     """
@@ -30,20 +40,51 @@ def msg_received_callback(status, msg_id):
     logging.debug(f"Message {msg_id} result = {status}")
 
 
-def init_postgres_session(connection):
+def init_question_store(connection, args):
     """
     Setup access to postgres.
 
-    A function that sets up acces to postgres and returns a session
-    object. Other functions can use the session object and run
-    queries as needed.
+    A function that sets up a pool of postgres connections and returns
+    the question store used to look up question metadata.
+    """
+    url = "postgresql://{user}:{pwd}@{url}/{db}".format(**connection)
+    return QuestionStore(url, pool_size=args.pool_size, max_overflow=args.max_overflow)
+
+
+def find_metadata(keys, store, snapshot=None):
     """
-    engine = create_engine("postgresql://{user}:{pwd}@{url}/{db}".format(**connection))
-    Session = sessionmaker(bind=engine)
-    return Session()
+    Return {(site, id): (answer_count, link)} for a set of (site, id) keys.
+
+    Metadata is read from the memory-mapped snapshot when one is given.
+    Postgres is only queried (once, for all keys) for questions missing
+    from the snapshot.
+    """
+    metadata = {}
+    missing = keys
+    if snapshot is not None:
+        current = snapshot.get()
+        missing = []
+        for site, id in keys:
+            found = current.lookup(site, id)
+            if found is None:
+                missing.append((site, id))
+            else:
+                answer_count, _, link = found
+                metadata[(site, id)] = (answer_count, link)
+
+    if missing:
+        start = time.perf_counter()
+        try:
+            metadata.update(store.fetch(missing))
+        except Exception:
+            metrics.error("postgres")
+            raise
+        finally:
+            metrics.postgres.observe(time.perf_counter() - start)
+    return metadata
 
 
-def curate(suggestions, site, session):
+def rank(suggestions, site, metadata):
     """
     Score search suggestions based on question metadata.
 
@@ -53,15 +94,16 @@ def curate(suggestions, site, session):
     results by scaling the ES score with the number of answers for that
     question.
     """
-    results = (
-        session.query(Questions)
-        .filter(and_(Questions.site == site, Questions.id.in_(suggestions.keys())))
-        .all()
-    )
-    for q in results:
+    for id, suggestion in suggestions.items():
+        found = metadata.get((site, int(id)))
+        if found is None:
+            continue
+        answer_count, link = found
         # Retain original score for question with answer_count == 0. Hence +1.
-        suggestions[str(q.id)]["score"] *= q.answer_count + 1
-        suggestions[str(q.id)]["link"] = q.link
+        # Cosine scores (--query-type vector) can be negative, scaling them
+        # would rank questions with more answers lower.
+        suggestion["score"] = max(suggestion["score"], 0.0) * (answer_count + 1)
+        suggestion["link"] = link
 
     ranked_suggestions = sorted(
         suggestions.values(), key=lambda x: x["score"], reverse=True
@@ -69,37 +111,90 @@ def curate(suggestions, site, session):
     return ranked_suggestions
 
 
-def find_suggestions(in_topic, out_topic, client, session):
+def curate(suggestions, site, store, snapshot=None):
+    """
+    Curate the suggestions of a single message.
+    """
+    keys = {(site, int(id)) for id in suggestions}
+    return rank(suggestions, site, find_metadata(keys, store, snapshot))
+
+
+def decode_packet(msg, received_at=None):
+    """
+    Decode a message received from in_topic at received_at (now by default).
+
+    Messages are acked once processed (sent or dropped), see runtime.py.
+    """
+    msg_id = msg.message_id()
+    start = time.perf_counter()
+    packet = decode_message(msg)
+    metrics.decode.observe(time.perf_counter() - start)
+    metrics.received(packet, "es_end", "pg_start", received_at)
+    logging.debug(
+        f"Curator: Received message {packet['text']}, id={msg_id}, room={packet['room']}"
+    )
+    return packet
+
+
+def send_packet(producer, packet):
+    metrics.sent(packet, "pg_start", "pg_end")
+    start = time.perf_counter()
+    data = codec.encode(packet)
+    metrics.encode.observe(time.perf_counter() - start)
+    producer.send_async(
+        data,
+        msg_received_callback,
+        properties=codec.properties,
+        partition_key=packet["room"],
+    )
+
+
+def find_suggestions(
+    in_topic, out_topic, client, store, freshness, args, snapshot=None
+):
     """
     Consume from in_topic, process and produce to out_topic.
 
     This function reads messages from curate-topic. Messages
     contain question id, ES score and the name of the subdomain.
     The curator then queries postgres, orders results and
-    sends back the curated message to the user.
+    sends back the curated message to the user. Messages that
+    expired or were superseded by a newer message of the same
+    room are dropped before postgres is queried.
+
+    With a batch size greater than one, the metadata of up to
+    args.batch_size messages (or whatever arrives within
+    args.linger_ms) is fetched with a single postgres query.
+
+    Curated packets are sent to the reply topic of the web-server
+    instance that received the request.
     """
     consumer = client.subscribe(
-        in_topic, "test-subscription", consumer_type=ConsumerType.Shared
+        in_topic, "test-subscription", consumer_type=ConsumerType.KeyShared
     )
-    producer = client.create_producer(out_topic)
+    producers = {out_topic: client.create_producer(out_topic)}
     while True:
-        msg = consumer.receive()
-        consumer.acknowledge(msg)
-        msg_id = msg.message_id()
-        data = msg.data().decode("utf-8")
-        packet = json.loads(data)
-        if "timestamps" in packet:
-            packet["timestamps"].append(datetime.utcnow().timestamp())
-        logging.debug(
-            f"Curator: Received message {packet['text']}, id={msg_id}, room={packet['room']}"
-        )
-        if len(packet["suggestions"]):
-            curated_result = curate(packet["suggestions"], packet["site"], session)
-            packet["suggestions"] = curated_result
+        msgs = receive_batch(consumer, args.batch_size, args.linger_ms)
+        packets = [decode_packet(msg, received_at) for msg, received_at in msgs]
+        for packet in packets:
+            freshness.observe(packet)
+        packets = [packet for packet in packets if not freshness.drop_reason(packet)]
 
-        if "timestamps" in packet:
-            packet["timestamps"].append(datetime.utcnow().timestamp())
-        producer.send_async(json.dumps(packet).encode("utf-8"), msg_received_callback)
+        keys = {
+            (packet["site"], int(id))
+            for packet in packets
+            for id in packet["suggestions"]
+        }
+        metadata = find_metadata(keys, store, snapshot) if keys else {}
+        for packet in packets:
+            if len(packet["suggestions"]):
+                packet["suggestions"] = rank(
+                    packet["suggestions"], packet["site"], metadata
+                )
+            send_packet(reply_producer(client, producers, packet, out_topic), packet)
+        # The dropped messages too, they are done with.
+        for msg, _ in msgs:
+            consumer.acknowledge(msg)
 
 
 def main():
@@ -111,6 +206,69 @@ def main():
         help="URL of pulsar broker.",
         default=os.getenv("PULSAR_BROKER_URL"),
     )
+    runtime.add_arguments(parser)
+    supervisor.add_arguments(parser)
+    parser.add_argument(
+        "--drop-superseded",
+        help="Drop requests superseded by a newer request of the same room.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        help="Seconds between drop count, postgres stats and throughput log lines.",
+        default=60.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--pool-size",
+        help="Postgres connections kept open per worker.",
+        default=5,
+        type=int,
+    )
+    parser.add_argument(
+        "--max-overflow",
+        help="Extra postgres connections opened under load.",
+        default=10,
+        type=int,
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="Max messages curated per postgres query. Defaults to 1 (no batching).",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--linger-ms",
+        help="Max time (in ms) to wait for a batch to fill up.",
+        default=5,
+        type=int,
+    )
+    parser.add_argument(
+        "--snapshot",
+        help="Question metadata snapshot written by export-question-snapshot.py. "
+        "Postgres is only queried for questions missing from the snapshot.",
+        default=os.getenv("QUESTION_SNAPSHOT"),
+    )
+    parser.add_argument(
+        "--snapshot-check-interval",
+        help="Seconds between checks for a new snapshot file.",
+        default=30.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--codec",
+        help="Codec of outgoing messages. Incoming messages are decoded with "
+        "the codec they were sent with.",
+        default=os.getenv("PIPELINE_CODEC", DEFAULT_CODEC),
+        choices=CODECS,
+    )
+    parser.add_argument(
+        "--metrics-port",
+        help="Serve Prometheus metrics on localhost:PORT/metrics, worker i on "
+        "PORT + i. Disabled if zero.",
+        default=int(os.getenv("METRICS_PORT", 0)),
+        type=int,
+    )
     args = parser.parse_args()
 
     if not args.pulsar_broker_url:
@@ -118,6 +276,37 @@ def main():
             "Pulsar broker url is null. Set PULSAR_BROKER_URL environment variable."
         )
 
+    global codec
+    try:
+        codec = Codec(args.codec)
+    except ValueError as e:
+        parser.error(str(e))
+    snapshot = None
+    if args.snapshot:
+        # Mapped before the workers fork, they share its pages.
+        snapshot = ReloadingSnapshot(args.snapshot, args.snapshot_check_interval)
+    try:
+        runtime.profile_settings(args.pulsar_profile, args.pulsar_compression)
+        workers = supervisor.Supervisor(
+            "curate",
+            lambda worker: run_worker(worker, args, snapshot),
+            args.workers,
+            args.pin_cpus,
+            args.drain_timeout,
+            args.stats_interval,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    workers.run()
+
+
+def run_worker(worker, args, snapshot=None):
+    """
+    Consume curate-topic in a worker forked by the supervisor.
+
+    Threads and connections do not survive a fork, they are all started
+    here. snapshot is mapped before the fork.
+    """
     connection_map = {
         "user": "POSTGRES_USER",
         "pwd": "POSTGRES_PWD",
@@ -125,11 +314,27 @@ def main():
         "db": "POSTGRES_DB",
     }
     connection = {k: os.getenv(v) for k, v in connection_map.items()}
-    session = init_postgres_session(connection)
-    client = Client(args.pulsar_broker_url)
+    store = init_question_store(connection, args)
+    store.start_reporting(args.stats_interval)
+    freshness = FreshnessFilter("curate", supersede=args.drop_superseded)
+    freshness.start_reporting(args.stats_interval)
+    metrics.watch_drops(freshness)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port + worker.index)
+
+    client = runtime.connect(
+        args.pulsar_broker_url, args.pulsar_profile, args.pulsar_compression
+    )
+    worker.on_stop(client.stop)
+    worker.watch(client)
     in_topic = "curate-topic"
     out_topic = "suggestions-topic"
-    find_suggestions(in_topic, out_topic, client, session)
+    try:
+        find_suggestions(in_topic, out_topic, client, store, freshness, args, snapshot)
+    except runtime.Stopped:
+        logging.warning(f"Worker {worker.index} drained.")
+    finally:
+        client.close()
 
 
 if __name__ == "__main__":
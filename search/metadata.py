@@ -0,0 +1,86 @@
+"""
+Postgres access for the curator.
+
+The curator only needs (answer_count, link) for a handful of questions per
+message. QuestionStore reads exactly those columns as plain tuples through a
+pooled engine, and resolves the ids of any number of messages (from any
+number of sites) with a single query by joining against unnest-ed arrays of
+keys. Query latency and row counts are recorded so that the share of time
+spent in postgres is visible.
+"""
+
+import logging
+from threading import Lock, Thread
+import time
+
+from sqlalchemy import create_engine, text
+
+# (site, id) pairs are passed as two parallel arrays. Joining against them
+# lets postgres use the (site, id) primary key for every pair.
+METADATA_QUERY = text(
+    "SELECT q.site, q.id, q.answer_count, q.link "
+    "FROM questions q "
+    "JOIN unnest(CAST(:sites AS varchar[]), CAST(:ids AS integer[])) AS k(site, id) "
+    "ON q.site = k.site AND q.id = k.id"
+)
+
+
+class QuestionStore:
+    """
+    Pooled, ORM-free reader of question metadata.
+    """
+
+    def __init__(self, url, pool_size=5, max_overflow=10):
+        self.engine = create_engine(
+            url, pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=True
+        )
+        self.stats = {"queries": 0, "keys": 0, "rows": 0, "seconds": 0.0}
+        self._lock = Lock()
+
+    def fetch(self, keys):
+        """
+        Return {(site, id): (answer_count, link)} for the given (site, id) keys.
+
+        Keys missing from the questions table are missing from the result.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        sites, ids = zip(*keys)
+        start = time.perf_counter()
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                METADATA_QUERY, {"sites": list(sites), "ids": list(ids)}
+            ).fetchall()
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.stats["queries"] += 1
+            self.stats["keys"] += len(keys)
+            self.stats["rows"] += len(rows)
+            self.stats["seconds"] += elapsed
+        logging.debug(
+            f"Fetched {len(rows)} rows for {len(keys)} keys in {elapsed * 1000:.2f} ms."
+        )
+        return {
+            (site, id): (answer_count, link) for site, id, answer_count, link in rows
+        }
+
+    def start_reporting(self, interval):
+        """
+        Log query counts and mean latency every interval seconds.
+        """
+
+        def report():
+            while True:
+                time.sleep(interval)
+                with self._lock:
+                    stats = dict(self.stats)
+                queries = stats["queries"] or 1
+                logging.warning(
+                    f"Postgres: {stats}, "
+                    f"mean latency {stats['seconds'] / queries * 1000:.2f} ms, "
+                    f"mean rows {stats['rows'] / queries:.1f}"
+                )
+
+        Thread(target=report, daemon=True).start()
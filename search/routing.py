@@ -0,0 +1,109 @@
+"""
+Site to index routing for the search stage.
+
+batch-pipeline/etl-to-es.py --index-type site writes every site to its own
+index, or packs small sites into shared indexes, and saves the resulting
+routing table:
+
+    {
+        "sites": {site: alias searched for the site},
+        "indexes": {index: {"sites": [site], "docs": n, "shards": n}},
+        "created": ISO timestamp,
+    }
+
+The table is stored as a document of an ES index (its id is the index
+prefix passed to the ETL, the --index of search-es.py) and optionally as a
+JSON file. RoutingTable keeps a copy and reloads it from a daemon thread,
+so a new ETL run (or a hot site moved to its own index) is picked up
+without restarting the workers and lookups never wait on ES.
+"""
+
+import json
+import logging
+import os
+from threading import Thread
+import time
+
+
+class RoutingTable:
+    """
+    Reloadable site -> index map.
+
+    fetch returns the routing table document, or None if it has not
+    changed since the last call.
+    """
+
+    def __init__(self, fetch, source):
+        self.fetch = fetch
+        self.source = source
+        self.sites = {}
+        self.created = None
+        self.stats = {"reloads": 0, "errors": 0}
+
+    def index(self, site):
+        """
+        Return the index to search for site, None for unknown sites.
+
+        The index prefix the table is saved under is not an index, unknown
+        sites have nothing to search.
+        """
+        return self.sites.get(site)
+
+    def reload(self):
+        try:
+            table = self.fetch()
+        except Exception:
+            # Keep routing with the table we have.
+            self.stats["errors"] += 1
+            logging.exception(f"Failed to reload the routing table from {self.source}.")
+            return
+        if table is None or table.get("created") == self.created:
+            return
+        # Swap the dict instead of updating it, readers never lock.
+        self.sites = dict(table["sites"])
+        self.created = table.get("created")
+        self.stats["reloads"] += 1
+        logging.warning(
+            f"Loaded routing table of {self.created} from {self.source}: "
+            f"{len(self.sites)} sites in {len(table.get('indexes', {}))} indexes."
+        )
+
+    def start_refreshing(self, interval):
+        def refresh():
+            while True:
+                time.sleep(interval)
+                self.reload()
+
+        Thread(target=refresh, daemon=True).start()
+
+    @classmethod
+    def from_es(cls, es_url, routing_index, id):
+        from elasticsearch import Elasticsearch
+
+        clients = {}
+
+        def fetch():
+            # Forked workers must not share the connections of their parent.
+            pid = os.getpid()
+            if pid not in clients:
+                clients.clear()
+                clients[pid] = Elasticsearch(es_url)
+            return clients[pid].get(index=routing_index, id=id)["_source"]
+
+        return cls(fetch, f"{routing_index}/{id}")
+
+    @classmethod
+    def from_file(cls, path):
+        modified = None
+
+        def fetch():
+            nonlocal modified
+            mtime = os.stat(path).st_mtime
+            if mtime == modified:
+                return None
+            with open(path) as f:
+                table = json.load(f)
+            modified = mtime
+            return table
+
+        return cls(fetch, path)
@@ -1,19 +1,40 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
-from datetime import datetime
-import json
+import asyncio
 import logging
 import os
+import sys
+from threading import Thread
+import time
 
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import ConnectionTimeout
 
-from pulsar import Client
 from pulsar import ConsumerType
 
+from backends import BM25Backend, VectorBackend
+from cache import MemoryStore, QueryCache, SqliteStore, normalize_key
+from routing import RoutingTable
+
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+from batching import receive_batch
+from codec import CODECS, DEFAULT_CODEC, Codec, decode_message
+from freshness import FreshnessFilter
+from metrics import StageMetrics, start_metrics_server
+from replies import reply_producer
+import runtime
+import supervisor
+
 logging.basicConfig(level=logging.WARN)
 
+# Codec of outgoing messages, set from the command line.
+codec = Codec()
+metrics = StageMetrics("search")
+# Site -> index routing table (routing.py), set from the command line.
+routes = None
+
 
 def msg_received_callback(status, msg_id):
     """
@@ -57,77 +78,490 @@ def select_query_type(type, field, text, site):
         }
     }
 
+    # Served by local indexes (backends.py), not ES.
+    for local in ["bm25", "vector"]:
+        query[local] = {
+            "query": {
+                "bool": {
+                    "must": [{local: {"fields": [field], "like": text}}],
+                    "filter": [{"term": {"site": site}}],
+                }
+            }
+        }
+
     assert type in query
     return query[type]
 
 
-def find_suggestions(es, in_topic, out_topic, client, args):
+def rank_in_es(query):
+    """
+    Wrap query so that ES ranks hits like the curator does.
+
+    The curator multiplies the ES score of a question by answer_count + 1.
+    Summing a field_value_factor of answer_count and a constant weight of
+    1, then multiplying with the query score, computes the same thing on
+    every matching question, not only on the top hits.
+    """
+    return {
+        "query": {
+            "function_score": {
+                "query": query["query"],
+                "functions": [
+                    {"field_value_factor": {"field": "answer_count", "missing": 0}},
+                    {"weight": 1},
+                ],
+                "score_mode": "sum",
+                "boost_mode": "multiply",
+            }
+        }
+    }
+
+
+def build_query(packet, args):
+    """
+    Build the ES query body for a single packet.
+    """
+    # Responses from ES only need to include a subset of keys.
+    # For example, we don't need to return the "body" of the message.
+    # Body is large, takes time to (de)serialize.
+    keys_to_return = ["id", "title"]
+    query = select_query_type(
+        args.query_type, args.field, packet["text"], packet["site"]
+    )
+    if args.rank_in_es:
+        keys_to_return.append("link")
+        query = rank_in_es(query)
+
+    return {
+        "_source": keys_to_return,
+        "size": args.limit_result_count,  # number of results to limit.
+        **query,
+    }
+
+
+def extract_results(response):
+    """
+    Trim an ES response down to the fields forwarded to the curator.
+
+    Returns a tuple of (total_hits, results) where results maps the
+    question id to its title and ES score (and link, when ES ranks).
+    Results are in ES order.
+    """
+    results = {}
+    for hit in response["hits"]["hits"]:
+        title, score, id = (
+            hit["_source"]["title"],
+            hit["_score"],
+            hit["_source"]["id"],
+        )
+        results[id] = {"title": title, "score": score}
+        if "link" in hit["_source"]:
+            results[id]["link"] = hit["_source"]["link"]
+    return response["hits"]["total"]["value"], results
+
+
+def decode_packet(msg, received_at=None):
+    """
+    Decode a message received from in_topic at received_at (now by default).
+
+    Messages are acked once processed (sent or dropped), see runtime.py.
+    """
+    msg_id = msg.message_id()
+    start = time.perf_counter()
+    packet = decode_message(msg)
+    metrics.decode.observe(time.perf_counter() - start)
+    metrics.received(packet, "server_req", "es_start", received_at)
+    logging.debug(
+        f"NLP-er: Received message {packet['text']}, id={msg_id}, room={packet['room']}"
+    )
+    return packet
+
+
+def send_packet(producer, packet, results, ranked=False):
+    # Ranked results skip the curator and go out in its format, a list
+    # sorted by score.
+    packet["suggestions"] = list(results.values()) if ranked else results
+    metrics.sent(packet, "es_start", "es_end")
+    start = time.perf_counter()
+    data = codec.encode(packet)
+    metrics.encode.observe(time.perf_counter() - start)
+    # Keying by room keeps all messages of a room on the same downstream
+    # consumer (Key_Shared subscription), so it sees every newer message.
+    producer.send_async(
+        data,
+        msg_received_callback,
+        properties=codec.properties,
+        partition_key=packet["room"],
+    )
+
+
+def resolve_index(packet, args):
+    """
+    Return the index to search for packet.
+
+    An index named in the message wins (used to experiment with indexing
+    schemes), then the routing table entry of the site, then --index.
+    With a routing table, sites not in the table have no index (None).
+    """
+    if "index" in packet:
+        return packet["index"]
+    if routes is not None:
+        return routes.index(packet["site"])
+    return args.index
+
+
+def unrouted(packet):
+    metrics.error("unrouted")
+    logging.warning(f"Site {packet['site']} is not in the routing table, skipping.")
+    return None, {}
+
+
+def cache_key(packet, args):
+    if args.query_type in ["bm25", "vector"]:
+        # Local backends do not search ES indexes, key on their directory.
+        index = getattr(args, f"{args.query_type}_index")
+    else:
+        index = resolve_index(packet, args)
+    return normalize_key(
+        packet["text"],
+        packet["site"],
+        index,
+        # Ranked and unranked results differ, keep workers sharing a cache apart.
+        f"{args.query_type}+rank" if args.rank_in_es else args.query_type,
+        args.field,
+    )
+
+
+def cacheable(outcome):
+    """
+    Map failed searches to None so that the cache does not keep them.
+    """
+    total_hits, results = outcome
+    return outcome if total_hits is not None else None
+
+
+def search_one(es, packet, args, cache=None):
+    """
+    Run a single ES search for packet.
+
+    Returns a tuple of (total_hits, results). total_hits is None
+    when the search timed out.
+    """
+    if cache is not None:
+        outcome = cache.get_or_compute(
+            cache_key(packet, args), lambda: cacheable(search_one(es, packet, args))
+        )
+        return outcome if outcome is not None else (None, {})
+
+    es_query = build_query(packet, args)
+    index = resolve_index(packet, args)
+    if index is None:
+        return unrouted(packet)
+    logging.info(f"Using {index} index.")
+    start = time.perf_counter()
+    try:
+        response = es.search(index=index, body=es_query)
+    except ConnectionTimeout as e:
+        metrics.error("es_timeout")
+        logging.exception(
+            f"Read timed out. Skipping read for index={index}, query={es_query}"
+        )
+        return None, {}
+    finally:
+        metrics.es.observe(time.perf_counter() - start)
+    return extract_results(response)
+
+
+def search_many(es, packets, args, cache=None):
+    """
+    Run the searches for a batch of packets in a single _msearch request.
+
+    Returns a list of (total_hits, results) tuples in the same order as
+    packets. total_hits is None for searches that failed.
+    """
+    if cache is not None:
+        # Serve hits from the cache and only send one query per distinct
+        # missing key to ES.
+        outcomes = [None] * len(packets)
+        misses = {}
+        for i, packet in enumerate(packets):
+            key = cache_key(packet, args)
+            if key in misses:
+                cache.coalesced()
+                misses[key].append(i)
+                continue
+            outcomes[i] = cache.get(key)
+            if outcomes[i] is None:
+                misses[key] = [i]
+
+        if misses:
+            to_search = [packets[indices[0]] for indices in misses.values()]
+            searched = search_many(es, to_search, args)
+            for (key, indices), outcome in zip(misses.items(), searched):
+                if cacheable(outcome) is not None:
+                    cache.put(key, outcome)
+                for i in indices:
+                    outcomes[i] = outcome
+        return outcomes
+
+    outcomes = [None] * len(packets)
+    searched = []
+    body = []
+    for i, packet in enumerate(packets):
+        index = resolve_index(packet, args)
+        if index is None:
+            outcomes[i] = unrouted(packet)
+            continue
+        searched.append(i)
+        body.append({"index": index})
+        body.append(build_query(packet, args))
+    if not searched:
+        return outcomes
+
+    start = time.perf_counter()
+    try:
+        response = es.msearch(body=body)
+    except ConnectionTimeout as e:
+        metrics.error("es_timeout")
+        logging.exception(
+            f"Read timed out. Skipping _msearch of {len(searched)} queries."
+        )
+        for i in searched:
+            outcomes[i] = (None, {})
+        return outcomes
+    finally:
+        metrics.es.observe(time.perf_counter() - start)
+
+    for i, item in zip(searched, response["responses"]):
+        if "error" in item:
+            metrics.error("es_error")
+            logging.error(
+                f"Search failed for text={packets[i]['text']}: {item['error']}"
+            )
+            outcomes[i] = (None, {})
+        else:
+            outcomes[i] = extract_results(item)
+    return outcomes
+
+
+def find_suggestions(es, in_topic, out_topic, client, args, cache=None, freshness=None):
     """
     Consume from in_topic, process and produce to out_topic.
 
     This function reads messages from in_topic, performs NLP and queries the
     elastic search server to find posts related to the incoming messages. These
-    suggestions are then posted to out_topic for other consumers.
+    suggestions are then posted to out_topic for other consumers. With
+    args.rank_in_es, out_topic is the suggestions topic and every packet
+    goes to the reply topic of its web-server.
+
+    With a batch size greater than one, up to args.batch_size messages
+    (or whatever arrives within args.linger_ms) are searched using one
+    _msearch request and the hits are fanned back out to one packet per
+    message.
+
+    Messages that expired or were superseded by a newer message of the
+    same room are dropped before they reach ES.
     """
+    freshness = freshness or FreshnessFilter("search")
     consumer = client.subscribe(
-        in_topic, "test-subscription", consumer_type=ConsumerType.Shared
+        in_topic, "test-subscription", consumer_type=ConsumerType.KeyShared
     )
-    producer = client.create_producer(out_topic)
+    producers = {out_topic: client.create_producer(out_topic)}
     while True:
-        msg = consumer.receive()
-        consumer.acknowledge(msg)
-        msg_id = msg.message_id()
-        data = msg.data().decode("utf-8")
-        packet = json.loads(data)
-        if "timestamps" in packet:
-            packet["timestamps"].append(datetime.utcnow().timestamp())
-        logging.debug(
-            f"NLP-er: Received message {packet['text']}, id={msg_id}, room={packet['room']}"
+        if args.batch_size <= 1:
+            msg = consumer.receive()
+            packet = decode_packet(msg)
+            freshness.observe(packet)
+            if not freshness.drop_reason(packet):
+                total_hits, results = search_one(es, packet, args, cache)
+                if total_hits is not None:
+                    packet["total_hits"] = total_hits
+                producer = reply_producer(client, producers, packet, out_topic)
+                send_packet(producer, packet, results, args.rank_in_es)
+            consumer.acknowledge(msg)
+            continue
+
+        msgs = receive_batch(consumer, args.batch_size, args.linger_ms)
+        packets = [decode_packet(msg, received_at) for msg, received_at in msgs]
+        for packet in packets:
+            freshness.observe(packet)
+        packets = [packet for packet in packets if not freshness.drop_reason(packet)]
+        if packets:
+            outcomes = search_many(es, packets, args, cache)
+            for packet, (total_hits, results) in zip(packets, outcomes):
+                if total_hits is not None:
+                    packet["total_hits"] = total_hits
+                producer = reply_producer(client, producers, packet, out_topic)
+                send_packet(producer, packet, results, args.rank_in_es)
+        # The dropped messages too, they are done with.
+        for msg, _ in msgs:
+            consumer.acknowledge(msg)
+
+
+async def search_one_async(es, packet, args, cache=None):
+    """
+    Async counterpart of search_one using an AsyncElasticsearch client.
+    """
+    if cache is not None:
+
+        async def compute():
+            return cacheable(await search_one_async(es, packet, args))
+
+        outcome = await cache.get_or_compute_async(cache_key(packet, args), compute)
+        return outcome if outcome is not None else (None, {})
+
+    es_query = build_query(packet, args)
+    index = resolve_index(packet, args)
+    if index is None:
+        return unrouted(packet)
+    logging.info(f"Using {index} index.")
+    start = time.perf_counter()
+    try:
+        response = await es.search(index=index, body=es_query)
+    except ConnectionTimeout as e:
+        metrics.error("es_timeout")
+        logging.exception(
+            f"Read timed out. Skipping read for index={index}, query={es_query}"
         )
+        return None, {}
+    finally:
+        metrics.es.observe(time.perf_counter() - start)
+    return extract_results(response)
 
-        # Responses from ES only need to include a subset of keys.
-        # For example, we don't need to return the "body" of the message.
-        # Body is large, takes time to (de)serialize.
-        keys_to_return = ["id", "title"]
-
-        es_query = {
-            "_source": keys_to_return,
-            "size": args.limit_result_count,  # number of results to limit.
-            **select_query_type(
-                args.query_type, args.field, packet["text"], packet["site"]
-            ),
-        }
 
-        results = {}
+async def search_or_drop(es, producer, packet, previous, args, cache, freshness):
+    if freshness.drop_reason(packet):
+        return
+    total_hits, results = await search_one_async(es, packet, args, cache)
+    if previous is not None:
+        # asyncio.wait does not raise if previous failed.
+        await asyncio.wait([previous])
+    # A newer message of the room may have arrived during the search.
+    if freshness.drop_reason(packet):
+        return
+    if total_hits is not None:
+        packet["total_hits"] = total_hits
+    send_packet(producer, packet, results, args.rank_in_es)
+
+
+async def search_and_send(
+    es,
+    producer,
+    packet,
+    previous,
+    in_flight,
+    args,
+    cache,
+    freshness,
+    ack=None,
+    nack=None,
+):
+    """
+    Search ES for packet and send the results once previous has been sent.
+
+    previous is the task handling the prior message of the same room (or
+    None). Waiting on it keeps the output ordered per room while searches
+    for different rooms (and for the same room) still overlap. ack is
+    called once the packet is sent or dropped, nack if handling it failed,
+    so that pulsar redelivers it.
+    """
+    try:
+        await search_or_drop(es, producer, packet, previous, args, cache, freshness)
+    except Exception:
+        metrics.error("search")
+        logging.exception(f"Search failed for text={packet['text']}, redelivering.")
+        if nack is not None:
+            nack()
+    else:
+        if ack is not None:
+            ack()
+    finally:
+        in_flight.release()
+
+
+async def find_suggestions_async(
+    es, in_topic, out_topic, client, args, cache=None, freshness=None
+):
+    """
+    Asyncio version of find_suggestions.
+
+    Keeps up to args.max_in_flight ES queries outstanding. Once that limit
+    is reached the worker stops pulling messages from pulsar until a query
+    completes, so a slow ES cluster pushes back on the broker instead of
+    piling up work in memory. Output is ordered per room and messages
+    superseded by a newer message of the same room are dropped.
+    """
+    freshness = freshness or FreshnessFilter("search")
+    consumer = client.subscribe(
+        in_topic, "test-subscription", consumer_type=ConsumerType.KeyShared
+    )
+    producers = {out_topic: client.create_producer(out_topic)}
+    loop = asyncio.get_running_loop()
+    in_flight = asyncio.Semaphore(args.max_in_flight)
+    # room -> task handling the latest message received for that room.
+    last_in_room = {}
+
+    def forget(room, task):
+        if last_in_room.get(room) is task:
+            del last_in_room[room]
+
+    while True:
+        await in_flight.acquire()
+        # The pulsar client is blocking, so receive on a worker thread.
+        try:
+            msg = await loop.run_in_executor(None, consumer.receive)
+        except runtime.Stopped:
+            # Finish the searches in flight, each waits for the previous
+            # one of its room.
+            if last_in_room:
+                await asyncio.wait(list(last_in_room.values()))
+            raise
+        except Exception:
+            in_flight.release()
+            logging.exception("Receive failed, retrying in 1 s.")
+            await asyncio.sleep(1)
+            continue
         try:
-            # In order to optimize ES performance, we want to experiment with
-            # different indexing schemes. For example, instead of one common
-            # index for the entire dataset, we could have an index per stackexchange
-            # subdomain (or site) as they call it. In order to experiment with
-            # different indexing options, pass the name of the index to the
-            # consumer in the body of the message. If no index is present, use
-            # the default index.
-            index = packet.get("index", args.index)
-            logging.info(f"Using {index} index.")
-            response = es.search(index=index, body=es_query)
-        except ConnectionTimeout as e:
-            logging.exception(
-                f"Read timed out. Skipping read for index={index}, query={es_query}"
+            packet = decode_packet(msg)
+        except Exception:
+            in_flight.release()
+            metrics.error("decode")
+            logging.exception(f"Dropping malformed message {msg.message_id()}.")
+            consumer.acknowledge(msg)
+            continue
+        freshness.observe(packet)
+        room = packet["room"]
+        task = asyncio.create_task(
+            search_and_send(
+                es,
+                reply_producer(client, producers, packet, out_topic),
+                packet,
+                last_in_room.get(room),
+                in_flight,
+                args,
+                cache,
+                freshness,
+                lambda msg=msg: consumer.acknowledge(msg),
+                lambda msg=msg: consumer.negative_acknowledge(msg),
             )
-        else:  # N.B try/else clause.
-            packet["total_hits"] = response["hits"]["total"]["value"]
-            for hit in response["hits"]["hits"]:
-                title, score, id = (
-                    hit["_source"]["title"],
-                    hit["_score"],
-                    hit["_source"]["id"],
-                )
-                results[id] = {"title": title, "score": score}
+        )
+        last_in_room[room] = task
+        task.add_done_callback(lambda t, room=room: forget(room, t))
+
 
-        packet["suggestions"] = results
-        if "timestamps" in packet:
-            packet["timestamps"].append(datetime.utcnow().timestamp())
-        producer.send_async(json.dumps(packet).encode("utf-8"), msg_received_callback)
+def log_cache_stats(cache, interval):
+    """
+    Log the cache hit/miss/eviction counters every interval seconds.
+    """
+
+    def log_stats():
+        while True:
+            time.sleep(interval)
+            logging.warning(
+                f"Query cache stats: {cache.stats}, size={len(cache.store)}"
+            )
+
+    Thread(target=log_stats, daemon=True).start()
 
 
 def main():
@@ -140,6 +574,8 @@ def main():
         help="URL of pulsar broker.",
         default=os.getenv("PULSAR_BROKER_URL"),
     )
+    runtime.add_arguments(parser)
+    supervisor.add_arguments(parser)
     parser.add_argument(
         "--es-url", help="Elastic Search URL", default=os.getenv("ES_URL")
     )
@@ -147,16 +583,135 @@ def main():
         "--field", help="ES document to search. Defaults to body.", default="body"
     )
     parser.add_argument(
-        "--query-type", help="ES query type", default="match", choices=["match", "mlt"]
+        "--query-type",
+        help="ES query type. bm25 and vector search the local --bm25-index and "
+        "--vector-index instead of ES.",
+        default="match",
+        choices=["match", "mlt", "bm25", "vector"],
+    )
+    parser.add_argument(
+        "--bm25-index",
+        help="Directory built by batch-pipeline/build-bm25-index.py.",
+        default=os.getenv("BM25_INDEX"),
+    )
+    parser.add_argument(
+        "--bm25-check-interval",
+        help="Seconds between checks for new segments of the BM25 index.",
+        default=30.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--vector-index",
+        help="Directory built by batch-pipeline/build-vector-index.py.",
+        default=os.getenv("VECTOR_INDEX"),
+    )
+    parser.add_argument(
+        "--nprobe",
+        help="IVF lists scanned per vector query. Higher is slower but finds "
+        "more of the true nearest neighbours.",
+        default=8,
+        type=int,
+    )
+    parser.add_argument(
+        "--routing-index",
+        help="ES index holding the site routing table written by "
+        "batch-pipeline/etl-to-es.py --index-type site. Searches of sites "
+        "missing from the table are skipped.",
+        default=os.getenv("ES_ROUTING_INDEX"),
+    )
+    parser.add_argument(
+        "--routing-file",
+        help="Read the site routing table from a JSON file instead.",
+        default=None,
+    )
+    parser.add_argument(
+        "--routing-refresh",
+        help="Seconds between reloads of the routing table.",
+        default=30.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--rank-in-es",
+        help="Rank hits by ES score * (answer_count + 1) inside ES and send "
+        "them straight to the web-servers, skipping the curator. Needs "
+        "answer_count and link in the index (etl-to-es.py).",
+        action="store_true",
     )
     # 10K is the default max_result_window limit in ES, but we only need 10 usually.
     parser.add_argument(
         "--limit-result-count", help="Limit ES result count.", default=10, type=int
     )
+    parser.add_argument(
+        "--batch-size",
+        help="Max messages searched per _msearch request. Defaults to 1 (no batching).",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--linger-ms",
+        help="Max time (in ms) to wait for a batch to fill up.",
+        default=5,
+        type=int,
+    )
+    parser.add_argument(
+        "--async-mode",
+        help="Run an asyncio worker with many ES queries in flight.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        help="Max concurrent ES queries in async mode.",
+        default=32,
+        type=int,
+    )
+    parser.add_argument(
+        "--cache-size",
+        help="Max cached query results. Defaults to 0 (cache disabled).",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        help="Seconds a cached query result stays valid.",
+        default=60.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--cache-path",
+        help="Share the cache between workers using a sqlite file at this path "
+        "(preferably on /dev/shm). Defaults to a per-process cache.",
+        default=None,
+    )
+    parser.add_argument(
+        "--drop-superseded",
+        help="Drop requests superseded by a newer request of the same room.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        help="Seconds between cache, drop count and throughput log lines.",
+        default=60.0,
+        type=float,
+    )
 
+    parser.add_argument(
+        "--codec",
+        help="Codec of outgoing messages. Incoming messages are decoded with "
+        "the codec they were sent with.",
+        default=os.getenv("PIPELINE_CODEC", DEFAULT_CODEC),
+        choices=CODECS,
+    )
+    parser.add_argument(
+        "--metrics-port",
+        help="Serve Prometheus metrics on localhost:PORT/metrics, worker i on "
+        "PORT + i. Disabled if zero.",
+        default=int(os.getenv("METRICS_PORT", 0)),
+        type=int,
+    )
     args = parser.parse_args()
 
-    if not args.index:
+    local = args.query_type in ["bm25", "vector"]
+    if not args.index and not local:
         parser.error(
             "Empty ES index. Update ES_INDEX environment variable with index name."
         )
@@ -166,14 +721,114 @@ def main():
             "Pulsar broker url is null. Set PULSAR_BROKER_URL environment variable."
         )
 
-    if not args.es_url:
+    if local:
+        if not getattr(args, f"{args.query_type}_index"):
+            parser.error(
+                f"--query-type {args.query_type} requires --{args.query_type}-index."
+            )
+        if args.async_mode:
+            parser.error(
+                f"--async-mode is not supported with --query-type {args.query_type}."
+            )
+    elif not args.es_url:
         parser.error("ES url is null. Set ES_URL environment variable.")
 
-    client = Client(args.pulsar_broker_url)
+    if args.async_mode and args.batch_size > 1:
+        parser.error("--batch-size is not supported with --async-mode.")
+
+    if args.routing_index and args.routing_file:
+        parser.error("--routing-index and --routing-file are exclusive.")
+    if local and args.rank_in_es:
+        parser.error(
+            f"--rank-in-es is not supported with --query-type {args.query_type}."
+        )
+    if local and (args.routing_index or args.routing_file):
+        parser.error(f"--query-type {args.query_type} does not use ES indexes.")
+
+    global codec, routes
+    try:
+        codec = Codec(args.codec)
+    except ValueError as e:
+        parser.error(str(e))
+    # State loaded here is shared by the workers (supervisor.py).
+    if args.routing_index:
+        # The ETL saves the table under the index prefix, our --index.
+        routes = RoutingTable.from_es(args.es_url, args.routing_index, args.index)
+    elif args.routing_file:
+        routes = RoutingTable.from_file(args.routing_file)
+    if routes is not None:
+        routes.reload()
+    backend = None
+    if args.query_type == "vector":
+        backend = VectorBackend(args.vector_index, args.nprobe)
+    elif args.query_type == "bm25":
+        backend = BM25Backend(args.bm25_index, args.bm25_check_interval)
+    if backend is not None:
+        backend.warm()
+    try:
+        runtime.profile_settings(args.pulsar_profile, args.pulsar_compression)
+        workers = supervisor.Supervisor(
+            "search",
+            lambda worker: run_worker(worker, args, backend),
+            args.workers,
+            args.pin_cpus,
+            args.drain_timeout,
+            args.stats_interval,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    workers.run()
+
+
+def run_worker(worker, args, backend=None):
+    """
+    Consume suggest-topic in a worker forked by the supervisor.
+
+    Threads and connections do not survive a fork, they are all started
+    here. backend is the local index (if any), loaded before the fork.
+    """
+    cache = None
+    if args.cache_size > 0:
+        if args.cache_path:
+            store = SqliteStore(args.cache_path, args.cache_size)
+        else:
+            store = MemoryStore(args.cache_size)
+        cache = QueryCache(store, args.cache_ttl)
+        log_cache_stats(cache, args.stats_interval)
+        metrics.watch_cache(cache)
+    freshness = FreshnessFilter("search", supersede=args.drop_superseded)
+    freshness.start_reporting(args.stats_interval)
+    metrics.watch_drops(freshness)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port + worker.index)
+    if routes is not None:
+        routes.start_refreshing(args.routing_refresh)
+
+    client = runtime.connect(
+        args.pulsar_broker_url, args.pulsar_profile, args.pulsar_compression
+    )
+    worker.on_stop(client.stop)
+    worker.watch(client)
     in_topic = "suggest-topic"
-    out_topic = "curate-topic"
-    es = Elasticsearch(args.es_url)
-    find_suggestions(es, in_topic, out_topic, client, args)
+    out_topic = "suggestions-topic" if args.rank_in_es else "curate-topic"
+    try:
+        if args.async_mode:
+            # AsyncElasticsearch needs the async extra (aiohttp), import lazily.
+            from elasticsearch import AsyncElasticsearch
+
+            es = AsyncElasticsearch(args.es_url)
+            asyncio.run(
+                find_suggestions_async(
+                    es, in_topic, out_topic, client, args, cache, freshness
+                )
+            )
+        else:
+            es = backend or Elasticsearch(args.es_url)
+            find_suggestions(es, in_topic, out_topic, client, args, cache, freshness)
+    except runtime.Stopped:
+        logging.warning(f"Worker {worker.index} drained.")
+    finally:
+        client.close()
 
 
 if __name__ == "__main__":
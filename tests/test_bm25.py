@@ -0,0 +1,62 @@
+import os
+import random
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+from bm25 import SiteIndex, _tf_part, site_dir, write_meta, write_segment
+from text import tokenize
+
+WORDS = [f"w{i}" for i in range(30)]
+
+
+def brute_force(segments, text, k):
+    """
+    Score every newest copy of a question with the statistics of SiteIndex.
+    """
+    docs = [doc for segment in segments for doc in segment]
+    avg_length = sum(len(tokenize(text)) for _, _, text in docs) / len(docs)
+    latest = {id: text for id, _, text in docs}
+    query_tf = {}
+    for term in tokenize(text):
+        query_tf[term] = query_tf.get(term, 0) + 1
+    scores = {}
+    for term, qtf in query_tf.items():
+        df = sum(term in tokenize(text) for _, _, text in docs)
+        if not df:
+            continue
+        idf = np.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+        for id, text in latest.items():
+            terms = tokenize(text)
+            tf = terms.count(term)
+            if tf:
+                part = _tf_part(float(tf), float(len(terms)), avg_length)
+                scores[id] = scores.get(id, 0.0) + qtf * idf * part
+    return sorted(scores.values(), reverse=True)[:k]
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_search_matches_brute_force(tmp_path, seed):
+    rng = random.Random(seed)
+    path = str(tmp_path)
+    write_meta(path, ["body"])
+    segments = []
+    for _ in range(rng.randint(2, 4)):
+        # Ids overlap between segments: questions are indexed again.
+        segment = []
+        for id in rng.sample(range(40), rng.randint(5, 20)):
+            text = " ".join(rng.choices(WORDS, k=rng.randint(1, 12)))
+            segment.append((id, f"title {id}", text))
+        write_segment(path, "site", segment)
+        segments.append(segment)
+    index = SiteIndex(site_dir(path, "site"))
+
+    for _ in range(5):
+        query = " ".join(rng.choices(WORDS, k=rng.randint(1, 4)))
+        k = rng.randint(1, 5)
+        _, hits = index.search(query, k)
+        expected = brute_force(segments, query, k)
+        assert [score for _, _, score in hits] == pytest.approx(expected)
+        assert len({id for id, _, _ in hits}) == len(hits)
@@ -0,0 +1,45 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+from scanner import Scan
+
+
+@pytest.fixture
+def dump(tmp_path):
+    path = tmp_path / "dump.ndjson"
+    with open(path, "w") as f:
+        for id in range(10000):
+            f.write(json.dumps({"id": id, "type": "question"}) + "\n")
+    return str(path)
+
+
+def scan(path):
+    return Scan(path, workers=2, chunk_size=4096, max_pending=2)
+
+
+def test_break_early(dump):
+    results = scan(dump).map(batched=True)
+    assert next(results)
+    results.close()
+
+    for record in scan(dump).map(lambda record: record["id"]):
+        break
+
+
+def test_worker_raises(dump):
+    def fail(record):
+        if record["id"] == 5000:
+            raise KeyError("id")
+        return record
+
+    with pytest.raises(KeyError):
+        for _ in scan(dump).map(fail):
+            pass
+
+
+def test_count(dump):
+    assert scan(dump).count() == 10000
@@ -8,6 +8,10 @@ import os
 import sys
 import socketio
 
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+from metrics import SPANS
+
 url = os.getenv("WEB_SERVER")
 sio = socketio.Client()
 
@@ -40,9 +44,12 @@ def handle_suggestions(message):
     """
     Handler for messages sent by the server to the "suggestion list" event.
     """
-    message["timestamps"].append(datetime.utcnow().timestamp())
-    timestamps_str = ", ".join([f"{ts:.2f}" for ts in message["timestamps"]])
-    elapsed_time = (message["timestamps"][-1] - message["timestamps"][0]) * 1000
+    spans = message["spans"]
+    spans["client_rsp"] = datetime.utcnow().timestamp()
+    timestamps_str = ", ".join(
+        [f"{spans[name]:.6f}" if name in spans else "" for name in SPANS]
+    )
+    elapsed_time = (spans["client_rsp"] - spans["client_send"]) * 1000
     seq_id = message["sequence_id"]
     site = message["site"]
     hits = message["total_hits"]
@@ -92,10 +99,7 @@ def main():
     out_file_path = os.path.join(args.out_dir, sio.sid)
     global out_file
     out_file = open(out_file_path, "a")
-    print(
-        "site, hits, msg_id, client_send, server_req, es_start, es_end, pg_start, pg_end, server_rsp, client_rsp",
-        file=out_file,
-    )
+    print(", ".join(["site", "hits", "msg_id"] + SPANS), file=out_file)
     global num_messages
     num_messages = args.num_messages
 
@@ -106,7 +110,7 @@ def main():
         message = {
             "text": l_json["body"][0:body_length],  # for now limit to 100 characters.
             "stage": "send-request",
-            "timestamps": [datetime.utcnow().timestamp()],
+            "spans": {"client_send": datetime.utcnow().timestamp()},
             "sequence_id": seq_id,
             "site": l_json["site"],
         }
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+"""
+Open-loop load generator simulating many users typing questions.
+
+Keeps --clients socket.io connections open and starts typing sessions at
+Poisson (or trace-driven) arrival times, independently of how fast the
+server answers. Every session replays one question from the NDJSON dataset
+the way app.js sends it: the growing prefix of the question is emitted each
+time the user types a space, with per-user typing speeds.
+
+To correct for coordinated omission every request is stamped with the time
+it was *scheduled* to be sent (client_send), not the time the generator got
+around to sending it, so any delay caused by an overloaded generator or a
+lack of free connections shows up as latency. The actual send time is kept
+in client_actual.
+
+Responses are written in the same CSV format as file-input.py, so report.py
+can analyze them.
+"""
+
+from argparse import ArgumentParser, FileType
+import asyncio
+from datetime import datetime
+import json
+import logging
+import math
+import os
+import random
+import sys
+
+import socketio
+
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+from metrics import SPANS
+
+url = os.getenv("WEB_SERVER")
+
+out_event = "get-suggestions"
+in_event = "suggestions-list"
+
+logging.basicConfig(level=logging.INFO)
+
+
+def load_questions(f, body_length, limit):
+    questions = []
+    for line in f:
+        l_json = json.loads(line)
+        if "body" not in l_json or "site" not in l_json:
+            continue
+        questions.append((l_json["site"], l_json["body"][0:body_length]))
+        if limit and len(questions) >= limit:
+            break
+    return questions
+
+
+def poisson_arrivals(rate):
+    """
+    Yield session start offsets (seconds) of a Poisson process.
+    """
+    t = 0.0
+    while True:
+        t += random.expovariate(rate)
+        yield t
+
+
+def trace_arrivals(f):
+    """
+    Yield session start offsets (seconds) read from a trace, one per line.
+    """
+    for line in f:
+        line = line.strip()
+        if line:
+            yield float(line)
+
+
+def prefixes(text):
+    """
+    Return the requests app.js would send while text is typed.
+    """
+    words = text.split()
+    return [" ".join(words[: i + 1]) + " " for i in range(len(words))]
+
+
+class LoadGenerator:
+    def __init__(self, args, questions, out_file):
+        self.args = args
+        self.questions = questions
+        self.out_file = out_file
+        self.stats = {"sessions": 0, "sent": 0, "received": 0, "late_starts": 0}
+        self.max_lateness = 0.0
+        self.seq_ids = {}
+        self.free = asyncio.Queue()
+        self.clients = []
+        self.loop = asyncio.get_running_loop()
+        # Map loop time to wall clock (utc timestamps used by the pipeline).
+        self.wall_offset = datetime.utcnow().timestamp() - self.loop.time()
+
+    def wall(self, loop_time):
+        return self.wall_offset + loop_time
+
+    async def connect(self):
+        async def open_one():
+            client = socketio.AsyncClient(reconnection=False)
+            client.on(in_event, self.handle_suggestions)
+            await client.connect(url)
+            self.seq_ids[client] = 0
+            self.clients.append(client)
+            self.free.put_nowait(client)
+
+        pending = self.args.clients
+        while pending:
+            batch = min(pending, self.args.connect_batch)
+            await asyncio.gather(*[open_one() for _ in range(batch)])
+            pending -= batch
+        logging.info(f"Opened {len(self.clients)} connections.")
+
+    async def handle_suggestions(self, message):
+        spans = message["spans"]
+        spans["client_rsp"] = datetime.utcnow().timestamp()
+        self.stats["received"] += 1
+        timestamps = [f"{spans[n]:.6f}" if n in spans else "" for n in SPANS]
+        actual = spans.get("client_actual")
+        timestamps.append(f"{actual:.6f}" if actual is not None else "")
+        row = [message["site"], str(message.get("total_hits", ""))]
+        row.append(str(message["sequence_id"]))
+        print(", ".join(row + timestamps), file=self.out_file)
+
+    async def session(self, client, site, text, start):
+        """
+        Type text on client, sending a request on every space.
+        """
+        try:
+            # Typing speed of this user (words per minute).
+            wpm = random.lognormvariate(math.log(self.args.wpm), 0.3)
+            t = start
+            for prefix in prefixes(text):
+                await asyncio.sleep(max(t - self.loop.time(), 0))
+                self.seq_ids[client] += 1
+                message = {
+                    "text": prefix,
+                    "stage": "send-request",
+                    "spans": {
+                        "client_send": self.wall(t),
+                        "client_actual": datetime.utcnow().timestamp(),
+                    },
+                    "sequence_id": self.seq_ids[client],
+                    "site": site,
+                }
+                await client.emit(out_event, message)
+                self.stats["sent"] += 1
+                t += random.expovariate(wpm / 60)
+        finally:
+            self.free.put_nowait(client)
+
+    async def run(self, arrivals):
+        start = self.loop.time()
+        end = start + self.args.duration
+        sessions = []
+        for i, offset in enumerate(arrivals):
+            if self.args.sessions and i >= self.args.sessions:
+                break
+            intended = start + offset
+            if intended > end:
+                break
+            await asyncio.sleep(max(intended - self.loop.time(), 0))
+            if self.free.empty():
+                self.stats["late_starts"] += 1
+            client = await self.free.get()
+            # Open-loop: the session keeps its intended start time even if
+            # no connection was free at that time.
+            self.max_lateness = max(self.max_lateness, self.loop.time() - intended)
+            site, text = self.questions[i % len(self.questions)]
+            sessions.append(
+                asyncio.create_task(self.session(client, site, text, intended))
+            )
+            self.stats["sessions"] += 1
+
+        await asyncio.gather(*sessions)
+        # Give in-flight requests time to come back.
+        await asyncio.sleep(self.args.drain)
+        await asyncio.gather(*[client.disconnect() for client in self.clients])
+
+
+async def main_async(args):
+    questions = load_questions(args.file, args.body_length, args.max_questions)
+    if not questions:
+        raise SystemExit("No questions with a body and a site in the input file.")
+
+    if args.trace:
+        arrivals = trace_arrivals(args.trace)
+    else:
+        arrivals = poisson_arrivals(args.rate)
+
+    out_file_path = os.path.join(args.out_dir, f"load-generator-{os.getpid()}")
+    with open(out_file_path, "a") as out_file:
+        print(
+            ", ".join(["site", "hits", "msg_id"] + SPANS + ["client_actual"]),
+            file=out_file,
+        )
+        generator = LoadGenerator(args, questions, out_file)
+        await generator.connect()
+        await generator.run(arrivals)
+
+    logging.info(
+        f"{generator.stats}. Max session start lateness "
+        f"{generator.max_lateness * 1000:.1f} ms. Saved metrics to {out_file_path}."
+    )
+
+
+def main():
+    parser = ArgumentParser("you-complete-me open-loop load generator")
+    parser.add_argument("file", help="NDJSON file with questions", type=FileType("r"))
+    parser.add_argument(
+        "--out-dir", help="Output dir where metrics are stored", default="/tmp"
+    )
+    parser.add_argument(
+        "--clients", help="Number of socket.io connections.", default=1000, type=int
+    )
+    parser.add_argument(
+        "--connect-batch",
+        help="Connections opened concurrently while ramping up.",
+        default=100,
+        type=int,
+    )
+    parser.add_argument(
+        "--rate",
+        help="Typing sessions started per second (Poisson arrivals).",
+        default=10.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--trace",
+        help="File with session start offsets in seconds, one per line. "
+        "Overrides --rate.",
+        type=FileType("r"),
+    )
+    parser.add_argument(
+        "--duration", help="Seconds to start sessions for.", default=60.0, type=float
+    )
+    parser.add_argument(
+        "--sessions",
+        help="Stop after this many sessions. Defaults to 0 (no limit).",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--wpm", help="Median typing speed in words per minute.", default=40, type=float
+    )
+    parser.add_argument(
+        "--body-length",
+        help="Characters of each question body to type.",
+        default=100,
+        type=int,
+    )
+    parser.add_argument(
+        "--max-questions",
+        help="Questions loaded from file. Defaults to 100000.",
+        default=100_000,
+        type=int,
+    )
+    parser.add_argument(
+        "--drain",
+        help="Seconds to wait for responses after the last request.",
+        default=5.0,
+        type=float,
+    )
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
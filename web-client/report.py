@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+"""
+Latency breakdown and regression report for load test output.
+
+file-input.py writes one CSV per client to --out-dir with a timestamp per
+pipeline span. This script streams every client file in chunks, computes
+per-hop durations with numpy and accumulates them in log-spaced histograms,
+so memory stays flat no matter how many rows there are. It reports
+p50/p90/p99/p99.9 per stage and per site, throughput over time and hops
+whose durations are negative (clocks of the hosts disagree).
+
+A summary can be saved as JSON and compared against a baseline run. The
+script exits with status 1 if any compared percentile regressed by more than
+--threshold.
+"""
+
+from argparse import ArgumentParser
+from collections import Counter
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+from metrics import SPANS
+
+logging.basicConfig(level=logging.INFO)
+
+# Stage name -> (start span, end span). Hops between hosts are marked as
+# such, their durations are subject to clock skew.
+STAGES = {
+    "client->server": ("client_send", "server_req"),
+    "server->search": ("server_req", "es_start"),
+    "search": ("es_start", "es_end"),
+    "search->curate": ("es_end", "pg_start"),
+    "curate": ("pg_start", "pg_end"),
+    "curate->server": ("pg_end", "server_rsp"),
+    "server->client": ("server_rsp", "client_rsp"),
+    "total": ("client_send", "client_rsp"),
+}
+CROSS_HOST = {name for name in STAGES if "->" in name}
+
+PERCENTILES = [50, 90, 99, 99.9]
+# Log-spaced bins from 1 us to 100 s, ~1% apart.
+BINS = np.geomspace(1e-6, 100, 1850)
+
+
+class Summary:
+    """
+    Streaming accumulator of latency histograms and throughput.
+    """
+
+    def __init__(self):
+        self.histograms = {}  # site -> counts, shape (stages, bins + 1)
+        self.negative = Counter()  # stage -> count of negative durations
+        self.missing = Counter()  # stage -> count of rows without the spans
+        self.per_second = Counter()  # unix second -> completed requests
+        self.rows = 0
+
+    def add(self, chunk):
+        self.rows += len(chunk)
+        durations = np.column_stack(
+            [
+                chunk[end].to_numpy(float) - chunk[start].to_numpy(float)
+                for start, end in STAGES.values()
+            ]
+        )
+        missing = np.isnan(durations)
+        negative = durations < 0
+        for i, stage in enumerate(STAGES):
+            self.negative[stage] += int(negative[:, i].sum())
+            self.missing[stage] += int(missing[:, i].sum())
+
+        bins = np.searchsorted(BINS, np.clip(durations, 0, None))
+        valid = ~missing
+        stage_index = np.broadcast_to(np.arange(len(STAGES)), durations.shape)
+        sites, site_index = np.unique(chunk["site"].astype(str), return_inverse=True)
+        for i, site in enumerate(sites):
+            if site not in self.histograms:
+                self.histograms[site] = np.zeros((len(STAGES), len(BINS) + 1), int)
+            rows = site_index == i
+            mask = valid & rows[:, None]
+            np.add.at(self.histograms[site], (stage_index[mask], bins[mask]), 1)
+
+        done = chunk["client_rsp"].dropna().to_numpy(float).astype(np.int64)
+        seconds, counts = np.unique(done, return_counts=True)
+        self.per_second.update(dict(zip(seconds.tolist(), counts.tolist())))
+
+    def percentiles(self, counts):
+        """
+        Return {percentile: seconds} for one histogram row.
+        """
+        total = counts.sum()
+        if not total:
+            return {p: None for p in PERCENTILES}
+        cumulative = np.cumsum(counts)
+        result = {}
+        for p in PERCENTILES:
+            i = int(np.searchsorted(cumulative, total * p / 100))
+            result[p] = float(BINS[min(i, len(BINS) - 1)])
+        return result
+
+    def to_dict(self):
+        overall = sum(self.histograms.values())
+        report = {"rows": self.rows, "stages": {}, "sites": {}}
+        for i, stage in enumerate(STAGES):
+            report["stages"][stage] = {
+                "count": int(overall[i].sum()) if self.histograms else 0,
+                "negative": self.negative[stage],
+                "missing": self.missing[stage],
+                "percentiles": self.percentiles(overall[i]) if self.histograms else {},
+            }
+        total = list(STAGES).index("total")
+        for site, counts in self.histograms.items():
+            report["sites"][site] = {
+                "count": int(counts[total].sum()),
+                "percentiles": self.percentiles(counts[total]),
+            }
+        if self.per_second:
+            start, end = min(self.per_second), max(self.per_second)
+            series = [self.per_second.get(s, 0) for s in range(start, end + 1)]
+            report["throughput"] = {
+                "start": start,
+                "per_second": series,
+                "mean": float(np.mean(series)),
+                "peak": int(max(series)),
+            }
+        # JSON keys must be strings.
+        return json.loads(json.dumps(report))
+
+
+def client_files(out_dir):
+    """
+    Yield the load test output files in out_dir.
+    """
+    for name in sorted(os.listdir(out_dir)):
+        path = os.path.join(out_dir, name)
+        if not os.path.isfile(path):
+            continue
+        with open(path) as f:
+            if f.readline().startswith("site,"):
+                yield path
+
+
+def summarize(out_dir, chunk_size):
+    summary = Summary()
+    files = 0
+    for path in client_files(out_dir):
+        files += 1
+        for chunk in pd.read_csv(
+            path,
+            skipinitialspace=True,
+            usecols=["site"] + SPANS,
+            dtype={span: float for span in SPANS},
+            chunksize=chunk_size,
+        ):
+            summary.add(chunk)
+    logging.info(f"Read {summary.rows} rows from {files} files in {out_dir}.")
+    return summary.to_dict()
+
+
+def load(path, chunk_size):
+    """
+    Return the summary of a run given its output dir or a saved summary.
+    """
+    if os.path.isdir(path):
+        return summarize(path, chunk_size)
+    with open(path) as f:
+        return json.load(f)
+
+
+def print_report(report):
+    header = "".join(f"{'p' + str(p):>10}" for p in PERCENTILES)
+    print(f"{'stage':<16}{'count':>10}{header}{'negative':>10}")
+    for stage, stats in report["stages"].items():
+        values = "".join(
+            f"{v * 1000:>10.2f}" if v is not None else f"{'-':>10}"
+            for v in stats["percentiles"].values()
+        )
+        print(f"{stage:<16}{stats['count']:>10}{values}{stats['negative']:>10}")
+    print("(milliseconds)\n")
+
+    print(f"{'site (total)':<24}{'count':>10}{header}")
+    sites = sorted(report["sites"].items(), key=lambda x: x[1]["count"], reverse=True)
+    for site, stats in sites:
+        values = "".join(
+            f"{v * 1000:>10.2f}" if v is not None else f"{'-':>10}"
+            for v in stats["percentiles"].values()
+        )
+        print(f"{site:<24}{stats['count']:>10}{values}")
+    print()
+
+    if "throughput" in report:
+        throughput = report["throughput"]
+        seconds = len(throughput["per_second"])
+        print(
+            f"Throughput over {seconds} s: mean {throughput['mean']:.1f} msg/s, "
+            f"peak {throughput['peak']} msg/s."
+        )
+
+    for stage, stats in report["stages"].items():
+        if stage in CROSS_HOST and stats["negative"]:
+            print(
+                f"Clock skew: {stats['negative']} negative {stage} durations. "
+                "Check NTP on the hosts involved."
+            )
+
+
+def compare(report, baseline, percentile, threshold):
+    """
+    Return the list of stages whose percentile regressed beyond threshold.
+    """
+    regressions = []
+    key = str(percentile)
+    for stage, stats in report["stages"].items():
+        current = stats["percentiles"].get(key)
+        previous = baseline["stages"].get(stage, {}).get("percentiles", {}).get(key)
+        if not current or not previous:
+            continue
+        change = current / previous - 1
+        print(
+            f"{stage:<16} p{percentile}: {previous * 1000:.2f} ms -> "
+            f"{current * 1000:.2f} ms ({change:+.1%})"
+        )
+        if change > threshold:
+            regressions.append(stage)
+    return regressions
+
+
+def main():
+    parser = ArgumentParser("Summarize and compare load test runs.")
+    parser.add_argument("out_dir", help="Dir with client output (file-input.py).")
+    parser.add_argument("--save", help="Save the summary as JSON to this path.")
+    parser.add_argument(
+        "--baseline", help="Baseline run to compare with (output dir or summary)."
+    )
+    parser.add_argument(
+        "--percentile",
+        help="Percentile compared against the baseline.",
+        default=99,
+        type=float,
+        choices=PERCENTILES,
+    )
+    parser.add_argument(
+        "--threshold",
+        help="Max allowed relative increase over the baseline, e.g. 0.1 for 10%%.",
+        default=0.1,
+        type=float,
+    )
+    parser.add_argument(
+        "--chunk-size", help="Rows read per chunk.", default=500_000, type=int
+    )
+    args = parser.parse_args()
+
+    report = summarize(args.out_dir, args.chunk_size)
+    print_report(report)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f)
+
+    if args.baseline:
+        baseline = load(args.baseline, args.chunk_size)
+        percentile = args.percentile
+        if percentile == int(percentile):
+            percentile = int(percentile)
+        regressions = compare(report, baseline, percentile, args.threshold)
+        if regressions:
+            logging.error(f"Regression over {args.threshold:.0%} in: {regressions}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -39,8 +39,9 @@ def handle_suggestions(message):
     """
     Handler for messages sent by the server to the "suggestion list" event.
     """
-    message["timestamps"].append(datetime.utcnow().timestamp())
-    elasped_time = (message["timestamps"][-1] - message["timestamps"][0]) * 1000
+    spans = message["spans"]
+    spans["client_rsp"] = datetime.utcnow().timestamp()
+    elasped_time = (spans["client_rsp"] - spans["client_send"]) * 1000
     num_suggestions = len(message.get("suggestions", []))
     logging.info(f"Took {elasped_time} ms. Returned {num_suggestions} suggestions.")
     msg_id = message["sequence_id"]
@@ -78,7 +79,7 @@ def main():
             message = {
                 "text": text,
                 "stage": "send-request",
-                "timestamps": [datetime.utcnow().timestamp()],
+                "spans": {"client_send": datetime.utcnow().timestamp()},
                 "sequence_id": seq_id,
                 "site": "stackoverflow",
             }
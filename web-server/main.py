@@ -1,11 +1,24 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
-from datetime import datetime
-import json
 import os
+import re
+import socket
+
+# socket.io server mode: "threading" or "eventlet". eventlet serves every
+# socket from one event loop and has to patch the stdlib before anything
+# else is imported, hence an environment variable instead of a flag.
+async_mode = os.getenv("SOCKETIO_ASYNC_MODE", "threading")
+if async_mode == "eventlet":
+    import eventlet
+    from eventlet import tpool
+
+    eventlet.monkey_patch()
+
 import logging
+import sys
 from threading import Lock
+import time
 
 from engineio.payload import Payload
 
@@ -14,14 +27,19 @@ Payload.max_decode_packets = 100
 from flask import Flask, render_template, request
 from flask_socketio import SocketIO, emit, send
 
-from pulsar import Client
 from pulsar import ConsumerType
 
+# Modules shared by all stages of the pipeline live in <repo>/common.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../common"))
+from codec import CODECS, DEFAULT_CODEC, Codec, decode_message
+from freshness import FreshnessFilter, set_deadline
+from metrics import REGISTRY, StageMetrics, mark, start_metrics_server
+import runtime
+
 app = Flask(__name__, template_folder="templates", static_folder="static")
 
 app.config["SECRET_KEY"] = "secret!"
-socketio = SocketIO(app, async_mode="threading")
-# socketio = SocketIO(app, async_mode="eventlet")
+socketio = SocketIO(app, async_mode=async_mode)
 
 in_event = "get-suggestions"
 out_event = "suggestions-list"
@@ -29,6 +47,9 @@ out_event = "suggestions-list"
 pulsar_broker_url = os.getenv("PULSAR_BROKER_URL")
 out_topic = "suggest-topic"
 in_topic = "suggestions-topic"
+# Topic this instance consumes suggestions from. Every instance gets its own
+# (in_topic-<instance id>) so replies reach the instance holding the socket.
+reply_topic = in_topic
 
 client = None
 producer = None
@@ -36,6 +57,18 @@ producer = None
 thread = None
 thread_lock = Lock()
 loopback = False
+# Seconds a request may take end to end before stages drop it (None to disable).
+deadline = None
+freshness = FreshnessFilter("web-server")
+# Codec of outgoing messages, set from the command line.
+codec = Codec()
+metrics = StageMetrics("web-server")
+metrics.watch_drops(freshness)
+pipeline_time = REGISTRY.histogram(
+    "ycm_pipeline_seconds",
+    "Time between the web-server receiving a request and its suggestions.",
+    stage="web-server",
+)
 
 logging.basicConfig(level=logging.INFO)
 
@@ -63,14 +96,31 @@ def get_suggestions(data):
     logging.debug(f"Message from client {request.sid} is {data}")
 
     data["room"] = request.sid
+    # Tell the curator where to send the suggestions (never trust a client).
+    data.pop("reply_to", None)
+    if reply_topic != in_topic:
+        data["reply_to"] = reply_topic
     if "timestamps" in data:
-        data["timestamps"].append(datetime.utcnow().timestamp())
+        # Clients predating named spans send a list of timestamps.
+        mark(data, "client_send", data.pop("timestamps")[0])
+    mark(data, "server_req")
+    if deadline:
+        set_deadline(data, deadline)
+    freshness.observe(data)
 
     if loopback:
         data["suggestions"] = loopback_suggestions(data["text"])
         socketio.emit(out_event, data, room=request.sid)
     else:
-        producer.send_async(json.dumps(data).encode("utf-8"), msg_received_callback)
+        start = time.perf_counter()
+        encoded = codec.encode(data)
+        metrics.encode.observe(time.perf_counter() - start)
+        producer.send_async(
+            encoded,
+            msg_received_callback,
+            properties=codec.properties,
+            partition_key=request.sid,
+        )
 
 
 def loopback_suggestions(text):
@@ -81,29 +131,50 @@ def loopback_suggestions(text):
     return suggestions
 
 
-def consumer_thread(client, in_topic):
+def consumer_thread(client, in_topic, exclusive=False):
     """
     Pulsar consumer thread.
 
     This web-server thread consumes messages from the given topic and emits
-    a list of suggestions back to the client.
+    a list of suggestions back to the client. Suggestions that expired or
+    that answer an older question than the latest one sent by the client
+    are not emitted.
+
+    A per-instance topic only carries the replies of this instance and is
+    consumed exclusively. Messages are acked once emitted or dropped.
     """
-    consumer = client.subscribe(
-        in_topic, "test-subscription", consumer_type=ConsumerType.Shared
-    )
+    if exclusive:
+        consumer = client.subscribe(
+            in_topic, f"{in_topic}-subscription", consumer_type=ConsumerType.Exclusive
+        )
+    else:
+        consumer = client.subscribe(
+            in_topic, "test-subscription", consumer_type=ConsumerType.Shared
+        )
+
+    receive = consumer.receive
+    if async_mode == "eventlet":
+        # A blocking receive would stall the event loop and every socket.
+        receive = lambda: tpool.execute(consumer.receive)
 
     while True:
-        msg = consumer.receive()
-        consumer.acknowledge(msg)
+        msg = receive()
         msg_id = msg.message_id()
-        data = msg.data().decode("utf-8")
-        packet = json.loads(data)
-        if "timestamps" in packet:
-            packet["timestamps"].append(datetime.utcnow().timestamp())
+        start = time.perf_counter()
+        packet = decode_message(msg)
+        metrics.decode.observe(time.perf_counter() - start)
+        # Suggestions ranked in ES (search-es.py --rank-in-es) skip the curator.
+        previous = "pg_end" if "pg_end" in packet["spans"] else "es_end"
+        received = metrics.received(packet, previous, "server_rsp")
+        if "server_req" in packet["spans"]:
+            pipeline_time.observe(max(received - packet["spans"]["server_req"], 0.0))
         logging.debug(
             f"Web-server: Received message {packet['text']}, id={msg_id}, room={packet['room']}"
         )
-        socketio.emit(out_event, packet, room=packet["room"])
+        if not freshness.drop_reason(packet):
+            socketio.emit(out_event, packet, room=packet["room"])
+            metrics.messages.inc()
+        consumer.acknowledge(msg)
 
 
 @socketio.on("connect")
@@ -114,7 +185,9 @@ def test_connect():
     global thread
     with thread_lock:
         if thread is None:
-            thread = socketio.start_background_task(consumer_thread, client, in_topic)
+            thread = socketio.start_background_task(
+                consumer_thread, client, reply_topic, reply_topic != in_topic
+            )
 
 
 @app.route("/")
@@ -125,16 +198,83 @@ def hello_world():
 def main():
     parser = ArgumentParser("Web-server")
     parser.add_argument("--loopback", action="store_true", help="Loop back mode")
+    parser.add_argument(
+        "--deadline-ms",
+        help="Drop requests older than this many ms. Defaults to 0 (disabled).",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--drop-superseded",
+        help="Drop requests superseded by a newer request of the same room.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        help="Seconds between drop count and pulsar rate log lines.",
+        default=60.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--codec",
+        help="Codec of outgoing messages. Incoming messages are decoded with "
+        "the codec they were sent with.",
+        default=os.getenv("PIPELINE_CODEC", DEFAULT_CODEC),
+        choices=CODECS,
+    )
+    parser.add_argument(
+        "--instance-id",
+        help="Name of this web-server instance, unique among the instances "
+        "behind the load balancer. Defaults to the host name.",
+        default=os.getenv("WEB_SERVER_ID", socket.gethostname()),
+    )
+    parser.add_argument(
+        "--shared-reply-topic",
+        help=f"Consume replies from {in_topic} instead of a per-instance topic. "
+        "Only correct with a single web-server instance.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        help="Serve Prometheus metrics on localhost:PORT/metrics. Disabled if zero.",
+        default=int(os.getenv("METRICS_PORT", 0)),
+        type=int,
+    )
+    runtime.add_arguments(parser)
     args = parser.parse_args()
 
-    global loopback
+    global loopback, deadline, codec, reply_topic
+    try:
+        codec = Codec(args.codec)
+    except ValueError as e:
+        parser.error(str(e))
     loopback = args.loopback
+    deadline = args.deadline_ms / 1000 if args.deadline_ms else None
+    freshness.supersede = args.drop_superseded
+    freshness.start_reporting(args.stats_interval)
+    if args.shared_reply_topic:
+        reply_topic = in_topic
+    else:
+        # Pulsar topic names only allow a few punctuation characters.
+        reply_topic = f"{in_topic}-" + re.sub(r"[^\w.-]", "-", args.instance_id)
+    logging.info(f"Consuming suggestions from {reply_topic}.")
 
     if not loopback:
         global client, producer
-        client = Client(pulsar_broker_url)
+        try:
+            client = runtime.connect(
+                pulsar_broker_url, args.pulsar_profile, args.pulsar_compression
+            )
+        except ValueError as e:
+            parser.error(str(e))
+        client.start_reporting(args.stats_interval, "web-server")
         producer = client.create_producer(out_topic)
 
+    # debug=True serves the app from a child process of the reloader, the
+    # parent only watches the sources.
+    if args.metrics_port and os.getenv("WERKZEUG_RUN_MAIN") == "true":
+        start_metrics_server(args.metrics_port)
+
     socketio.run(app, host="0.0.0.0", port=80, debug=True)
     print("Closing server connection")
 
@@ -1,4 +1,6 @@
 const socket = io('http://ec2-44-232-15-31.us-west-2.compute.amazonaws.com')
+// Increasing id per request so the pipeline can drop superseded requests.
+var sequence_id = 0
 
 socket.on('connect', function() {
 console.log("I'm connected")
@@ -8,7 +10,8 @@ document.body.onkeyup = function(e){
 if(e.keyCode == 32){
 	var x = document.getElementById("questions");
 	console.log(x.value);
-	msg = {"text": x.value, "sequence_id": 0, "site": "stackoverflow", "timestamps": [123]}
+	sequence_id += 1
+	msg = {"text": x.value, "sequence_id": sequence_id, "site": "stackoverflow", "spans": {"client_send": Date.now() / 1000}}
 	socket.emit('get-suggestions', msg);
 }
 }